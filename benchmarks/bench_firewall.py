@@ -0,0 +1,80 @@
+"""
+Benchmarks of hub.firewall against an in-memory kernel, see hub.fw.memory.
+
+Each scenario runs against a synthetic Hub at 100, 1k and 10k scale with each backend, the iptc one up to 1k.
+The wall time of a firewall operation, including any jobs it queues, is reported alongside the number of kernel
+commits it made, so that regressions in either show up in CI. Run with `make benchmark`.
+"""
+
+import os
+
+from django.contrib.auth.models import User
+
+from hub import firewall
+from hub.fw import snapshot
+import hub.models
+
+
+ROUNDS = 5
+
+
+def _toggle(queryset, field, values):
+    "flips `field` of the first object of `queryset` between two `values` without sending signals"
+    obj = queryset.first()
+    queryset.filter(pk=obj.pk).update(**{field: values[getattr(obj, field) == values[0]]})
+
+
+def bench_init(benchmark, scale, kernel, report):
+    "boot-time initialisation of the full firewall from an empty kernel, compiled from the DB"
+
+    def setup():
+        kernel.reset()
+        if os.path.exists(snapshot._path(firewall.backend)):
+            os.remove(snapshot._path(firewall.backend))
+
+    benchmark.pedantic(firewall.init.__wrapped__, setup=setup, rounds=ROUNDS)
+    report(benchmark)
+
+
+def bench_apply_rule(benchmark, scale, kernel, report):
+    "applying a Rule whose ports changed"
+    firewall.init.__wrapped__()
+    rules = hub.models.Rule.objects.filter(destination_protocol=hub.models.Rule.TCP).order_by("pk")
+    rule = rules.first()
+
+    def setup():
+        _toggle(rules, "destination_ports", ["22", "22,443"])
+        kernel.clear_counters()
+
+    benchmark.pedantic(firewall.apply_rule.__wrapped__, args=(rule,), setup=setup, rounds=ROUNDS)
+    report(benchmark)
+
+
+def bench_apply_policy(benchmark, scale, kernel, report):
+    "applying a Policy that gained or lost a target Server"
+    firewall.init.__wrapped__()
+    policy = hub.models.Policy.objects.order_by("pk").first()
+    server = hub.models.Server.objects.exclude(policy=policy).order_by("pk").first()
+
+    def setup():
+        if policy.servers.filter(pk=server.pk).exists():
+            hub.models.Policy.servers.through.objects.filter(policy=policy, server=server).delete()
+        else:
+            hub.models.Policy.servers.through.objects.create(policy=policy, server=server)
+        kernel.clear_counters()
+
+    benchmark.pedantic(firewall.apply_policy.__wrapped__, args=(policy,), setup=setup, rounds=ROUNDS)
+    report(benchmark)
+
+
+def bench_sync_all_users(benchmark, scale, kernel, report):
+    "syncing shared User devices after a User shared or unshared theirs"
+    firewall.init.__wrapped__()
+    profiles = hub.models.UserProfile.objects.filter(user__in=User.objects.filter(username__startswith="bench-user-")).order_by("pk")
+
+    def setup():
+        _toggle(profiles, "shared", [True, False])
+        kernel.clear_counters()
+
+    benchmark.pedantic(firewall.sync_all_users, setup=setup, rounds=ROUNDS)
+    report(benchmark)
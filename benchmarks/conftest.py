@@ -0,0 +1,150 @@
+"""
+Fixtures for the firewall benchmarks: a synthetic Hub seeded at scale and an in-memory kernel.
+"""
+
+import random
+import uuid
+
+import pytest
+
+
+SCALES = [100, 1000, 10000]
+BACKENDS = ["iptc", "iptables-restore", "nftables"]
+# the iptc backend commits rule by rule and rereads whole chains as it goes, at 10k it would run for hours
+ITERATIVE_MAX_SCALE = 1000
+
+# extra info of each benchmark, reported at the end of the run
+results = []
+
+
+def seed(scale, rng):
+    """
+    Seeds `scale` Users and Servers, capped by the overlay address space (1023 Users and 2047 Servers), plus
+    scale/10 Groups, Server Groups, Rules and Policies randomly wired together.
+    Objects are bulk created so that no signal touches the firewall while seeding.
+    """
+    from django.contrib.auth.models import Group, User
+    import hub.models
+
+    count = max(scale // 10, 1)
+    user_addresses = hub.models.vpn_ipv4_addresses(for_users=True)[:scale]
+    server_addresses = hub.models.vpn_ipv4_addresses()[:scale]
+
+    User.objects.bulk_create([User(username=f"bench-user-{i}") for i in range(len(user_addresses))])
+    users = list(User.objects.filter(username__startswith="bench-user-").order_by("pk").values_list("pk", flat=True))
+    hub.models.UserProfile.objects.bulk_create([
+        hub.models.UserProfile(user_id=pk, ipv4_address=address, shared=rng.random() < 0.05)
+        for pk, address in zip(users, user_addresses)
+    ])
+    Group.objects.bulk_create([Group(name=f"bench-group-{i}") for i in range(count)])
+    groups = list(Group.objects.filter(name__startswith="bench-group-").values_list("pk", flat=True))
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=user, group_id=group)
+        for user in users for group in rng.sample(groups, min(2, len(groups)))
+    ])
+
+    hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid=str(uuid.UUID(int=rng.getrandbits(128))), fqdn=f"bench-server-{i}.bench", ipv4_address=address)
+        for i, address in enumerate(server_addresses)
+    ])
+    servers = list(hub.models.Server.objects.filter(fqdn__startswith="bench-server-").values_list("pk", flat=True))
+    hub.models.ServerGroup.objects.bulk_create([hub.models.ServerGroup(name=f"bench-servergroup-{i}") for i in range(count)])
+    servergroups = list(hub.models.ServerGroup.objects.filter(name__startswith="bench-servergroup-").values_list("pk", flat=True))
+    hub.models.Server.server_groups.through.objects.bulk_create([
+        hub.models.Server.server_groups.through(server_id=server, servergroup_id=rng.choice(servergroups))
+        for server in servers
+    ])
+
+    Rule = hub.models.Rule
+    protocols = [Rule.TCP, Rule.TCP, Rule.UDP, Rule.ICMP, Rule.ANY]
+    rules = []
+    for i in range(count):
+        protocol = rng.choice(protocols)
+        ports = ""
+        if protocol in [Rule.TCP, Rule.UDP]:
+            ports = ",".join(sorted({str(rng.choice([22, 53, 80, 443, 3306, 5432])), f"{rng.randint(1024, 8000)}-{rng.randint(8001, 9000)}"}))
+        rules.append(Rule(name=f"bench-rule-{i}", destination_protocol=protocol, destination_ports=ports))
+    Rule.objects.bulk_create(rules)
+    rules = list(Rule.objects.filter(name__startswith="bench-rule-").values_list("pk", flat=True))
+    for through, field, pool, size in [
+        (Rule.source_users.through, "user_id", users, 5),
+        (Rule.source_groups.through, "group_id", groups, 1),
+        (Rule.source_servers.through, "server_id", servers, 3),
+        (Rule.source_servergroups.through, "servergroup_id", servergroups, 1),
+    ]:
+        through.objects.bulk_create([
+            through(rule_id=rule, **{field: pk}) for rule in rules for pk in rng.sample(pool, rng.randint(0, min(size, len(pool))))
+        ])
+
+    Policy = hub.models.Policy
+    Policy.objects.bulk_create([Policy(name=f"bench-policy-{i}") for i in range(count)])
+    policies = list(Policy.objects.filter(name__startswith="bench-policy-").values_list("pk", flat=True))
+    for through, field, pool, size in [
+        (Policy.rules.through, "rule_id", rules, 5),
+        (Policy.servers.through, "server_id", servers, 10),
+        (Policy.servergroups.through, "servergroup_id", servergroups, 2),
+    ]:
+        through.objects.bulk_create([
+            through(policy_id=policy, **{field: pk}) for policy in policies for pk in rng.sample(pool, rng.randint(1, min(size, len(pool))))
+        ])
+
+
+@pytest.fixture(params=SCALES, ids=lambda scale: f"scale-{scale}")
+def scale(request, db):
+    "seeds the DB at each scale and returns the scale"
+    seed(request.param, random.Random(request.param))
+    return request.param
+
+
+@pytest.fixture(params=BACKENDS)
+def kernel(request, monkeypatch, tmp_path):
+    "selects each backend and routes its commands to an in-memory kernel, returned"
+    from eapi.settings import EVON_HUB_CONFIG
+    from evon.job_queue import job_queue
+    from hub import firewall
+    from hub.fw import conntrack, memory, shell
+
+    kernel = memory.Kernel()
+    monkeypatch.setitem(EVON_HUB_CONFIG, "FIREWALL_STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(firewall, "backend", request.param)
+    # never touch the conntrack table of the host running the benchmarks
+    monkeypatch.setattr(conntrack, "_sweep", lambda condemned: 0)
+    shell.set_runner(kernel)
+    # the iptc backend queues a job per object, run them in the test's DB transaction
+    workers = job_queue.workers
+    job_queue.set_workers(0)
+    yield kernel
+    job_queue.set_workers(workers)
+    shell.set_runner(None)
+
+
+@pytest.fixture
+def report(request, kernel):
+    "returns a function that records the commits and rules of the last benchmark round"
+
+    def record(benchmark):
+        benchmark.extra_info.update({
+            "commits": sum(kernel.commits.values()),
+            "reads": sum(kernel.reads.values()),
+            "rules": kernel.rule_count(),
+        })
+        results.append((request.node.name, benchmark.stats.stats.mean if benchmark.stats else 0.0, benchmark.extra_info))
+
+    return record
+
+
+def pytest_collection_modifyitems(items):
+    for item in items:
+        params = getattr(item, "callspec", None) and item.callspec.params
+        if params and params.get("kernel") == "iptc" and params.get("scale", 0) > ITERATIVE_MAX_SCALE:
+            item.add_marker(pytest.mark.skip(reason=f"the iptc backend is only benchmarked up to {ITERATIVE_MAX_SCALE} scale"))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not results:
+        return
+    terminalreporter.section("firewall commits per scenario (last round)")
+    for name, mean, info in results:
+        terminalreporter.write_line(
+            f"{name:60s} {mean * 1000:10.1f}ms  {info['commits']:3d} commits  {info['reads']:3d} reads  {info['rules']:7d} rules"
+        )
@@ -63,6 +63,43 @@ INSTALLED_APPS = [
 EVON_HUB_CONFIG = {
     "vpn_mgmt_servers": VPN(unix_socket="/etc/openvpn/evon_mgmt_servers"),
     "vpn_mgmt_users": VPN(unix_socket="/etc/openvpn/evon_mgmt_users"),
+    # firewall backend used by hub.firewall, one of:
+    #   iptc             - insert rules one at a time via python-iptables, as Hubs always have
+    #   iptables-restore - compile chains and commit them in a single iptables-restore transaction
+    #   nftables         - express rules natively in an nftables table and commit them in a single nft transaction
+    # to switch backends, change this setting, restart the Hub and run `eapi fwctl --init`, which removes the
+    # objects of the previous backend. `eapi fwctl --backend` overrides the backend for that invocation only.
+    "FIREWALL_BACKEND": "iptc",
+    # iptables-restore backend only: match Rule sources using one hash:ip ipset per Rule rather than one
+    # iptables rule per source address. The nftables backend always uses native sets.
+    "FIREWALL_IPSET": True,
+    # nftables backend only: offload established TCP and UDP overlay flows to a flowtable spanning these
+    # devices, so their packets bypass the forward chain after the first few. Devices that don't exist when
+    # the firewall is initialised are left out of the flowtable.
+    "FIREWALL_FLOWTABLE": False,
+    "FIREWALL_FLOWTABLE_DEVICES": ["tun0", "tun1"],
+    # directory holding the state of the compiled firewall backends, eg. fingerprints of the last applied
+    # chains used by `eapi fwctl --reconcile` to detect and repair drift
+    "FIREWALL_STATE_DIR": os.path.join(BASE_DIR, ".fwstate"),
+    # submit firewall changes from all processes to the applier daemon (`eapi fwapplier`) listening on this
+    # unix socket, which owns the kernel firewall state. If False or the daemon isn't running, each process
+    # applies its own changes.
+    "FIREWALL_APPLIER": True,
+    "FIREWALL_APPLIER_SOCKET": "/run/evonfw/applier.sock",
+    # seconds to collect repeated changes to the same Rule, Policy or User before applying only the latest, eg.
+    # the post_save and m2m_changed signals fired by a single admin save
+    "FIREWALL_DEBOUNCE_SECONDS": 0.5,
+    # times to retry a failed firewall job, waiting FIREWALL_RETRY_BACKOFF_SECONDS before the first retry and
+    # doubling the wait for each further one. A job that fails every attempt is recorded as a dead letter (see
+    # `eapi fwctl --dead-letters`) and escalated to a rebuild of the chains it touches.
+    "FIREWALL_RETRIES": 3,
+    "FIREWALL_RETRY_BACKOFF_SECONDS": 1,
+    # SQLite journal of queued background jobs. Jobs left unfinished by a dead process, eg. a recycled gunicorn
+    # worker, are replayed when gunicorn starts and on each `eapi fwctl --reconcile`. Set to None to disable.
+    "JOB_JOURNAL": os.path.join(BASE_DIR, ".fwstate", "jobs.sqlite3"),
+    # number of background jobs that may run in parallel. Jobs for the same object run in order and full
+    # firewall operations like init run alone, kernel commits are serialised by hub.fw.applier.
+    "JOB_WORKERS": 4,
     # define blacklist of permissions with content types having specific names
     "EXCLUDED_CONTENT_TYPE_NAMES": [
         'log entry',
@@ -74,6 +111,7 @@ EVON_HUB_CONFIG = {
         'OpenVPN Client',
         'user profile',
         'session',
+        'Firewall State',
     ],
     # define blacklist of permissions having specific names
     "EXCLUDED_PERMISSION_NAMES": [
@@ -0,0 +1,21 @@
+import sys
+
+from eapi.settings import *  # noqa
+from hub.fw import memory
+
+
+# python-iptables must never touch the host's tables, tests run the iptc backend against the in-memory kernel.
+# Installed here as Django imports hub.firewall while setting up, before any test module
+sys.modules["iptc"] = memory.iptc_module()
+
+
+# tests use a throwaway sqlite database rather than the Hub's MySQL database
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+# jobs queued by tests must not be journaled for replay by the Hub
+EVON_HUB_CONFIG["JOB_JOURNAL"] = None  # noqa
@@ -27,6 +27,7 @@ router = routers.DefaultRouter(trailing_slash=False)
 router.register(r'ping', hub.views.PingViewSet, basename="ping")
 router.register(r'bootstrap', hub.views.BootstrapViewSet, basename="bootstrap")
 router.register(r'ovpnclient', hub.views.OVPNClientViewSet, basename="ovpnclient")
+router.register(r'jobqueue', hub.views.JobQueueViewSet, basename="jobqueue")
 
 urlpatterns = [
     re_path(r'^favicon\.ico$', RedirectView.as_view(permanent=False, url='/static/favicon.ico')),
@@ -11,6 +11,11 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from evon.job_queue import job_queue
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "eapi.settings")
 
 application = get_wsgi_application()
+
+# recover firewall jobs lost by workers that died with jobs still queued
+job_queue.replay()
@@ -1,6 +1,14 @@
-from concurrent.futures import ThreadPoolExecutor
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
+import importlib
+import json
+import os
+import pickle
+import queue
+import sqlite3
 import threading
+import time
 import uuid
 
 from evon.log import get_evon_logger  # noqa
@@ -9,14 +17,495 @@ from evon.log import get_evon_logger  # noqa
 logger = get_evon_logger()
 
 
-class SingleWorkerQueue:
+class Journal:
+    """
+    Durable record of queued jobs in a local SQLite database, so that jobs lost with their process (eg. a
+    recycled gunicorn worker) can be replayed by another. Jobs are recorded with the pid that queued them and
+    deleted once finished, any left behind by a dead pid are orphans.
+    Records are written by a background thread so submitting a job never waits on SQLite, at the cost of
+    losing the jobs submitted in the moment before a crash. Reads flush this process's pending writes first.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL with relaxed syncing keeps a record to a local write, off the fsync path
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, pid INTEGER, func TEXT, job_id TEXT, key TEXT, lane TEXT, payload BLOB, created REAL)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS metrics (pid INTEGER PRIMARY KEY, stats TEXT, updated REAL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letters ("
+                "key TEXT PRIMARY KEY, func TEXT, error TEXT, attempts INTEGER, escalated INTEGER, pid INTEGER, failed REAL)"
+            )
+        self._writes = queue.Queue()
+        threading.Thread(target=self._write_loop, name="job-journal", daemon=True).start()
+
+    def _write_loop(self):
+        "executes queued writes in submission order, those queued meanwhile in a single SQLite transaction"
+        while True:
+            writes = [self._writes.get()]
+            while True:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    self._db.execute("BEGIN")
+                    try:
+                        for sql, params in writes:
+                            self._db.execute(sql, params)
+                    except BaseException:
+                        self._db.execute("ROLLBACK")
+                        raise
+                    self._db.execute("COMMIT")
+            except Exception as e:
+                logger.error(f"Failed to write {len(writes)} job journal records: {e}")
+            finally:
+                for _ in writes:
+                    self._writes.task_done()
+
+    def _write(self, sql, params):
+        self._writes.put((sql, params))
+
+    def flush(self):
+        "waits for the pending writes of this process to reach the journal"
+        self._writes.join()
+
+    def add(self, func, args, kwargs, job_id=None, key=None, lane=None):
+        "records a job, returning its journal id or None if it can't be replayed"
+        try:
+            payload = pickle.dumps((args, kwargs))
+        except Exception as e:
+            logger.warning(f"Not journaling job '{job_id or key}', its arguments can't be pickled: {e}")
+            return None
+        # ids are allocated here rather than by SQLite so the insert needn't be waited for
+        journal_id = uuid.uuid4().int >> 65
+        self._write(
+            "INSERT INTO jobs (id, pid, func, job_id, key, lane, payload, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (journal_id, os.getpid(), f"{func.__module__}:{func.__qualname__}", job_id, key, lane, payload, time.time()),
+        )
+        return journal_id
+
+    def update(self, journal_id, args, kwargs):
+        "replaces the arguments of a recorded job"
+        self._write("UPDATE jobs SET payload = ? WHERE id = ?", (pickle.dumps((args, kwargs)), journal_id))
+
+    def done(self, journal_id):
+        self._write("DELETE FROM jobs WHERE id = ?", (journal_id,))
+
+    def publish(self, stats):
+        "stores the job metrics of this process"
+        self._write(
+            "INSERT OR REPLACE INTO metrics (pid, stats, updated) VALUES (?, ?, ?)",
+            (os.getpid(), json.dumps(stats), time.time()),
+        )
+
+    def metrics(self):
+        "returns the job metrics published by live processes, forgetting those of dead ones"
+        self.flush()
+        with self._lock:
+            rows = self._db.execute("SELECT pid, stats FROM metrics").fetchall()
+            for pid, _ in rows:
+                if not _alive(pid):
+                    self._db.execute("DELETE FROM metrics WHERE pid = ?", (pid,))
+            return [json.loads(stats) for pid, stats in rows if _alive(pid)]
+
+    def pending(self):
+        "returns the number of unfinished jobs of all processes and the submission time of the oldest"
+        self.flush()
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*), MIN(created) FROM jobs").fetchone()
+
+    def dead_letter(self, letter):
+        "records dead letter `letter`, see SingleWorkerQueue.dead_letters(), replacing any earlier one for its key"
+        self._write(
+            "INSERT OR REPLACE INTO dead_letters (key, func, error, attempts, escalated, pid, failed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (letter["key"], letter["func"], letter["error"], letter["attempts"], letter["escalated"], letter["pid"], letter["failed"]),
+        )
+
+    def resolve(self, key):
+        "drops the dead letter of job `key`"
+        self._write("DELETE FROM dead_letters WHERE key = ?", (key,))
+
+    def dead_letters(self):
+        self.flush()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, func, error, attempts, escalated, pid, failed FROM dead_letters ORDER BY failed"
+            ).fetchall()
+        return [
+            {"key": key, "func": func, "error": error, "attempts": attempts, "escalated": bool(escalated), "pid": pid, "failed": failed}
+            for key, func, error, attempts, escalated, pid, failed in rows
+        ]
+
+    def claim_orphans(self):
+        "takes ownership of the jobs recorded by dead processes, returning them oldest first"
+        self.flush()
+        with self._lock:
+            rows = self._db.execute("SELECT id, pid, func, job_id, key, lane, payload FROM jobs ORDER BY created, id").fetchall()
+            claimed = []
+            for journal_id, pid, *job in rows:
+                if _alive(pid):
+                    continue
+                # another process may be replaying the same orphans
+                if self._db.execute(
+                    "UPDATE jobs SET pid = ? WHERE id = ? AND pid = ?", (os.getpid(), journal_id, pid)
+                ).rowcount:
+                    claimed.append((journal_id, *job))
+            return claimed
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# upper bounds in seconds of the wait and run time histogram buckets, the last bucket is unbounded
+HISTOGRAM_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+
+def _histogram():
+    return {"buckets": [0] * (len(HISTOGRAM_BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+
+
+def _observe(histogram, seconds):
+    bucket = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if seconds <= bound), len(HISTOGRAM_BUCKETS))
+    histogram["buckets"][bucket] += 1
+    histogram["count"] += 1
+    histogram["sum"] += seconds
+    histogram["max"] = max(histogram["max"], seconds)
+
+
+def percentile(histogram, q):
+    "returns the upper bound of the histogram bucket holding percentile `q`, or None if unbounded or empty"
+    rank = q / 100 * histogram["count"]
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS + [None], histogram["buckets"]):
+        seen += count
+        if count and seen >= rank:
+            return bound
+    return None
+
+
+def merge_stats(stats):
+    "combines the job metrics of several processes, see Metrics.stats()"
+    merged = {"processes": len(stats), "depth": 0, "oldest_pending_seconds": 0.0, "jobs": {}}
+    for process in stats:
+        merged["depth"] += process["depth"]
+        merged["oldest_pending_seconds"] = max(merged["oldest_pending_seconds"], process["oldest_pending_seconds"])
+        for name, job in process["jobs"].items():
+            total = merged["jobs"].setdefault(name, Metrics.job())
+            for field, value in job.items():
+                if field in ["wait", "run"]:
+                    total[field]["buckets"] = [a + b for a, b in zip(total[field]["buckets"], value["buckets"])]
+                    total[field]["count"] += value["count"]
+                    total[field]["sum"] += value["sum"]
+                    total[field]["max"] = max(total[field]["max"], value["max"])
+                elif field == "last_error":
+                    total[field] = value or total[field]
+                else:
+                    total[field] += value
+    return merged
+
+
+class Metrics:
+    """
+    Job counters and wait (queued to started) and run time histograms by job type, ie. function name,
+    for the jobs of one process
+    """
 
     def __init__(self):
-        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-worker')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pending = {}
+
+    @staticmethod
+    def job():
+        return {
+            "submitted": 0, "coalesced": 0, "deduped": 0, "completed": 0, "failed": 0, "retried": 0, "escalated": 0,
+            "last_error": None,
+            "wait": _histogram(), "run": _histogram(),
+        }
+
+    def count(self, name, field):
+        with self._lock:
+            self._jobs.setdefault(name, self.job())[field] += 1
+
+    def submitted(self, name, token):
+        with self._lock:
+            self._jobs.setdefault(name, self.job())["submitted"] += 1
+            self._pending[token] = time.monotonic()
+
+    def started(self, name, token):
+        "records the wait of job `token`, returning its start time"
+        now = time.monotonic()
+        with self._lock:
+            _observe(self._jobs[name]["wait"], now - self._pending[token])
+        return now
+
+    def finished(self, name, token, started, error=None):
+        with self._lock:
+            job = self._jobs[name]
+            _observe(job["run"], time.monotonic() - started)
+            del self._pending[token]
+            if error:
+                job["failed"] += 1
+                job["last_error"] = str(error)
+            else:
+                job["completed"] += 1
+
+    def stats(self):
+        "returns the number of unfinished jobs, the age of the oldest and the metrics of each job type"
+        with self._lock:
+            oldest = min(self._pending.values(), default=None)
+            return {
+                "pid": os.getpid(),
+                "depth": len(self._pending),
+                "oldest_pending_seconds": time.monotonic() - oldest if oldest else 0.0,
+                "jobs": json.loads(json.dumps(self._jobs)),
+            }
+
+
+class SingleWorkerQueue:
+    """
+    Runs jobs in worker threads with strict ordering per lane. Jobs in the same lane, eg. all work for one
+    user, run one at a time in submission order while jobs in other lanes run in parallel. Jobs without a
+    lane are barriers: they wait for all earlier jobs to finish and run alone, so full-table operations like
+    firewall.init never overlap other work. With one worker, all jobs run serially in submission order.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
         self._pending_jobs = set()
+        self._keyed_jobs = {}
+        self._timers = {}
+        self._failures = {}
+        self._dead_letters = {}
         self._lock = threading.Lock()
+        self._scheduled = []
+        self._running_lanes = set()
+        self._running = 0
+        self._schedule_lock = threading.Lock()
+        self.journal = None
+        self.metrics = Metrics()
+
+    def set_workers(self, workers):
+        """
+        Sets the number of jobs that may run in parallel, call before any jobs are submitted. With 0 workers jobs
+        run in the submitting thread as they are submitted, without delay, eg. for tests and benchmarks whose
+        DB transaction worker threads can't see.
+        """
+        self._executor.shutdown(wait=False)
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers or 1, thread_name_prefix='job-worker')
+
+    def _schedule(self, func, lane=None):
+        "runs `func` after the earlier jobs of its lane, or of all lanes if `lane` is None, returning a Future"
+        future = Future()
+        if not self.workers:
+            self._call(func, future)
+            return future
+        with self._schedule_lock:
+            self._scheduled.append((lane, func, future))
+            self._dispatch()
+        return future
 
-    def submit_job(self, func, *args, job_id=None, **kwargs):
+    def _dispatch(self):
+        "starts every scheduled job that no earlier or running job holds back, with the schedule lock held"
+        held = set(self._running_lanes)
+        for job in list(self._scheduled):
+            lane = job[0]
+            if lane is None:
+                # a barrier starts once everything before it has finished, and holds back everything after it
+                if not self._running and job is self._scheduled[0]:
+                    self._start(job)
+                break
+            if None in self._running_lanes:
+                break
+            if lane not in held:
+                self._start(job)
+            held.add(lane)
+
+    def _start(self, job):
+        self._scheduled.remove(job)
+        self._running_lanes.add(job[0])
+        self._running += 1
+        self._executor.submit(self._run, *job)
+
+    def _release(self, key, func, lane):
+        "queues keyed job `key` once its debounce delay is over, unless drain() already has"
+        with self._lock:
+            if not self._timers.pop(key, None):
+                return
+        self._schedule(func, lane)
+
+    def drain(self):
+        """
+        Queues the keyed jobs waiting out their delay at once and waits for all jobs to finish and be journaled as
+        done, so that a process doesn't exit with debounced submissions lost. Runs at interpreter exit for the
+        global queue.
+        """
+        while True:
+            with self._lock:
+                timers, self._timers = self._timers, {}
+            for timer, func, lane in timers.values():
+                timer.cancel()
+                self._schedule(func, lane)
+            # a barrier runs once all earlier jobs have finished
+            self._schedule(lambda: None).result()
+            with self._lock:
+                # failed jobs may have been resubmitted with a delay for a retry
+                if self._timers:
+                    continue
+            if self.journal:
+                self.journal.flush()
+            return
+
+    @staticmethod
+    def _call(func, future):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+
+    def _run(self, lane, func, future):
+        try:
+            self._call(func, future)
+        finally:
+            with self._schedule_lock:
+                self._running_lanes.discard(lane)
+                self._running -= 1
+                self._dispatch()
+
+    def enable_journal(self, path):
+        "records queued jobs in a Journal at `path` until they finish, see replay()"
+        self.journal = Journal(path)
+
+    def replay(self):
+        """
+        Queues the journaled jobs of dead processes, returning the number replayed. Replayed jobs must be
+        idempotent, as a job that was interrupted mid-run is run again from the start.
+        """
+        if not self.journal:
+            return 0
+        orphans = self.journal.claim_orphans()
+        for journal_id, func, job_id, key, lane, payload in orphans:
+            try:
+                module, _, name = func.partition(":")
+                target = importlib.import_module(module)
+                for attr in name.split("."):
+                    target = getattr(target, attr)
+                # decorated jobs are looked up by name as their wrapper
+                target = getattr(target, "__wrapped__", target)
+                args, kwargs = pickle.loads(payload)
+            except Exception as e:
+                logger.error(f"Can't replay journaled job '{job_id or key or func}': {e}")
+                self.journal.done(journal_id)
+                continue
+            logger.warning(f"Replaying job '{job_id or key or func}' orphaned by a dead process")
+            # replayed jobs are journaled afresh before their orphaned record is dropped, and not debounced
+            # as they have waited long enough
+            if key:
+                self.submit_keyed_job(target, *args, key=key, lane=lane, **kwargs)
+            else:
+                self.submit_job(target, *args, job_id=job_id, lane=lane, **kwargs)
+            self.journal.done(journal_id)
+        return len(orphans)
+
+    def stats(self):
+        """
+        Returns the job metrics of all processes sharing the journal, or of this process if there is no
+        journal. Unfinished jobs are counted from the journal as other processes only publish their metrics
+        when a job finishes.
+        """
+        if not self.journal:
+            return merge_stats([self.metrics.stats()])
+        local = self.metrics.stats()
+        stats = merge_stats([s for s in self.journal.metrics() if s["pid"] != local["pid"]] + [local])
+        depth, oldest = self.journal.pending()
+        stats["depth"] = max(stats["depth"], depth)
+        if oldest:
+            stats["oldest_pending_seconds"] = max(stats["oldest_pending_seconds"], time.time() - oldest)
+        return stats
+
+    def dead_letters(self):
+        """
+        Returns the keyed jobs of all processes sharing the journal, or of this process if there is no journal,
+        that failed on every attempt and haven't succeeded since, oldest failure first. A job's dead letter is
+        dropped when it next succeeds, or when the job its failure was escalated to succeeds.
+        """
+        if self.journal:
+            return self.journal.dead_letters()
+        with self._lock:
+            return sorted(self._dead_letters.values(), key=lambda letter: letter["failed"])
+
+    def _resolve(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            letter = self._dead_letters.pop(key, None)
+        if self.journal:
+            self.journal.resolve(key)
+        if letter:
+            logger.info(f"Resolved dead letter of job '{key}'")
+
+    def _failed(self, func, args, kwargs, key, lane, retries, backoff, escalate, error):
+        "retries keyed job `key` after `error` with exponential backoff, or dead-letters and escalates it"
+        with self._lock:
+            attempts = self._failures[key] = self._failures.get(key, 0) + 1
+            pending = key in self._keyed_jobs
+        if attempts <= retries and pending:
+            # a newer submission is waiting to run, retrying would replace its arguments with stale ones
+            logger.info(f"Job '{key}' will be retried by its pending submission")
+            return
+        if attempts <= retries:
+            delay = backoff * 2 ** (attempts - 1)
+            logger.warning(f"Retrying job '{key}' in {delay}s, attempt {attempts + 1} of {retries + 1}")
+            self.metrics.count(func.__name__, "retried")
+            self.submit_keyed_job(
+                func, *args, key=key, delay=delay, lane=lane, retries=retries, backoff=backoff, escalate=escalate, **kwargs
+            )
+            return
+        letter = {
+            "key": key, "func": func.__name__, "error": str(error), "attempts": attempts, "escalated": bool(escalate),
+            "pid": os.getpid(), "failed": time.time(),
+        }
+        with self._lock:
+            del self._failures[key]
+            self._dead_letters[key] = letter
+        if self.journal:
+            self.journal.dead_letter(letter)
+        logger.error(f"Job '{key}' failed {attempts} times, recorded as a dead letter")
+        if not escalate:
+            return
+        self.metrics.count(func.__name__, "escalated")
+        try:
+            future = escalate(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Failed to escalate job '{key}': {e}")
+            return
+        if isinstance(future, Future):
+            future.add_done_callback(lambda f: None if f.cancelled() or f.exception() else self._resolve(key))
+
+    def _finished(self, name, token, started, error=None):
+        self.metrics.finished(name, token, started, error)
+        if self.journal:
+            self.journal.publish(self.metrics.stats())
+
+    def submit_job(self, func, *args, job_id=None, lane=None, **kwargs):
         """
         Submit a job to the queue.
 
@@ -24,6 +513,7 @@ class SingleWorkerQueue:
             func: Function to execute
             *args, **kwargs: Arguments for the function
             job_id: If provided, enables deduplication. If None, always runs.
+            lane: Lane of the job, see SingleWorkerQueue. If None, the job is a barrier.
         """
         # Generate unique ID if no job_id provided (no deduplication)
         if job_id is None:
@@ -35,10 +525,15 @@ class SingleWorkerQueue:
             with self._lock:
                 if job_id in self._pending_jobs:
                     logger.info(f"Job '{job_id}' already pending, skipping")
+                    self.metrics.count(func.__name__, "deduped")
                     return None
                 self._pending_jobs.add(job_id)
+        journal_id = self.journal.add(func, args, kwargs, job_id=job_id if dedupe else None, lane=lane) if self.journal else None
+        token = object()
+        self.metrics.submitted(func.__name__, token)
 
         def wrapped_job():
+            started, error = self.metrics.started(func.__name__, token), None
             try:
                 logger.info(f"Starting job '{job_id}'")
                 if dedupe:
@@ -49,11 +544,101 @@ class SingleWorkerQueue:
                 return result
             except Exception as e:
                 logger.error(f"Job '{job_id}' failed: {e}")
+                error = e
                 raise
+            finally:
+                if journal_id:
+                    self.journal.done(journal_id)
+                self._finished(func.__name__, token, started, error)
 
-        future = self._executor.submit(wrapped_job)
+        future = self._schedule(wrapped_job, lane)
         return future
 
+    def submit_keyed_job(self, func, *args, key, delay=0, lane=None, retries=0, backoff=1, escalate=None, **kwargs):
+        """
+        Submit a job with latest-wins semantics.
+
+        Args:
+            func: Function to execute
+            *args, **kwargs: Arguments for the function
+            key: Jobs submitted with the same key before the pending one starts are coalesced into it, and it
+                runs with the arguments of the latest submission
+            delay: Seconds to wait after the first submission before queuing the job, collecting further
+                submissions with the same key
+            lane: Lane of the job, see SingleWorkerQueue. Defaults to `key`.
+            retries: Times to resubmit the job if it fails, waiting `backoff` seconds before the first retry and
+                doubling the wait for each further one
+            escalate: Called with the job's arguments once it has failed on every attempt, eg. to queue a more
+                thorough job. If it returns a Future that succeeds, the job's dead letter is dropped.
+
+        Returns a Future shared by all coalesced submissions, which fails with the first failed attempt.
+        """
+        with self._lock:
+            job = self._keyed_jobs.get(key)
+            coalesced = job is not None
+            if coalesced:
+                job["args"], job["kwargs"] = args, kwargs
+                job["count"] += 1
+                self.metrics.count(func.__name__, "coalesced")
+            else:
+                job = {
+                    "args": args, "kwargs": kwargs, "count": 1, "future": Future(), "journal_id": None,
+                    "journal_lock": threading.Lock(), "token": object(),
+                }
+                self.metrics.submitted(func.__name__, job["token"])
+                self._keyed_jobs[key] = job
+                # held until the job is journaled, so coalesced submissions don't journal ahead of it
+                job["journal_lock"].acquire()
+        if coalesced:
+            if self.journal:
+                with job["journal_lock"]:
+                    # written outside the queue lock, so record the latest arguments rather than these
+                    with self._lock:
+                        args, kwargs = job["args"], job["kwargs"]
+                    if job["journal_id"]:
+                        self.journal.update(job["journal_id"], args, kwargs)
+            return job["future"]
+        try:
+            if self.journal:
+                job["journal_id"] = self.journal.add(func, args, kwargs, key=key, lane=lane)
+        finally:
+            job["journal_lock"].release()
+
+        def wrapped_job():
+            with self._lock:
+                del self._keyed_jobs[key]
+            if job["count"] > 1:
+                logger.info(f"Coalesced {job['count']} submissions of job '{key}'")
+            started, error = self.metrics.started(func.__name__, job["token"]), None
+            try:
+                if not job["future"].set_running_or_notify_cancel():
+                    return
+                logger.info(f"Starting job '{key}'")
+                job["future"].set_result(func(*job["args"], **job["kwargs"]))
+                logger.info(f"Completed job '{key}'")
+            except Exception as e:
+                logger.error(f"Job '{key}' failed: {e}")
+                job["future"].set_exception(e)
+                error = e
+            finally:
+                if job["journal_id"]:
+                    self.journal.done(job["journal_id"])
+                self._finished(func.__name__, job["token"], started, error)
+            if error:
+                self._failed(func, job["args"], job["kwargs"], key, lane, retries, backoff, escalate, error)
+            elif not job["future"].cancelled():
+                self._resolve(key)
+
+        if delay and self.workers:
+            timer = threading.Timer(delay, self._release, args=[key, wrapped_job, lane or key])
+            timer.daemon = True
+            with self._lock:
+                self._timers[key] = (timer, wrapped_job, lane or key)
+            timer.start()
+        else:
+            self._schedule(wrapped_job, lane or key)
+        return job["future"]
+
     def dedupe_job(self, job_id):
         """Decorator for automatic job queuing with deduplication"""
         def decorator(func):
@@ -70,16 +655,34 @@ class SingleWorkerQueue:
             return self.submit_job(func, *args, **kwargs)  # No job_id = no deduplication
         return wrapper
 
+    def keyed_job(self, key, delay=0, lane=None, retries=0, backoff=1, escalate=None):
+        """
+        Decorator for latest-wins job queuing, `key` and `lane` are called with the job's arguments to get its
+        key and lane
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return self.submit_keyed_job(
+                    func, *args, key=key(*args, **kwargs), delay=delay,
+                    lane=lane(*args, **kwargs) if lane else None,
+                    retries=retries, backoff=backoff, escalate=escalate, **kwargs
+                )
+            return wrapper
+        return decorator
+
 
 # Global instance
 job_queue = SingleWorkerQueue()
+# run before the executors stop accepting jobs at exit, which happens ahead of atexit handlers where supported
+getattr(threading, "_register_atexit", atexit.register)(job_queue.drain)
 
 
 # Convenience functions
-def queue_job(func, *args, job_id=None, **kwargs):
+def queue_job(func, *args, job_id=None, lane=None, **kwargs):
     """
     Queue a job. Provide job_id for deduplication, omit for always-run.
-    Jobs are run sequentially. Examples:
+    Jobs without a lane are run sequentially, see SingleWorkerQueue. Examples:
 
     # Deduped jobs (provide job_id)
     queue_job(firewall.init, job_id='firewall-init')  # Will add to queue
@@ -89,7 +692,7 @@ def queue_job(func, *args, job_id=None, **kwargs):
     queue_job(firewall.apply_rule, rule1)  # will add to queue
     queue_job(firewall.apply_rule, rule2)  # will also add to queue, both will run sequentially
     """
-    return job_queue.submit_job(func, *args, job_id=job_id, **kwargs)
+    return job_queue.submit_job(func, *args, job_id=job_id, lane=lane, **kwargs)
 
 
 def dedupe_job(job_id):
@@ -97,6 +700,11 @@ def dedupe_job(job_id):
     return job_queue.dedupe_job(job_id)
 
 
+def keyed_job(key, delay=0, lane=None, retries=0, backoff=1, escalate=None):
+    """Decorator for latest-wins jobs, coalesced by key within `delay` seconds and retried `retries` times"""
+    return job_queue.keyed_job(key, delay, lane, retries, backoff, escalate)
+
+
 def async_job(func):
     """Decorator for non-deduped async jobs"""
     return job_queue.async_job(func)
@@ -57,5 +57,5 @@ os.system(f"echo {ccd_config} > {ccd_file}")
 logger.info(f"Wrote CCD file '{ccd_file}' with content: {ccd_config}")
 
 server.connected = True
-server.save()
+server.save(update_fields=Server.connection_fields)
 logger.info(f"set connected=True for {server.fqdn} with UUID {cn}")
@@ -29,5 +29,5 @@ if not server:
     sys.exit(1)
 
 server.connected = False
-server.save()
+server.save(update_fields=Server.connection_fields)
 logger.info(f"set connected=False for {server.fqdn} with UUID {cn}")
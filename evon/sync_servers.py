@@ -47,14 +47,14 @@ def do_sync():
             if not server.connected:
                 logger.info(f"toggling connected to True for server {server.fqdn}")
                 server.connected = True
-                server.save()
+                server.save(update_fields=Server.connection_fields)
             else:
                 logger.debug(f"leaving connected as True for server {server.fqdn}")
         else:
             if server.connected:
                 logger.info(f"toggling connected to False for server {server.fqdn}")
                 server.connected = False
-                server.save()
+                server.save(update_fields=Server.connection_fields)
             else:
                 logger.debug(f"leaving connected as False for server {server.fqdn}")
 
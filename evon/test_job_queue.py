@@ -0,0 +1,164 @@
+import os
+import threading
+
+from evon import job_queue
+from evon.job_queue import SingleWorkerQueue
+
+
+def test_keyed_jobs_coalesce_to_the_latest_arguments():
+    queue = SingleWorkerQueue()
+    calls = []
+    futures = [queue.submit_keyed_job(calls.append, n, key="rule:1", delay=0.1) for n in range(3)]
+    assert all(future is futures[0] for future in futures)
+    futures[0].result(5)
+    assert calls == [2]
+
+
+def test_drain_runs_debounced_jobs():
+    queue = SingleWorkerQueue()
+    calls = []
+    queue.submit_keyed_job(calls.append, 1, key="rule:1", delay=60)
+    queue.drain()
+    assert calls == [1]
+
+
+def test_no_workers_runs_jobs_inline():
+    queue = SingleWorkerQueue()
+    queue.set_workers(0)
+    calls = []
+    queue.submit_keyed_job(calls.append, 1, key="rule:1", delay=60)
+    queue.submit_job(calls.append, 2)
+    assert calls == [1, 2]
+
+
+replayed = []
+
+
+def replay_target(n):
+    replayed.append(n)
+
+
+def test_replay_runs_the_journaled_jobs_of_dead_processes(tmp_path, monkeypatch):
+    crashed = SingleWorkerQueue()
+    crashed.enable_journal(str(tmp_path / "jobs.sqlite3"))
+    crashed.submit_keyed_job(replay_target, 1, key="rule:1", delay=60)
+    crashed.submit_keyed_job(replay_target, 2, key="rule:1", delay=60)
+    crashed.journal.add(replay_target, (3,), {}, job_id="init")
+    # the process dies before its jobs run, once their records are written
+    crashed.journal.flush()
+    for timer, _, _ in crashed._timers.values():
+        timer.cancel()
+    monkeypatch.setattr(job_queue, "_alive", lambda pid: pid != os.getpid())
+
+    restarted = SingleWorkerQueue()
+    restarted.enable_journal(str(tmp_path / "jobs.sqlite3"))
+    assert restarted.replay() == 2
+    restarted.drain()
+    assert replayed == [2, 3]
+    assert restarted.journal.pending()[0] == 0
+
+
+def test_journal_writes_dont_hold_up_submissions(tmp_path):
+    queue = SingleWorkerQueue()
+    queue.enable_journal(str(tmp_path / "jobs.sqlite3"))
+    # eg. while another process holds the SQLite write lock
+    with queue.journal._lock:
+        future = queue.submit_keyed_job(len, [], key="rule:1", delay=60)
+        queue.submit_keyed_job(len, [1], key="rule:1", delay=60)
+    queue.drain()
+    assert future.result() == 1
+    assert queue.journal.pending()[0] == 0
+
+
+def test_metrics_count_jobs_by_function():
+    queue = SingleWorkerQueue()
+    gate = threading.Event()
+    queue.submit_job(gate.wait, 5)
+    queue.submit_job(len, [], job_id="init")
+    queue.submit_job(len, [], job_id="init")
+    queue.submit_keyed_job(len, [], key="rule:1", delay=60)
+    queue.submit_keyed_job(len, [1], key="rule:1", delay=60)
+    queue.submit_job(int, "not a number")
+    assert queue.stats()["depth"] == 4
+    gate.set()
+    queue.drain()
+
+    stats = queue.stats()
+    assert (stats["processes"], stats["depth"], stats["oldest_pending_seconds"]) == (1, 0, 0.0)
+    lengths = stats["jobs"]["len"]
+    assert [lengths[field] for field in ["submitted", "coalesced", "deduped", "completed", "failed"]] == [2, 1, 1, 2, 0]
+    assert lengths["wait"]["count"] == lengths["run"]["count"] == 2
+    assert stats["jobs"]["int"]["failed"] == 1
+    assert "invalid literal" in stats["jobs"]["int"]["last_error"]
+
+
+def test_percentile_and_merged_stats():
+    histogram = job_queue._histogram()
+    for seconds in [0.001, 0.002, 0.3, 700]:
+        job_queue._observe(histogram, seconds)
+    assert job_queue.percentile(histogram, 50) == 0.01
+    assert job_queue.percentile(histogram, 75) == 0.5
+    assert job_queue.percentile(histogram, 100) is None
+
+    init = dict(job_queue.Metrics.job(), completed=1, wait=histogram)
+    process = {"pid": 1, "depth": 2, "oldest_pending_seconds": 3.0, "jobs": {"init": init}}
+    merged = job_queue.merge_stats([process, dict(process, pid=2, oldest_pending_seconds=5.0)])
+    assert (merged["processes"], merged["depth"], merged["oldest_pending_seconds"]) == (2, 4, 5.0)
+    assert merged["jobs"]["init"]["completed"] == 2
+    assert merged["jobs"]["init"]["wait"]["count"] == 8
+    assert merged["jobs"]["init"]["wait"]["max"] == 700
+
+
+def test_lanes_run_in_order_and_barriers_alone():
+    queue = SingleWorkerQueue(workers=4)
+    order = []
+    gate = threading.Event()
+
+    def job(name, wait=False):
+        if wait:
+            gate.wait(5)
+        order.append(name)
+
+    queue.submit_job(job, "a1", True, lane="a")
+    queue.submit_job(job, "a2", lane="a")
+    queue.submit_job(job, "b1", lane="b").result(5)
+    # a1 holds back its lane, but not lane b
+    assert order == ["b1"]
+    barrier = queue.submit_job(job, "barrier")
+    last = queue.submit_job(job, "b2", lane="b")
+    gate.set()
+    barrier.result(5)
+    last.result(5)
+    assert order == ["b1", "a1", "a2", "barrier", "b2"]
+
+
+def test_deduped_job_is_queued_once():
+    queue = SingleWorkerQueue()
+    gate = threading.Event()
+    queue.submit_job(gate.wait, 5)
+    first = queue.submit_job(len, [], job_id="init")
+    assert queue.submit_job(len, [], job_id="init") is None
+    gate.set()
+    assert first.result(5) == 0
+
+
+def test_failed_keyed_job_is_retried_then_dead_lettered_and_escalated():
+    queue = SingleWorkerQueue()
+    attempts = []
+    escalated = []
+
+    def apply_rule(pk):
+        attempts.append(pk)
+        raise RuntimeError("xtables lock")
+
+    queue.submit_keyed_job(apply_rule, 7, key="rule:7", retries=2, backoff=0.01, escalate=escalated.append)
+    queue.drain()
+    assert attempts == [7, 7, 7]
+    assert escalated == [7]
+    [letter] = queue.dead_letters()
+    assert (letter["key"], letter["attempts"], letter["escalated"]) == ("rule:7", 3, True)
+
+    # the next success drops the dead letter
+    queue.submit_keyed_job(len, [], key="rule:7")
+    queue.drain()
+    assert queue.dead_letters() == []
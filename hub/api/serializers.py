@@ -173,6 +173,10 @@ class BootstrapSerializer(serializers.Serializer):
     pass
 
 
+class JobQueueSerializer(serializers.Serializer):
+    pass
+
+
 class OVPNClientSerializer(serializers.Serializer):
     pass
 
@@ -9,6 +9,11 @@ class HubConfig(AppConfig):
 
     def ready(self):
         from . import signals
+        from eapi.settings import EVON_HUB_CONFIG
+        from evon.job_queue import job_queue
+        job_queue.set_workers(EVON_HUB_CONFIG["JOB_WORKERS"])
+        if EVON_HUB_CONFIG["JOB_JOURNAL"]:
+            job_queue.enable_journal(EVON_HUB_CONFIG["JOB_JOURNAL"])
 
 
 # Example of renaming of 3rd party app in Django Admin
@@ -0,0 +1,39 @@
+import pytest
+
+
+@pytest.fixture
+def kernel(monkeypatch, tmp_path):
+    "routes firewall commands to an in-memory kernel, returned, and keeps drift state in a temporary directory"
+    from eapi.settings import EVON_HUB_CONFIG
+    from hub.fw import conntrack, memory, shell
+
+    kernel = memory.Kernel()
+    monkeypatch.setitem(EVON_HUB_CONFIG, "FIREWALL_STATE_DIR", str(tmp_path))
+    # never touch the conntrack table of the host running the tests
+    monkeypatch.setattr(conntrack, "_sweep", lambda condemned: 0)
+    shell.set_runner(kernel)
+    yield kernel
+    shell.set_runner(None)
+
+
+@pytest.fixture
+def data():
+    "returns compile data for the full scope as compiler.load() would: two Rules, a Policy and a shared User"
+    from hub.fw import compiler
+
+    return {
+        "scope": compiler.FULL_SCOPE,
+        "rules": {
+            1: {
+                "protocol": "tcp", "ports": ["22", "8000:9000"], "definition": frozenset({"user:1", "user:2"}),
+                "sources": {"100.111.208.6", "100.111.208.10"}, "ranges": [],
+            },
+            2: {
+                "protocol": "all", "ports": [], "definition": frozenset({"group:1"}),
+                "sources": set(), "ranges": ["100.111.208.0/20"],
+            },
+        },
+        "retained_sources": set(),
+        "policies": {1: {"rules": {1, 2}, "targets": {"100.111.224.6", "100.111.224.10"}, "ranges": set()}},
+        "users": {3: "100.111.208.14"},
+    }
@@ -1,3 +1,7 @@
 
 class OutOfAddresses(Exception):
     pass
+
+
+class FirewallError(Exception):
+    pass
@@ -1,28 +1,118 @@
+from functools import wraps
 from itertools import chain
 import uuid
-import subprocess
 
 import iptc
 
 from eapi.settings import EVON_HUB_CONFIG
 from eapi.settings import EVON_VARS
 from evon.log import get_evon_logger
-from evon.job_queue import dedupe_job, async_job
+from evon.job_queue import dedupe_job, keyed_job
+from hub.fw import applier, compiler, conntrack, nft, restore
 import hub.models
 
 
 logger = get_evon_logger()
+ENGINES = {engine.NAME: engine for engine in [restore, nft]}
+BACKENDS = ["iptc", *ENGINES]
+backend = EVON_HUB_CONFIG["FIREWALL_BACKEND"]
+debounce = EVON_HUB_CONFIG["FIREWALL_DEBOUNCE_SECONDS"]
+retries = EVON_HUB_CONFIG["FIREWALL_RETRIES"]
+backoff = EVON_HUB_CONFIG["FIREWALL_RETRY_BACKOFF_SECONDS"]
 
 
-@async_job
+def set_backend(name):
+    """
+    Selects the firewall backend used by this process, overriding EVON_HUB_CONFIG["FIREWALL_BACKEND"].
+    Other processes keep using the configured backend, to switch backends change FIREWALL_BACKEND, restart the
+    Hub and run `eapi fwctl --init`, which removes the objects of the previous backend.
+    """
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f"unknown firewall backend '{name}', must be one of: {', '.join(BACKENDS)}")
+    backend = name
+
+
+def get_engine():
+    """
+    Returns the compiled firewall engine for the selected backend, or None if using the iptc backend
+    """
+    return ENGINES.get(backend)
+
+
+def user_key(pk):
+    "returns the intent key for the shared device rule of the User with primary key `pk`, see apply_scope()"
+    return f"user:{pk}"
+
+
+def policy_key(pk):
+    "returns the intent key for the Policy with primary key `pk`, see apply_scope()"
+    return f"policy:{pk}"
+
+
+def _intent_pks(scope, prefix):
+    return sorted(int(key.split(":", 1)[1]) for key in scope if key.startswith(f"{prefix}:"))
+
+
+def engine_scope(scope):
+    """
+    Returns the compiler scope of intent `scope`. The compiled engines rebuild the evon-user and evon-policy
+    chains as a whole, so single User and Policy keys map to compiler.USERS and compiler.POLICIES.
+    """
+    compiled = {key for key in scope if not key.startswith(("user:", "policy:"))}
+    if _intent_pks(scope, "user"):
+        compiled.add(compiler.USERS)
+    if _intent_pks(scope, "policy"):
+        compiled.add(compiler.POLICIES)
+    return compiled
+
+
+def iptc_committed(func):
+    """
+    Runs `func` under the applier commit lock when using the iptc backend, as jobs in different lanes run in
+    parallel and libiptc commits must not interleave. The compiled engines take the lock in hub.fw.applier.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if get_engine():
+            return func(*args, **kwargs)
+        with applier.commit_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def current(instance):
+    """
+    Returns `instance` as it is now in the DB, or None if it has been deleted. Debounced jobs run with the
+    instance they were queued with, and must not recreate the iptables objects of one deleted in the meantime
+    by a job in another lane.
+    """
+    current = type(instance)._default_manager.filter(pk=instance.pk).first()
+    if current is None:
+        logger.info(f"Skipping firewall update for deleted {type(instance).__name__} {instance.pk}")
+    return current
+
+
+@keyed_job(
+    lambda rule: f"apply-rule-{rule.pk}", delay=debounce, retries=retries, backoff=backoff,
+    escalate=lambda rule: rebuild({compiler.rule_key(rule.pk)}),
+)
+@iptc_committed
 def apply_rule(rule):
     """
     Takes a hub.models.Rule instance and creates an iptables chain with rules reflecting the object properties
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.rule_key(rule.pk)])
+        return
+    rule = current(rule)
+    if rule is None:
+        return
 
     # collect properties
     destination_protocol = rule.destination_protocol.lower()
-    destination_ports = [p.replace("-", ":") for p in rule.destination_ports.split(",") if p]
+    destination_ports = compiler.pack_ports(compiler.merge_ports(p for p in rule.destination_ports.split(",") if p))
     chain_name = rule.get_chain_name()
     source_objects = \
         list(
@@ -52,13 +142,17 @@ def apply_rule(rule):
     # create rules and apply them to chain
     for source_ipv4_address in source_ipv4_addresses:
         if destination_ports:
-            # we're a tcp or udp packet, thus create one rule per portspec
-            for portspec in destination_ports:
+            # we're a tcp or udp packet, thus create one rule per multiport pack of portspecs
+            for portspecs in destination_ports:
                 rule = iptc.Rule()
                 rule.protocol = destination_protocol
                 rule.src = source_ipv4_address
-                match = rule.create_match(destination_protocol)
-                match.dport = portspec
+                if len(portspecs) == 1:
+                    match = rule.create_match(destination_protocol)
+                    match.dport = portspecs[0]
+                else:
+                    match = rule.create_match("multiport")
+                    match.dports = ",".join(portspecs)
                 rule.target = iptc.Target(rule, "ACCEPT")
                 iptc_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), chain_name)
                 iptc_chain.insert_rule(rule)
@@ -73,11 +167,23 @@ def apply_rule(rule):
             iptc_chain.insert_rule(rule)
 
 
-@async_job
+@keyed_job(
+    lambda policy: f"apply-policy-{policy.pk}", delay=debounce, retries=retries, backoff=backoff,
+    escalate=lambda policy: rebuild({compiler.POLICIES}),
+)
+@iptc_committed
 def apply_policy(policy):
     """
     Takes a hub.models.Policy instance and creates iptables rules in the evon-policy chain reflecting the object properties
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.POLICIES])
+        return
+    policy = current(policy)
+    if policy is None:
+        return
+
     target_objects = \
         list(
             set(
@@ -129,18 +235,44 @@ def delete_user(user):
     """
     Takes a hub.models.User instance and deletes iptables rules in the evon-user chain
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.USERS])
+        return
     rule_comment = f"evon-user-{user.pk}"
     delete_iptrules_by_comment("evon-user", rule_comment, delete_conntrack_entry=True)
 
 
+@keyed_job(lambda user: f"revoke-user-{user.pk}", lane=lambda user: f"user-{user.pk}")
+def revoke_user(user):
+    """
+    Takes a hub.models.User instance and flushes the conntrack entries of all flows to and from its device,
+    eg. after the user is deactivated
+    """
+    address = user.userprofile.ipv4_address
+    if address:
+        applier.call("flush", flows=[conntrack.Flow(src=address), conntrack.Flow(dst=address)])
+
+
+@keyed_job(
+    lambda user: f"apply-user-{user.pk}", delay=debounce, lane=lambda user: f"user-{user.pk}", retries=retries,
+    backoff=backoff, escalate=lambda user: rebuild({compiler.USERS}),
+)
+@iptc_committed
 def apply_user(user):
     """
     Takes a hub.models.User instance and creates iptables rules in the evon-user chain if the user has shared their device
     """
     logger.info(f"Triggered firewall.apply_user() for user '{user}' with shared={user.userprofile.shared}")
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.USERS])
+        return
     # delete iptrule first, then recreate if required
+    rule_comment = f"evon-user-{user.pk}"
     delete_user(user)
-    if user.is_active and user.userprofile.shared:
+    user = current(user)
+    if user and user.is_active and user.userprofile.shared:
         logger.info(f"Adding user '{user}' with address '{user.userprofile.ipv4_address}' to shared pool.")
 
         ##### iptc bugfix workaround
@@ -177,80 +309,214 @@ def apply_user(user):
         ipt_chain.insert_rule(rule)
 
 
+@keyed_job(
+    lambda scope: f"apply-scope-{','.join(sorted(scope))}", delay=debounce, retries=retries, backoff=backoff,
+    escalate=lambda scope: rebuild(scope),
+)
+@iptc_committed
+def apply_scope(scope):
+    """
+    Rebuilds the firewall objects named by intent `scope`, eg. the intents collected from a DB transaction by
+    hub.signals. Besides compiler scope keys, `scope` may name single Users and Policies, see user_key() and
+    policy_key(). The compiled engines apply it in a single kernel transaction, with the iptc backend only the
+    named objects are rebuilt and whole chains only for the compiler.RULES, POLICIES and USERS keys.
+    """
+    if not scope:
+        return
+    logger.info(f"Triggered firewall.apply_scope() for {', '.join(sorted(scope))}")
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=sorted(engine_scope(scope)))
+        return
+    if compiler.MAIN in scope:
+        init.__wrapped__(full=False)
+    rule_pks = _intent_pks(scope, "rule")
+    rules = {rule.pk: rule for rule in hub.models.Rule.objects.filter(pk__in=rule_pks)}
+    for pk in rule_pks:
+        if pk in rules:
+            apply_rule.__wrapped__(rules[pk])
+        else:
+            # the Rule was deleted
+            delete_chain(f"{hub.models.Rule.chain_name_prefix}{pk}")
+            conntrack.revoke_unpermitted()
+    if compiler.POLICIES not in scope:
+        policy_pks = _intent_pks(scope, "policy")
+        policies = {policy.pk: policy for policy in hub.models.Policy.objects.filter(pk__in=policy_pks)}
+        for pk in policy_pks:
+            if pk in policies:
+                apply_policy.__wrapped__(policies[pk])
+            else:
+                # the Policy was deleted, deleting its rules only needs its pk
+                delete_policy(hub.models.Policy(pk=pk))
+    if compiler.USERS not in scope:
+        user_pks = _intent_pks(scope, "user")
+        users = {user.pk: user for user in hub.models.User.objects.filter(pk__in=user_pks).select_related("userprofile")}
+        for pk in user_pks:
+            if pk in users:
+                apply_user.__wrapped__(users[pk])
+            else:
+                delete_user(hub.models.User(pk=pk))
+    for key in [compiler.RULES, compiler.POLICIES, compiler.USERS]:
+        if key in scope:
+            apply_all.__wrapped__(key)
+
+
+@keyed_job(
+    lambda key: f"apply-{key}", delay=debounce, retries=retries, backoff=backoff,
+    escalate=lambda key: rebuild({key}),
+)
+@iptc_committed
+def apply_all(key):
+    """
+    Rebuilds all objects of scope `key`, one of compiler.RULES, compiler.POLICIES or compiler.USERS
+    """
+    {compiler.RULES: sync_all_rules, compiler.POLICIES: sync_all_policies, compiler.USERS: sync_all_users}[key]()
+
+
+@keyed_job(lambda scope: f"rebuild-{','.join(sorted(scope))}")
+@iptc_committed
+def rebuild(scope):
+    """
+    Rebuilds the chains of compiler scope `scope` along with the core chains, and the Policy chain if Rule
+    chains are rebuilt as it jumps to them. This is the escalation of a firewall job that keeps failing, and
+    unlike init it leaves the rest of the firewall alone.
+    """
+    scope = engine_scope(scope) | {compiler.MAIN}
+    rule_pks = _intent_pks(scope, "rule")
+    if rule_pks or compiler.RULES in scope:
+        scope.add(compiler.POLICIES)
+    logger.warning(f"Rebuilding firewall scope {', '.join(sorted(scope))}")
+    if not get_engine():
+        # recreate the Rule chains from scratch, the compiled engines rewrite every chain that differs
+        delete_chains([f"{hub.models.Rule.chain_name_prefix}{pk}" for pk in rule_pks])
+    apply_scope.__wrapped__(scope)
+
+
+def delete_iptrules(chain_names, predicate, delete_conntrack_entry=False):
+    """
+    deletes all rules for which `predicate(rule)` is true in iptables chains `chain_names`, scanning each chain
+    once and committing all deletions to the kernel in a single transaction.
+    if `delete_conntrack_entry` is True, conntrack entries of flows to the destinations of deleted rules are flushed afterwards.
+    returns the number of rules deleted.
+    """
+    table = iptc.Table(iptc.Table.FILTER)
+    table.refresh()
+    table.autocommit = False
+    conntrack_addresses = set()
+    deleted = 0
+    try:
+        for chain_name in chain_names:
+            if not table.is_chain(chain_name):
+                continue
+            chain_handle = iptc.Chain(table, chain_name)
+            for rule in [r for r in chain_handle.rules if predicate(r)]:
+                chain_handle.delete_rule(rule)
+                deleted += 1
+                if delete_conntrack_entry:
+                    conntrack_addresses.add(rule.dst.split('/')[0])
+        if deleted:
+            table.commit()
+    finally:
+        # refreshing with autocommit disabled discards anything left uncommitted on error
+        table.refresh()
+        table.autocommit = True
+    conntrack.flush(conntrack.Flow(dst=address) for address in conntrack_addresses)
+    return deleted
+
+
 def delete_iptrules_by_target_name(chain_name, target_name):
     """
-    deletes an iptables rule in chain `chain_name` with target `taget_name`
+    deletes all rules in iptables chain `chain_name` with target `target_name`, returns the number of rules deleted
     """
-    rule_list = True
-    while rule_list:
-        iptc.Table(iptc.Table.FILTER).refresh()
-        chain_handle = iptc.Chain(iptc.Table(iptc.Table.FILTER), chain_name)
-        rule_list = [r for r in chain_handle.rules if r.target.name == target_name]
-        if rule_list:
-            chain_handle.delete_rule(rule_list[-1])
-        else:
-            logger.info(f"successfully deleted rule with target_name '{target_name}' from chain '{chain_name}'")
+    deleted = delete_iptrules([chain_name], lambda r: r.target.name == target_name)
+    logger.info(f"successfully deleted {deleted} rule(s) with target_name '{target_name}' from chain '{chain_name}'")
+    return deleted
 
 
 def delete_iptrules_by_comment(chain_name, comment, delete_conntrack_entry=False):
     """
-    deletes all rules matching `comment` in iptables chain with chain_name `chain_name`
-    """
-    rule_list = True
-    while rule_list:
-        iptc.Table(iptc.Table.FILTER).refresh()
-        chain_handle = iptc.Chain(iptc.Table(iptc.Table.FILTER), chain_name)
-        rule_list = [r for r in chain_handle.rules if comment in [m.comment for m in r.matches]]
-        if rule_list:
-            rule_to_delete = rule_list[-1]
-            chain_handle.delete_rule(rule_to_delete)
-            if delete_conntrack_entry:
-                cmd = f"conntrack -D conntrack -d {rule_to_delete.dst.split('/')[0]}"
-                logger.info(f"running conntrack rule delete command: {cmd}")
-                rc = subprocess.call(cmd, shell=True)
-                logger.info(f"rc was: {rc}")
-        else:
-             logger.info(f"successfully deleted rule with comment '{comment}' from chain '{chain_name}'")
+    deletes all rules matching `comment` in iptables chain with chain_name `chain_name`, returns the number of rules deleted
+    """
+    deleted = delete_iptrules(
+        [chain_name],
+        lambda r: comment in [m.comment for m in r.matches],
+        delete_conntrack_entry=delete_conntrack_entry,
+    )
+    logger.info(f"successfully deleted {deleted} rule(s) with comment '{comment}' from chain '{chain_name}'")
+    return deleted
+
+
+def delete_chains(chain_names):
+    """
+    Deletes the iptables chains in `chain_names` along with all rules in other chains that jump to them,
+    in a single scan of the filter table and a single commit
+    """
+    table = iptc.Table(iptc.Table.FILTER)
+    table.refresh()
+    chain_names = {c for c in chain_names if table.is_chain(c)}
+    if not chain_names:
+        return
+    table.autocommit = False
+    try:
+        for chain_handle in table.chains:
+            if chain_handle.name in chain_names:
+                chain_handle.flush()
+                continue
+            for rule in [r for r in chain_handle.rules if r.target.name in chain_names]:
+                chain_handle.delete_rule(rule)
+        for chain_name in chain_names:
+            table.delete_chain(chain_name)
+        table.commit()
+    finally:
+        table.refresh()
+        table.autocommit = True
+
 
-    
 def delete_chain(chain_name):
     """
     Deletes an iptables chain matching `chain_name`
     """
-    if chain_name in iptc.easy.get_chains('filter'):
-        iptc.easy.flush_chain("filter", chain_name)
-        # delete chain refs in "evon-policy" chain
-        for cn in iptc.easy.get_chains('filter'):
-            delete_iptrules_by_target_name(cn, chain_name)
-        iptc.easy.delete_chain("filter", chain_name)
+    delete_chains([chain_name])
 
 
 def delete_rule(rule):
     """
     Takes a hub.models.Rule instance and deletes the corresponding iptables chain
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.rule_key(rule.pk)])
+        return
     delete_chain(rule.get_chain_name())
+    conntrack.revoke_unpermitted()
 
 
 def delete_policy(policy):
     """
     Takes a hub.models.Policy and deletes the corresponding iptables rules in the evon-policy chain
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.POLICIES])
+        return
     chain_name = "evon-policy"
     policy_comment = f"evon-policy-{policy.pk}"
-    delete_iptrules_by_comment(chain_name, policy_comment)
+    if delete_iptrules_by_comment(chain_name, policy_comment):
+        conntrack.revoke_unpermitted()
 
 
 def sync_all_rules():
     """
     Removes any orphaned Rule chains and creates Rule chains in iptables from the set of all Hub Rules
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.RULES])
+        return
     # remove orpans
     all_iptables_rule_chains = [c for c in iptc.easy.get_chains('filter') if c.startswith(hub.models.Rule.chain_name_prefix)]
     all_rule_chain_names = [r.get_chain_name() for r in hub.models.Rule.objects.all()]
-    for chain_name in all_iptables_rule_chains:
-        if not chain_name in all_rule_chain_names:
-            delete_chain(chain_name)
+    delete_chains([c for c in all_iptables_rule_chains if c not in all_rule_chain_names])
     # create chains
     for rule in hub.models.Rule.objects.all():
         apply_rule(rule)
@@ -260,6 +526,10 @@ def sync_all_policies():
     """
     Syncs all policy rules in the evon-policy chain, removing any orphans
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.POLICIES])
+        return
     iptc.easy.flush_chain("filter", "evon-policy")
     for policy in hub.models.Policy.objects.all():
         apply_policy(policy)
@@ -269,6 +539,10 @@ def sync_all_users():
     """
     Syncs all user rules in the evon-user chain
     """
+    engine = get_engine()
+    if engine:
+        applier.call("apply", scope=[compiler.USERS])
+        return
     iptc.easy.flush_chain("filter", "evon-user")
     for user in hub.models.User.objects.all():
         apply_user(user)
@@ -279,30 +553,30 @@ def delete_all(flush_only=True):
     Delete all rules and policies and revert to initialised state.
     If flush_only=False, delete absolutely all evon-related firewall rules and chains.
     """
-    # flush policy chain
-    if "evon-policy" in iptc.easy.get_chains('filter'):
-        iptc.easy.flush_chain("filter", "evon-policy")
-    # flush user chain
-    if "evon-user" in iptc.easy.get_chains('filter'):
-        iptc.easy.flush_chain("filter", "evon-user")
+    engine = get_engine()
+    if engine:
+        applier.call("delete_all", flush_only=flush_only)
+        return
+    # flush policy and user chains
+    delete_iptrules(["evon-policy", "evon-user"], lambda r: True)
     # delete rule chains
-    for chain_name in [c for c in iptc.easy.get_chains('filter') if c.startswith(hub.models.Rule.chain_name_prefix)]:
-        delete_chain(chain_name)
+    delete_chains([c for c in iptc.easy.get_chains('filter') if c.startswith(hub.models.Rule.chain_name_prefix)])
     if not flush_only:
-        # delete evon-main ref in FORWARD chain
-        table = iptc.Table(iptc.Table.FILTER)
-        table.refresh()
-        ipt_chain = iptc.Chain(table, "FORWARD")
-        for rule in ipt_chain.rules:
-            if rule.target.name == "evon-main":
-                ipt_chain.delete_rule(rule)
-                break
-        # flush and delete evon-main chain
-        delete_chain("evon-main")
-        # flush and delete evon-policy chain
-        delete_chain("evon-policy")
-        # flush and delete evon-user chain
-        delete_chain("evon-user")
+        # flush and delete the core chains along with their refs in the FORWARD chain
+        delete_chains(["evon-main", "evon-policy", "evon-user"])
+
+
+@dedupe_job('firewall-reconcile')
+def reconcile():
+    """
+    Rebuilds only those evon firewall objects whose kernel state has drifted from the last applied state,
+    eg. after manual iptables edits. Returns the list of drifted objects.
+    """
+    engine = get_engine()
+    if not engine:
+        logger.warning("drift reconciliation is not supported by the iptc backend, use init instead")
+        return []
+    return applier.call("reconcile")
 
 
 def kill_orphan_servers():
@@ -350,6 +624,12 @@ def init(full=True):
     Initialise iptables chains for evon Rules and Policies.
     if `full` == False, just create the core chains.
     """
+    engine = get_engine()
+    if engine:
+        applier.call("init", full=full)
+        return
+    # remove the objects of the compiled backends, which would otherwise keep filtering alongside these chains
+    applier.call("retire")
     # create core chains
     core_chains = ["evon-main", "evon-policy", "evon-user"]
     for chain_name in core_chains:
@@ -358,7 +638,7 @@ def init(full=True):
     # add rule to chain FORWARD -> evon-main
     main_chain_comment = "evon-forward-to-evon-main"
     subnet_key = EVON_VARS["subnet_key"]
-    if not [r for r in iptc.easy.dump_table('filter')['FORWARD'] if r.get("comment", {}).get("comment") == main_chain_comment]:
+    if not [r for r in iptc.easy.dump_table('filter')['FORWARD'] if main_chain_comment in r.get("comment", {}).get("comment", [])]:
         rule = iptc.Rule()
         match = iptc.Match(rule, "iprange")
         match.src_range = f"100.{ subnet_key }.208.1-100.{ subnet_key }.255.254"
@@ -372,7 +652,7 @@ def init(full=True):
     # add rule to chain FORWARD -> evon-user
     user_chain_comment = "evon-forward-to-evon-user"
     subnet_key = EVON_VARS["subnet_key"]
-    if not [r for r in iptc.easy.dump_table('filter')['FORWARD'] if r.get("comment", {}).get("comment") == user_chain_comment]:
+    if not [r for r in iptc.easy.dump_table('filter')['FORWARD'] if user_chain_comment in r.get("comment", {}).get("comment", [])]:
         rule = iptc.Rule()
         match = iptc.Match(rule, "iprange")
         match.src_range = f"100.{ subnet_key }.208.1-100.{ subnet_key }.255.254"
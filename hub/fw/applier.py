@@ -0,0 +1,256 @@
+"""
+Hub-wide firewall applier.
+
+Every gunicorn worker and `eapi` command has its own job queue (see evon.job_queue), so without coordination
+several processes mutate the kernel firewall at once and contend for the xtables lock. The applier daemon
+(`eapi fwapplier`, run by evonfwapplier.service) is the single process that owns the kernel state: other
+processes submit firewall operations to it as intents over a unix socket, one JSON line per request and reply.
+
+The daemon executes intents one at a time in arrival order. Consecutive intents that can be combined are
+executed as one, eg. pending applies are merged into a single apply of the union of their scopes, so bursts
+of changes from all processes cost a single compile and commit.
+
+If the applier is disabled or can't be connected to, operations are executed in the calling process.
+"""
+
+from concurrent.futures import Future
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from django.db import close_old_connections
+
+from eapi.settings import EVON_HUB_CONFIG
+from evon.log import get_evon_logger
+from hub.exceptions import FirewallError
+from hub.fw import compiler, conntrack, drift, restore, snapshot
+
+
+logger = get_evon_logger()
+
+# seconds to wait for the applier to execute an intent
+REPLY_TIMEOUT = 600
+
+# True in the applier daemon, which executes intents rather than submitting them
+serving = False
+
+# serialises kernel commits between the job worker threads of a process, the applier daemon does so between
+# processes
+commit_lock = threading.RLock()
+
+
+##### Operations
+
+def _apply(engine, scope):
+    return engine.apply(set(scope))
+
+
+def _init(engine, full=True):
+    if not (full and snapshot.restore(engine)):
+        engine.apply(compiler.FULL_SCOPE if full else {compiler.MAIN})
+    # the previous backend is removed once the new one filters, so there is no window without filtering
+    _retire(engine)
+
+
+def _retire(engine=None):
+    """
+    Deletes the evon objects of every backend but that of `engine`, or of iptc if None. Forwarded packets
+    must pass the evon chains of every backend holding them, so a stale backend keeps blocking newly granted
+    access. iptc manages the same iptables chains as iptables-restore, whose objects are only deleted for
+    iptc if iptables-restore has recorded applied state.
+    """
+    from hub.firewall import ENGINES
+    for other in ENGINES.values():
+        if other is engine or (engine is None and other is restore and not drift.recorded(restore.NAME)):
+            continue
+        try:
+            other.delete_all(flush_only=False)
+        except FirewallError as e:
+            logger.warning(f"unable to delete the firewall objects of the {other.NAME} backend: {e}")
+
+
+def _delete_all(engine, flush_only=True):
+    engine.delete_all(flush_only=flush_only)
+
+
+def _reconcile(engine):
+    drifted = drift.detect(engine.NAME, engine.live_objects())
+    if drifted is None:
+        logger.warning("no applied firewall state has been recorded, initialising the firewall")
+        engine.apply(compiler.FULL_SCOPE)
+        return []
+    if not drifted:
+        logger.info("no firewall drift detected")
+        return []
+    for key in drifted:
+        logger.warning(f"firewall drift detected in {key}")
+    drift.count(engine.NAME, drifted)
+    engine.apply({drift.scope_for(key) for key in drifted})
+    return drifted
+
+
+def _flush(engine, flows):
+    # port ranges are (first, last) tuples, which arrive as lists over the socket
+    return conntrack.flush([
+        conntrack.Flow(src, dst, proto, tuple(dport) if isinstance(dport, list) else dport)
+        for src, dst, proto, dport in flows
+    ])
+
+
+OPERATIONS = {
+    "apply": _apply,
+    "init": _init,
+    "retire": _retire,
+    "delete_all": _delete_all,
+    "reconcile": _reconcile,
+    "flush": _flush,
+}
+
+
+def execute(op, backend, args):
+    "executes operation `op` with the engine of `backend` in this process and returns its result"
+    from hub.firewall import ENGINES
+    with commit_lock:
+        return OPERATIONS[op](ENGINES.get(backend), **args)
+
+
+##### Batching
+
+def _merge_key(intent):
+    "returns a key that is equal for consecutive intents which can be executed as one"
+    if intent["op"] in ["apply", "flush"]:
+        return (intent["op"], intent["backend"])
+    return (intent["op"], intent["backend"], json.dumps(intent["args"], sort_keys=True))
+
+
+def coalesce(intents):
+    """
+    Groups consecutive `intents` that can be executed as one, preserving the order of those that can't.
+    Returns a list of (merged intent, intents) tuples.
+    """
+    batches = []
+    for intent in intents:
+        if batches and _merge_key(batches[-1][1][-1]) == _merge_key(intent):
+            batches[-1][1].append(intent)
+        else:
+            batches.append((intent, [intent]))
+    merged = []
+    for first, batch in batches:
+        args = dict(first["args"])
+        if first["op"] == "apply":
+            args["scope"] = sorted(set().union(*[intent["args"]["scope"] for intent in batch]))
+        elif first["op"] == "flush":
+            args["flows"] = [flow for intent in batch for flow in intent["args"]["flows"]]
+        merged.append(({**first, "args": args}, batch))
+    return merged
+
+
+##### Daemon
+
+class Applier:
+    "executes submitted intents serially in a single worker thread"
+
+    def __init__(self):
+        self._pending = []
+        self._condition = threading.Condition()
+
+    def submit(self, intent):
+        "queues `intent` and returns a Future of its result"
+        future = Future()
+        with self._condition:
+            self._pending.append((intent, future))
+            self._condition.notify()
+        return future
+
+    def work(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                pending, self._pending = self._pending, []
+            futures = {id(intent): future for intent, future in pending}
+            batches = coalesce([intent for intent, _ in pending])
+            if len(batches) < len(pending):
+                logger.info(f"firewall applier coalesced {len(pending)} intents into {len(batches)}")
+            for merged, batch in batches:
+                # the DB connection outlives requests, drop it if it has gone stale
+                close_old_connections()
+                try:
+                    result, error = execute(merged["op"], merged["backend"], merged["args"]), None
+                except Exception as e:
+                    logger.error(f"firewall applier failed to {merged['op']}: {e}")
+                    result, error = None, e
+                for intent in batch:
+                    if error:
+                        futures[id(intent)].set_exception(error)
+                    else:
+                        futures[id(intent)].set_result(result)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                intent = json.loads(line)
+                if intent.get("op") not in OPERATIONS:
+                    raise ValueError(f"unknown firewall operation {intent.get('op')}")
+                reply = {"ok": True, "result": self.server.applier.submit(intent).result()}
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+def serve(path=None):
+    "runs the applier daemon on unix socket `path` until interrupted"
+    global serving
+    path = path or EVON_HUB_CONFIG["FIREWALL_APPLIER_SOCKET"]
+    if os.path.exists(path):
+        os.remove(path)
+    serving = True
+    applier = Applier()
+    threading.Thread(target=applier.work, name="fw-applier", daemon=True).start()
+    with socketserver.ThreadingUnixStreamServer(path, _Handler) as server:
+        server.daemon_threads = True
+        server.applier = applier
+        os.chmod(path, 0o660)
+        logger.info(f"firewall applier listening on {path}")
+        server.serve_forever()
+
+
+##### Client
+
+def call(op, **args):
+    """
+    Runs firewall operation `op` with the current backend in the applier daemon, or in this process if the
+    applier is disabled or unavailable. Returns the result of the operation, raising FirewallError if it failed.
+    """
+    from hub import firewall
+    intent = {"op": op, "backend": firewall.backend, "args": args}
+    path = EVON_HUB_CONFIG["FIREWALL_APPLIER_SOCKET"]
+    if serving or not EVON_HUB_CONFIG["FIREWALL_APPLIER"]:
+        return execute(op, intent["backend"], args)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REPLY_TIMEOUT)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        # nothing was sent yet, eg. the socket is missing, refused, not permitted or the connect timed out
+        sock.close()
+        logger.warning(f"firewall applier is unavailable at {path} ({e}), applying in this process")
+        return execute(op, intent["backend"], args)
+    with sock:
+        # once the intent is sent the applier may act on it, so it is never retried in this process
+        try:
+            sock.sendall(json.dumps(intent).encode("utf-8") + b"\n")
+            reply = sock.makefile("rb").readline()
+        except OSError as e:
+            raise FirewallError(f"lost connection to the firewall applier: {e}")
+    if not reply:
+        raise FirewallError("the firewall applier closed the connection without replying")
+    reply = json.loads(reply)
+    if not reply["ok"]:
+        raise FirewallError(f"firewall applier failed to {op}: {reply['error']}")
+    return reply["result"]
@@ -0,0 +1,720 @@
+"""
+Compiles Hub Rules, Policies and Users into the desired contents of the evon iptables chains.
+
+Compilation is split in two phases so that either can be measured or replaced on its own:
+  - load() queries the DB for everything within a scope and returns plain data
+  - build() turns that data into a Ruleset without touching the DB
+
+A scope is a set of keys naming the parts of the firewall to compile:
+  - "main":      the evon-main chain and the FORWARD chain jumps
+  - "rules":     every Rule chain and shared source object, orphans are removed
+  - "rule:<pk>": a single Rule chain and its shared source object, removed if no longer used
+  - "policies":  the evon-policy chain and the per-destination dispatch chains it jumps to
+  - "users":     the evon-user chain
+"""
+
+import hashlib
+import ipaddress
+
+from eapi.settings import EVON_VARS
+from evon.log import get_evon_logger
+import hub.models
+
+
+logger = get_evon_logger()
+
+MAIN_CHAIN = "evon-main"
+POLICY_CHAIN = "evon-policy"
+USER_CHAIN = "evon-user"
+CORE_CHAINS = [MAIN_CHAIN, POLICY_CHAIN, USER_CHAIN]
+DISPATCH_PREFIX = "evon-dst-"
+SOURCE_PREFIX = "evon-src-"
+
+MAIN = "main"
+RULES = "rules"
+POLICIES = "policies"
+USERS = "users"
+FULL_SCOPE = frozenset([MAIN, RULES, POLICIES, USERS])
+# a multiport match holds up to 15 ports, a port range takes two of them
+MULTIPORT_SLOTS = 15
+
+
+def rule_key(pk):
+    "returns the scope key for the Rule with primary key `pk`"
+    return f"rule:{pk}"
+
+
+def dispatch_chain_name(rule_pks):
+    "returns the name of the dispatch chain that jumps to the chains of Rules `rule_pks`"
+    digest = hashlib.sha1(",".join(str(pk) for pk in sorted(rule_pks)).encode("utf-8")).hexdigest()
+    return f"{DISPATCH_PREFIX}{digest[:10]}"
+
+
+def source_name(definition):
+    "returns the name of the shared source chain or set matching the Rule source `definition`"
+    digest = hashlib.sha1(",".join(sorted(definition)).encode("utf-8")).hexdigest()
+    return f"{SOURCE_PREFIX}{digest[:10]}"
+
+
+def is_evon_object(name):
+    "returns True if `name` is a chain or set that compiled engines manage outside of their own table"
+    prefixes = [hub.models.Rule.chain_name_prefix, SOURCE_PREFIX, DISPATCH_PREFIX]
+    return name in CORE_CHAINS or any(name.startswith(prefix) for prefix in prefixes)
+
+
+def overlay_range():
+    "returns the iprange spec covering all User and Server addresses on the overlay network"
+    subnet_key = EVON_VARS["subnet_key"]
+    return f"100.{subnet_key}.208.1-100.{subnet_key}.255.254"
+
+
+def user_subnet():
+    "returns the subnet User addresses are allocated from, see hub.models.vpn_ipv4_addresses()"
+    return f"100.{EVON_VARS['subnet_key']}.208.0/20"
+
+
+def server_subnet():
+    "returns the subnet Server addresses are allocated from, see hub.models.vpn_ipv4_addresses()"
+    return f"100.{EVON_VARS['subnet_key']}.224.0/19"
+
+
+class Ruleset:
+    """
+    Desired contents of the evon chains within a compile scope.
+
+    `chains` maps chain names to lists of rule specs in iptables-save syntax (eg. "-s 1.2.3.4/32 -j ACCEPT").
+    `sets` maps ipset names to the addresses they should contain, if the ruleset was built with sets.
+    Engines with their own rule syntax (see hub.fw.nft) build Rulesets of the same shape, plus verdict `maps`.
+    Chains and sets that are owned by the scope but absent from `chains` or `sets` are expected to be deleted,
+    unless they are `retained` because something outside the scope still uses them.
+    """
+
+    def __init__(self, scope):
+        self.scope = frozenset(scope)
+        self.chains = {}
+        self.sets = {}
+        self.maps = {}
+        self.forward = []
+        self.owned_names = set()
+        self.owned_prefixes = []
+        self.retained = set()
+
+    def add(self, chain_name, spec):
+        self.chains.setdefault(chain_name, []).append(spec)
+
+    def owns(self, chain_name):
+        "returns True if `chain_name` is governed by this ruleset's scope"
+        if chain_name in self.chains or chain_name in self.sets:
+            return True
+        return chain_name not in self.retained and (
+            chain_name in self.owned_names or
+            any(chain_name.startswith(prefix) for prefix in self.owned_prefixes)
+        )
+
+    def rule_count(self):
+        return sum(len(specs) for specs in self.chains.values())
+
+    def to_dict(self):
+        "returns this ruleset as a JSON serialisable dict"
+        return {
+            "scope": sorted(self.scope),
+            "chains": self.chains,
+            "sets": {name: sorted(members) for name, members in self.sets.items()},
+            "maps": self.maps,
+            "forward": self.forward,
+            "owned_names": sorted(self.owned_names),
+            "owned_prefixes": self.owned_prefixes,
+            "retained": sorted(self.retained),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        "returns a Ruleset from a dict returned by to_dict()"
+        ruleset = cls(data["scope"])
+        ruleset.chains = data["chains"]
+        ruleset.sets = {name: set(members) for name, members in data["sets"].items()}
+        ruleset.maps = data["maps"]
+        ruleset.forward = [tuple(jump) for jump in data["forward"]]
+        ruleset.owned_names = set(data["owned_names"])
+        ruleset.owned_prefixes = data["owned_prefixes"]
+        ruleset.retained = set(data["retained"])
+        return ruleset
+
+
+##### Load phase
+
+ALL_USERS = "All Users"
+ALL_SERVERS = "All Servers"
+
+
+def virtual_sources():
+    """
+    Returns a dict of source definition item -> subnet for the "All Users" Group and the "All Servers"
+    ServerGroup. Every User and Server is a member of these, so they are matched by subnet rather than by the
+    addresses of their members, and adding a member never changes the firewall.
+    """
+    virtual = {}
+    for pk in hub.models.Group.objects.filter(name=ALL_USERS).values_list("pk", flat=True):
+        virtual[f"group:{pk}"] = user_subnet()
+    for pk in hub.models.ServerGroup.objects.filter(name=ALL_SERVERS).values_list("pk", flat=True):
+        virtual[f"servergroup:{pk}"] = server_subnet()
+    return virtual
+
+
+def _rule_pks(scope):
+    "returns the set of Rule pk's named in `scope`, or None if all Rules are in scope"
+    if RULES in scope:
+        return None
+    return {int(key.split(":", 1)[1]) for key in scope if key.startswith("rule:")}
+
+
+def _rule_sources():
+    "returns the (kind, through model, field) of each kind of object a Rule can source"
+    Rule = hub.models.Rule
+    return [
+        ("user", Rule.source_users.through, "user_id"),
+        ("group", Rule.source_groups.through, "group_id"),
+        ("server", Rule.source_servers.through, "server_id"),
+        ("servergroup", Rule.source_servergroups.through, "servergroup_id"),
+    ]
+
+
+def _load_definitions(rules):
+    """
+    Returns a dict of Rule pk -> source definition for the Rules in queryset `rules` that have sources.
+    A source definition is the set of objects a Rule sources directly, eg. {"user:1", "group:2"}.
+    """
+    definitions = {}
+    for kind, through, field in _rule_sources():
+        for rule_pk, pk in through.objects.filter(rule__in=rules).values_list("rule_id", field):
+            definitions.setdefault(rule_pk, set()).add(f"{kind}:{pk}")
+    return definitions
+
+
+def _resolve_sources(items):
+    "returns a dict of source definition item -> set of addresses for all `items`"
+    pks = {}
+    for item in items:
+        kind, pk = item.split(":")
+        pks.setdefault(kind, set()).add(int(pk))
+    queries = [
+        ("user", hub.models.UserProfile.objects.filter(user_id__in=pks.get("user", [])).values_list("user_id", "ipv4_address")),
+        ("group", hub.models.User.groups.through.objects.filter(group_id__in=pks.get("group", [])).values_list("group_id", "user__userprofile__ipv4_address")),
+        ("server", hub.models.Server.objects.filter(pk__in=pks.get("server", [])).values_list("pk", "ipv4_address")),
+        ("servergroup", hub.models.Server.server_groups.through.objects.filter(servergroup_id__in=pks.get("servergroup", [])).values_list("servergroup_id", "server__ipv4_address")),
+    ]
+    addresses = {item: set() for item in items}
+    for kind, query in queries:
+        if kind not in pks:
+            continue
+        for pk, address in query:
+            if address:
+                addresses[f"{kind}:{pk}"].add(address)
+    return addresses
+
+
+def _load_rules(rule_pks):
+    rules = hub.models.Rule.objects.all()
+    if rule_pks is not None:
+        rules = rules.filter(pk__in=rule_pks)
+    loaded = {}
+    for pk, protocol, ports in rules.values_list("pk", "destination_protocol", "destination_ports"):
+        loaded[pk] = {
+            "protocol": protocol.lower(),
+            "ports": [p.replace("-", ":") for p in ports.split(",") if p],
+            "definition": frozenset(),
+            "sources": set(),
+            "ranges": [],
+        }
+    if not loaded:
+        return loaded
+    definitions = _load_definitions(rules)
+    virtual = virtual_sources()
+    addresses = _resolve_sources(set().union(*definitions.values()) - set(virtual))
+    for pk, definition in definitions.items():
+        ranges = sorted({virtual[item] for item in definition if item in virtual})
+        networks = [ipaddress.IPv4Network(subnet) for subnet in ranges]
+        loaded[pk]["definition"] = frozenset(definition)
+        loaded[pk]["ranges"] = ranges
+        # addresses within a virtual group's subnet are matched by the subnet
+        loaded[pk]["sources"] = {
+            address for address in set().union(*[addresses[item] for item in definition if item not in virtual])
+            if not any(ipaddress.IPv4Address(address) in network for network in networks)
+        }
+    return loaded
+
+
+def _load_retained_sources(rule_pks):
+    "returns the names of the shared source objects used by Rules other than `rule_pks`"
+    rules = hub.models.Rule.objects.exclude(pk__in=rule_pks)
+    definitions = _load_definitions(rules)
+    return {source_name(definitions.get(pk, ())) for pk in rules.values_list("pk", flat=True)}
+
+
+def _load_policies():
+    Policy = hub.models.Policy
+    loaded = {pk: {"rules": set(), "targets": set(), "ranges": set()} for pk in Policy.objects.values_list("pk", flat=True)}
+    if not loaded:
+        return loaded
+    virtual = virtual_sources()
+    for policy_pk, rule_pk in Policy.rules.through.objects.filter(policy_id__in=loaded).values_list("policy_id", "rule_id"):
+        loaded[policy_pk]["rules"].add(rule_pk)
+    for policy_pk, address in Policy.servers.through.objects.filter(policy_id__in=loaded).values_list("policy_id", "server__ipv4_address"):
+        loaded[policy_pk]["targets"].add(address)
+    servergroup_policies = {}
+    for policy_pk, sg_pk in Policy.servergroups.through.objects.filter(policy_id__in=loaded).values_list("policy_id", "servergroup_id"):
+        if f"servergroup:{sg_pk}" in virtual:
+            loaded[policy_pk]["ranges"].add(virtual[f"servergroup:{sg_pk}"])
+            continue
+        servergroup_policies.setdefault(sg_pk, []).append(policy_pk)
+    members = hub.models.Server.server_groups.through.objects.filter(servergroup_id__in=servergroup_policies)
+    for sg_pk, address in members.values_list("servergroup_id", "server__ipv4_address"):
+        for policy_pk in servergroup_policies[sg_pk]:
+            loaded[policy_pk]["targets"].add(address)
+    return loaded
+
+
+def _load_users():
+    shared_profiles = hub.models.UserProfile.objects.filter(shared=True, user__is_active=True)
+    return dict(shared_profiles.values_list("user_id", "ipv4_address"))
+
+
+def load(scope):
+    """
+    Queries the DB for all objects needed to compile `scope` and returns them as plain data
+    """
+    rule_pks = _rule_pks(scope)
+    return {
+        "scope": frozenset(scope),
+        "rules": _load_rules(rule_pks) if rule_pks is None or rule_pks else {},
+        "retained_sources": _load_retained_sources(rule_pks) if rule_pks else set(),
+        "policies": _load_policies() if POLICIES in scope else {},
+        "users": _load_users() if USERS in scope else {},
+    }
+
+
+##### Dependencies
+
+def _sourcing_rules(kind, pks):
+    "returns the pk's of the Rules that source any of the `kind` objects with `pks` directly"
+    through, field = {k: (t, f) for k, t, f in _rule_sources()}[kind]
+    return set(through.objects.filter(**{f"{field}__in": pks}).values_list("rule_id", flat=True))
+
+
+def dependents(kind, pks):
+    """
+    Returns the minimal scope to rebuild when the addresses or memberships of the `kind` objects with `pks`
+    change, where `kind` is one of "user", "group", "server" or "servergroup". Users and Servers are also
+    sourced through their Groups and ServerGroups, and Policies target Servers and ServerGroups.
+    """
+    Policy = hub.models.Policy
+    virtual = virtual_sources()
+    pks = set(pks)
+    if kind in ["group", "servergroup"]:
+        # virtual groups are matched by subnet, their membership never changes the firewall
+        pks = {pk for pk in pks if f"{kind}:{pk}" not in virtual}
+    rule_pks = _sourcing_rules(kind, pks)
+    targeted = False
+    if kind == "user":
+        groups = hub.models.User.groups.through.objects.filter(user_id__in=pks).values_list("group_id", flat=True)
+        rule_pks |= _sourcing_rules("group", {pk for pk in groups if f"group:{pk}" not in virtual})
+    elif kind == "server":
+        servergroups = {
+            pk for pk in hub.models.Server.server_groups.through.objects.filter(server_id__in=pks).values_list("servergroup_id", flat=True)
+            if f"servergroup:{pk}" not in virtual
+        }
+        rule_pks |= _sourcing_rules("servergroup", servergroups)
+        targeted = Policy.servers.through.objects.filter(server_id__in=pks).exists() or \
+            Policy.servergroups.through.objects.filter(servergroup_id__in=servergroups).exists()
+    elif kind == "servergroup":
+        targeted = Policy.servergroups.through.objects.filter(servergroup_id__in=pks).exists()
+    scope = {rule_key(pk) for pk in rule_pks}
+    if targeted:
+        scope.add(POLICIES)
+    return scope
+
+
+##### Build phase
+
+def _build_main(ruleset):
+    overlay = overlay_range()
+    ruleset.chains[MAIN_CHAIN] = [
+        "-p tcp -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+        "-p udp -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+        "-p icmp -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+        "-m state --state RELATED,ESTABLISHED -j ACCEPT",
+        f"-j {POLICY_CHAIN}",
+        f"-m iprange --src-range {overlay} -j DROP",
+    ]
+    # FORWARD jumps are identified by their comment, evon-user ends up above evon-main
+    for target in [MAIN_CHAIN, USER_CHAIN]:
+        comment = f"evon-forward-to-{target}"
+        ruleset.forward.append(
+            (comment, f"-m iprange --src-range {overlay} -m comment --comment {comment} -j {target}")
+        )
+
+
+def aggregate(addresses):
+    """
+    Merges `addresses` into the fewest source matches, returned as a list of CIDR prefixes ("a.b.c.d/n") and
+    ranges ("a.b.c.d-w.x.y.z").
+
+    Client addresses are allocated one per /30 block by hub.models.vpn_ipv4_addresses(), the other addresses in
+    a client's block are never used as a source by anyone else, so contiguous client blocks are merged. A run of
+    blocks becomes a prefix if it aligns to one, otherwise a range. Lone clients are kept as /32's.
+    """
+    hosts = {ipaddress.IPv4Address(a) for a in addresses}
+    networks = [
+        ipaddress.IPv4Network((int(host) - 2, 30)) if int(host) % 4 == 2 else ipaddress.IPv4Network(host)
+        for host in hosts
+    ]
+    runs = []
+    for network in ipaddress.collapse_addresses(networks):
+        if runs and int(runs[-1][-1].broadcast_address) + 1 == int(network.network_address):
+            runs[-1].append(network)
+        else:
+            runs.append([network])
+    sources = []
+    for run in runs:
+        first, last = run[0].network_address, run[-1].broadcast_address
+        if len(run) > 1:
+            sources.append(f"{first}-{last}")
+        elif run[0].prefixlen == 30 and hosts.intersection(run[0]) == {first + 2}:
+            sources.append(f"{first + 2}/32")
+        else:
+            sources.append(run[0].with_prefixlen)
+    return sources
+
+
+def merge_ports(portspecs):
+    """
+    Parses `portspecs` (eg. ["80", "8000:9000"]) into a sorted list of (first, last) port intervals,
+    merging intervals that overlap or are adjacent
+    """
+    intervals = []
+    for portspec in portspecs:
+        first, _, last = portspec.replace("-", ":").partition(":")
+        intervals.append((int(first), int(last or first)))
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def pack_ports(intervals, slots=MULTIPORT_SLOTS):
+    """
+    Packs port `intervals` from merge_ports() into lists of iptables portspecs, each list fitting in one
+    multiport match
+    """
+    packs = []
+    used = slots
+    for first, last in intervals:
+        cost = 1 if first == last else 2
+        if used + cost > slots:
+            packs.append([])
+            used = 0
+        packs[-1].append(str(first) if first == last else f"{first}:{last}")
+        used += cost
+    return packs
+
+
+def _port_matches(protocol, ports):
+    "returns the destination port matches for `protocol` and `ports`, one per multiport pack"
+    matches = []
+    for pack in pack_ports(merge_ports(ports)):
+        if len(pack) == 1:
+            matches.append(f"-m {protocol} --dport {pack[0]}")
+        else:
+            matches.append(f"-m multiport --dports {','.join(pack)}")
+    return matches
+
+
+def _build_source(ruleset, name, addresses, ranges=(), sets=False):
+    """
+    Adds shared source `name` matching `addresses` and subnets `ranges` to `ruleset` and returns the number of
+    source matches it uses. With sets, `ranges` are matched in the Rule chains, see _build_rule().
+    """
+    if sets:
+        ruleset.sets[name] = set(addresses)
+        return 1
+    ruleset.chains[name] = []
+    sources = list(ranges) + aggregate(addresses)
+    for source in sources:
+        if "-" in source:
+            ruleset.add(name, f"-m iprange --src-range {source} -j ACCEPT")
+        else:
+            ruleset.add(name, f"-s {source} -j ACCEPT")
+    return len(sources)
+
+
+def _build_rule(ruleset, pk, rule, sets=False):
+    chain_name = f"{hub.models.Rule.chain_name_prefix}{pk}"
+    source = source_name(rule["definition"])
+    ruleset.chains[chain_name] = []
+    protocol = rule["protocol"]
+    if sets:
+        # sources are matched by the shared source ipset, and virtual group subnets by address, see virtual_sources()
+        matches = [("", f"-m set --match-set {source} src ")] + [(f"-s {subnet} ", "") for subnet in rule["ranges"]]
+        target = "ACCEPT"
+    else:
+        # matching packets jump to the shared source chain, which accepts them if their source matches
+        matches, target = [("", "")], source
+    for address_match, match in matches:
+        if rule["ports"]:
+            # tcp or udp, one rule per multiport pack
+            for port_match in _port_matches(protocol, rule["ports"]):
+                ruleset.add(chain_name, f"{address_match}-p {protocol} {match}{port_match} -j {target}")
+        elif protocol != "all":
+            ruleset.add(chain_name, f"{address_match}-p {protocol} {match}-j {target}")
+        else:
+            ruleset.add(chain_name, f"{address_match}{match}-j {target}")
+
+
+def own_rules(ruleset, data):
+    "marks the Rule chains and shared source objects governed by the scope of `data` as owned by `ruleset`"
+    scope = data["scope"]
+    if RULES in scope:
+        ruleset.owned_prefixes.extend([hub.models.Rule.chain_name_prefix, SOURCE_PREFIX])
+        return
+    rule_pks = _rule_pks(scope)
+    for pk in rule_pks:
+        ruleset.owned_names.add(f"{hub.models.Rule.chain_name_prefix}{pk}")
+    if rule_pks:
+        # shared sources that fall out of use are removed, unless a Rule outside the scope still uses them
+        ruleset.owned_prefixes.append(SOURCE_PREFIX)
+        ruleset.retained.update(data.get("retained_sources", ()))
+
+
+def dispatch_targets(policies):
+    """
+    Groups the target addresses of `policies` by the set of Rules that apply to them.
+    Returns a dict of dispatch chain name -> (Rule pk's, target addresses)
+    """
+    target_rules = {}
+    for policy in policies.values():
+        for address in policy["targets"]:
+            target_rules.setdefault(address, set()).update(policy["rules"])
+    dispatch = {}
+    for address, rule_pks in target_rules.items():
+        if rule_pks:
+            name = dispatch_chain_name(rule_pks)
+            dispatch.setdefault(name, (sorted(rule_pks), set()))[1].add(address)
+    return dispatch
+
+
+def dispatch_ranges(policies):
+    """
+    Returns a list of (subnet, dispatch chain name, Rule pk's) for the virtual ServerGroups targeted by `policies`,
+    see virtual_sources(). Subnets are matched after the addresses of dispatch_targets(), and as dispatch chains
+    return when no Rule accepts, a target address is evaluated against the Rules of both.
+    """
+    subnet_rules = {}
+    for policy in policies.values():
+        for subnet in policy.get("ranges", ()):
+            subnet_rules.setdefault(subnet, set()).update(policy["rules"])
+    return [(subnet, dispatch_chain_name(pks), sorted(pks)) for subnet, pks in sorted(subnet_rules.items()) if pks]
+
+
+def _build_policies(ruleset, policies, sets=False):
+    # evon-policy dispatches on destination to one chain per distinct set of Rules, which jumps to those Rule chains
+    ruleset.chains[POLICY_CHAIN] = []
+    ruleset.owned_prefixes.append(DISPATCH_PREFIX)
+    for name, (rule_pks, addresses) in sorted(dispatch_targets(policies).items()):
+        ruleset.chains[name] = [f"-j {hub.models.Rule.chain_name_prefix}{pk}" for pk in rule_pks]
+        if sets:
+            ruleset.sets[name] = addresses
+            ruleset.add(POLICY_CHAIN, f"-m set --match-set {name} dst -j {name}")
+            continue
+        for destination in aggregate(addresses):
+            if "-" in destination:
+                ruleset.add(POLICY_CHAIN, f"-m iprange --dst-range {destination} -j {name}")
+            else:
+                ruleset.add(POLICY_CHAIN, f"-d {destination} -j {name}")
+    for subnet, name, rule_pks in dispatch_ranges(policies):
+        ruleset.chains.setdefault(name, [f"-j {hub.models.Rule.chain_name_prefix}{pk}" for pk in rule_pks])
+        ruleset.add(POLICY_CHAIN, f"-d {subnet} -j {name}")
+
+
+def _build_users(ruleset, users):
+    ruleset.chains[USER_CHAIN] = []
+    for pk, address in sorted(users.items()):
+        ruleset.add(USER_CHAIN, f"-d {address}/32 -m comment --comment evon-user-{pk} -j ACCEPT")
+
+
+def build(data, sets=False):
+    """
+    Builds a Ruleset from data returned by load().
+    If `sets` is True, Rule sources and Policy targets are matched using ipsets rather than by address.
+    """
+    scope = data["scope"]
+    ruleset = Ruleset(scope)
+    if MAIN in scope:
+        _build_main(ruleset)
+    own_rules(ruleset, data)
+    sources = {}
+    for pk, rule in data["rules"].items():
+        _build_rule(ruleset, pk, rule, sets=sets)
+        sources[source_name(rule["definition"])] = (rule["sources"], rule["ranges"])
+    source_count = sum(
+        _build_source(ruleset, name, addresses, ranges, sets=sets) for name, (addresses, ranges) in sources.items()
+    )
+    if sources:
+        message = f"{len(data['rules'])} Rules share {len(sources)} source objects"
+        if not sets:
+            address_count = sum(len(addresses) for addresses, _ in sources.values())
+            message += (
+                f", {address_count} source addresses aggregated into {source_count} source matches "
+                f"(compression ratio {address_count / max(source_count, 1):.1f}:1)"
+            )
+        logger.info(message)
+    if POLICIES in scope:
+        _build_policies(ruleset, data["policies"], sets=sets)
+    if USERS in scope:
+        _build_users(ruleset, data["users"])
+    return ruleset
+
+
+def widen_scope(scope, ruleset, live_chains):
+    """
+    Returns `scope` with POLICIES added if applying `ruleset`, compiled from it, deletes a Rule chain among
+    `live_chains`, otherwise `scope` itself. Dispatch chains hold the only references to Rule chains and are
+    named after the Rules they jump to, so they are rebuilt whenever a Rule chain is deleted.
+    """
+    if POLICIES in scope:
+        return scope
+    prefix = hub.models.Rule.chain_name_prefix
+    if any(c.startswith(prefix) and ruleset.owns(c) and c not in ruleset.chains for c in live_chains):
+        return set(scope) | {POLICIES}
+    return scope
+
+
+def compile_ruleset(scope, sets=False):
+    "loads and builds the Ruleset for `scope`"
+    return build(load(scope), sets=sets)
+
+
+def empty(scope):
+    "returns a Ruleset for `scope` as if the DB held no Rules, Policies or shared Users"
+    return build({"scope": frozenset(scope), "rules": {}, "policies": {}, "users": {}})
+
+
+def revocation(scope):
+    """
+    Returns None if applying `scope` can't have revoked access to any destination. Otherwise returns a function(dst)
+    telling whether flows to address `dst` may have lost access, or None if all may have, and the data that
+    permits() needs to evaluate those flows. Access to a destination is governed by the Policies targeting it and their
+    Rules, and to Users by their sharing, so only the full scope is loaded for a scope that holds Policies.
+    Deleted Rules have no Policies left, their deletion widens the scope to POLICIES, see widen_scope().
+    """
+    if set(scope) & {MAIN, RULES, POLICIES}:
+        return None, load(FULL_SCOPE)
+    rule_pks = _rule_pks(scope)
+    policies = _load_policies()
+    addresses = set()
+    networks = [ipaddress.IPv4Network(user_subnet())] if USERS in scope else []
+    for policy in policies.values():
+        if policy["rules"] & rule_pks:
+            addresses.update(policy["targets"])
+            networks.extend(ipaddress.IPv4Network(subnet) for subnet in policy["ranges"])
+    if not addresses and not networks:
+        return None
+
+    def governed(dst):
+        return dst in addresses or any(ipaddress.IPv4Address(dst) in network for network in networks)
+
+    # flows to a governed destination are evaluated against the Rules of every Policy that targets it
+    needed = {}
+    for pk, policy in policies.items():
+        ranges = [ipaddress.IPv4Network(subnet) for subnet in policy["ranges"]]
+        if any(governed(address) for address in policy["targets"]) or \
+                any(r.overlaps(n) for r in ranges for n in networks) or \
+                any(ipaddress.IPv4Address(address) in r for address in addresses for r in ranges):
+            needed[pk] = policy
+    rule_pks = set().union(*[policy["rules"] for policy in needed.values()])
+    return governed, {"rules": _load_rules(rule_pks) if rule_pks else {}, "policies": needed, "users": _load_users()}
+
+
+def permits(data):
+    """
+    Returns a function(src, dst, proto, dport) telling whether the firewall built from `data` permits a flow.
+    `data` must hold the shared Users and every Policy targeting, and Rule applying to, the destinations
+    evaluated, eg. the full scope. Only flows forwarded from the overlay network to a client are evaluated,
+    all others are reported as permitted.
+    """
+    first, last = (ipaddress.IPv4Address(address) for address in overlay_range().split("-"))
+    shared_users = set(data["users"].values())
+    rules = {
+        pk: (rule["sources"], [ipaddress.IPv4Network(subnet) for subnet in rule["ranges"]], rule["protocol"], merge_ports(rule["ports"]))
+        for pk, rule in data["rules"].items()
+    }
+    target_rules = {}
+    for rule_pks, addresses in dispatch_targets(data["policies"]).values():
+        target_rules.update((address, rule_pks) for address in addresses)
+    subnet_rules = [(ipaddress.IPv4Network(subnet), rule_pks) for subnet, _, rule_pks in dispatch_ranges(data["policies"])]
+
+    def permitted(src, dst, proto, dport):
+        try:
+            src_address, dst_address = ipaddress.IPv4Address(src), ipaddress.IPv4Address(dst)
+        except ValueError:
+            return True
+        # client addresses are the third address of each /30 block, see hub.models.vpn_ipv4_addresses()
+        if not first <= src_address <= last or not first <= dst_address <= last or int(dst_address) % 4 != 2:
+            return True
+        if dst in shared_users:
+            return True
+        rule_pks = list(target_rules.get(dst, []))
+        rule_pks += [pk for subnet, pks in subnet_rules if dst_address in subnet for pk in pks]
+        for pk in rule_pks:
+            sources, ranges, protocol, ports = rules[pk]
+            if src not in sources and not any(src_address in subnet for subnet in ranges):
+                continue
+            if protocol not in ["all", proto]:
+                continue
+            if not ports or any(low <= (dport or -1) <= high for low, high in ports):
+                return True
+        return False
+
+    return permitted
+
+
+##### Analysis
+
+def jump_target(spec):
+    "returns the chain or target jumped to by rule `spec`, in iptables-save or nft syntax"
+    parts = spec.split()
+    for keyword in ["-j", "jump"]:
+        if keyword in parts[:-1]:
+            return parts[parts.index(keyword) + 1]
+    return None
+
+
+def walk_costs(ruleset, data):
+    """
+    Estimates, for every Policy target address, the worst-case number of rules evaluated from evon-main onwards
+    by a packet to that address that is denied, ie. one that falls through every rule it is matched against.
+    Jumps are assumed to be taken, except in evon-policy where only the target's own dispatch chain is entered.
+    `ruleset` must be built from `data`, which must cover the full scope.
+    """
+    costs = {}
+
+    def walk(chain_name):
+        if chain_name not in costs:
+            costs[chain_name] = 0
+            costs[chain_name] = sum(
+                1 + (walk(jump_target(spec)) if jump_target(spec) != POLICY_CHAIN else 0)
+                for spec in ruleset.chains.get(chain_name, [])
+            )
+        return costs[chain_name]
+
+    main_cost = walk(MAIN_CHAIN)
+    walks = {}
+    policy_specs = ruleset.chains.get(POLICY_CHAIN, [])
+    for name, (_, addresses) in dispatch_targets(data["policies"]).items():
+        # rules preceding the dispatch rule are evaluated, verdict map lookups cost a single rule
+        position = next((i for i, spec in enumerate(policy_specs) if jump_target(spec) == name), len(policy_specs) - 1)
+        cost = main_cost + position + 1 + walk(name)
+        walks.update((address, cost) for address in addresses)
+    return walks
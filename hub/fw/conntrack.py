@@ -0,0 +1,122 @@
+"""
+In-process conntrack flushing over netlink.
+
+evon-main accepts packets of established flows before any Rule or Policy is evaluated, so revoking access in
+the firewall alone leaves existing flows working until they time out. This module deletes the conntrack entries
+of flows that are no longer permitted using a single netlink dump per call, rather than spawning a `conntrack`
+process per entry.
+"""
+
+from collections import namedtuple
+import errno
+import socket
+
+from pyroute2 import Conntrack
+from pyroute2.netlink.exceptions import NetlinkError
+
+from evon.log import get_evon_logger
+from hub.fw import compiler
+
+
+logger = get_evon_logger()
+
+PROTOCOLS = {
+    socket.IPPROTO_ICMP: "icmp",
+    socket.IPPROTO_TCP: "tcp",
+    socket.IPPROTO_UDP: "udp",
+}
+
+# filters flows by their original direction, fields that are None match anything.
+# `proto` is a protocol name as used by Rules and `dport` is a port or a (first, last) port range
+Flow = namedtuple("Flow", ["src", "dst", "proto", "dport"], defaults=[None, None, None, None])
+
+
+def _matches(flow, src, dst, proto, dport):
+    "returns True if `flow` matches the flow with the given properties"
+    if flow.src is not None and flow.src != src:
+        return False
+    if flow.dst is not None and flow.dst != dst:
+        return False
+    if flow.proto is not None and flow.proto != proto:
+        return False
+    if flow.dport is not None:
+        first, last = flow.dport if isinstance(flow.dport, tuple) else (flow.dport, flow.dport)
+        if dport is None or not first <= dport <= last:
+            return False
+    return True
+
+
+def _sweep(condemned):
+    """
+    Dumps the conntrack table once and deletes every entry for which `condemned(src, dst, proto, dport)` is True.
+    Returns the number of entries deleted.
+    """
+    deleted = 0
+    try:
+        with Conntrack() as ct:
+            entries = [
+                entry for entry in ct.dump_entries()
+                if condemned(
+                    entry.tuple_orig.saddr,
+                    entry.tuple_orig.daddr,
+                    PROTOCOLS.get(entry.tuple_orig.proto, str(entry.tuple_orig.proto)),
+                    entry.tuple_orig.dport,
+                )
+            ]
+            for entry in entries:
+                try:
+                    ct.delete(entry)
+                    deleted += 1
+                except NetlinkError as e:
+                    # the entry expired since it was dumped
+                    if e.code != errno.ENOENT:
+                        raise
+    except (NetlinkError, OSError) as e:
+        logger.warning(f"unable to flush conntrack entries: {e}")
+    return deleted
+
+
+def flush(flows):
+    """
+    Deletes the conntrack entries of all flows matching any of `flows`.
+    Returns the number of entries deleted.
+    """
+    by_dst = {}
+    for flow in flows:
+        by_dst.setdefault(flow.dst, []).append(flow)
+    if not by_dst:
+        return 0
+
+    def condemned(src, dst, proto, dport):
+        candidates = by_dst.get(dst, []) + by_dst.get(None, [])
+        return any(_matches(flow, src, dst, proto, dport) for flow in candidates)
+
+    deleted = _sweep(condemned)
+    logger.info(f"flushed {deleted} conntrack entries matching {sum(len(f) for f in by_dst.values())} filters")
+    return deleted
+
+
+def revoke(permits):
+    """
+    Deletes the conntrack entries of all flows that `permits(src, dst, proto, dport)` does not allow.
+    Returns the number of entries deleted.
+    """
+    deleted = _sweep(lambda *flow: not permits(*flow))
+    logger.info(f"flushed {deleted} conntrack entries of revoked flows")
+    return deleted
+
+
+def revoke_unpermitted(scope=compiler.FULL_SCOPE):
+    """
+    Deletes the conntrack entries of overlay flows that the firewall, as compiled from the DB, no longer permits.
+    Only the flows to destinations whose access `scope` governs are evaluated, see compiler.revocation(), and
+    the conntrack table isn't dumped at all if it governs none.
+    """
+    revocation = compiler.revocation(scope)
+    if revocation is None:
+        return 0
+    governed, data = revocation
+    permitted = compiler.permits(data)
+    if governed is None:
+        return revoke(permitted)
+    return revoke(lambda src, dst, proto, dport: not governed(dst) or permitted(src, dst, proto, dport))
@@ -0,0 +1,155 @@
+"""
+Firewall drift detection.
+
+After every commit the engines record a fingerprint of each evon chain, set and map they applied in a state
+file per backend. detect() re-hashes the kernel's evon objects, which costs one save/list call and no DB
+queries, and reports those whose fingerprint differs from the last applied state, eg. after manual iptables
+edits.
+scope_for() maps drifted objects back to the compile scope that rebuilds them.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from eapi.settings import EVON_HUB_CONFIG
+from evon.log import get_evon_logger
+from hub.fw import compiler
+import hub.models
+
+
+logger = get_evon_logger()
+
+
+def fingerprint(content):
+    "returns a short hash of `content`, a list of rule specs or a set of members"
+    if isinstance(content, (set, frozenset)):
+        content = sorted(content)
+    elif isinstance(content, dict):
+        content = [f"{k} : {v}" for k, v in sorted(content.items())]
+    return hashlib.sha1("\n".join(content).encode("utf-8")).hexdigest()[:16]
+
+
+def fingerprints(objects):
+    """
+    Takes a dict of {"chains": ..., "sets": ..., "maps": ...} and returns a dict of object key -> fingerprint,
+    where object keys are of the form "chain:<name>", "set:<name>" or "map:<name>"
+    """
+    return {
+        f"{kind[:-1]}:{name}": fingerprint(content)
+        for kind in ["chains", "sets", "maps"]
+        for name, content in objects.get(kind, {}).items()
+    }
+
+
+def _path(backend):
+    return os.path.join(EVON_HUB_CONFIG["FIREWALL_STATE_DIR"], f"fingerprints-{backend}.json")
+
+
+def _empty_state():
+    return {"fingerprints": {}, "drift_events": 0, "drift_counts": {}, "last_drift": None}
+
+
+@contextmanager
+def _locked_state(backend):
+    """
+    Yields the state dict of `backend` under an exclusive lock and writes it back atomically, so that
+    concurrent web workers and CLI invocations don't lose each other's updates.
+    The state is advisory, failures to write it are logged rather than raised.
+    """
+    lock = None
+    try:
+        os.makedirs(EVON_HUB_CONFIG["FIREWALL_STATE_DIR"], exist_ok=True)
+        lock = open(f"{_path(backend)}.lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except OSError as e:
+        logger.warning(f"unable to lock firewall state in {_path(backend)}: {e}")
+    try:
+        state = read_state(backend) or _empty_state()
+        yield state
+        if lock:
+            tmp_path = f"{_path(backend)}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, _path(backend))
+    except OSError as e:
+        logger.warning(f"unable to update firewall state in {_path(backend)}: {e}")
+    finally:
+        if lock:
+            lock.close()
+
+
+def read_state(backend):
+    "returns the recorded state of `backend`, or None if nothing has been recorded yet"
+    try:
+        with open(_path(backend)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def recorded(backend):
+    "returns True if applied state is recorded for `backend`, ie. its objects are in the kernel"
+    state = read_state(backend)
+    return bool(state and state["fingerprints"])
+
+
+def record(backend, ruleset, objects):
+    """
+    Records the fingerprints of `objects`, the desired evon objects of `ruleset` as returned by an engine's
+    desired_objects(), as the last applied state. Recorded objects owned by `ruleset` but absent from
+    `objects` are forgotten.
+    """
+    applied = fingerprints(objects)
+    with _locked_state(backend) as state:
+        for key in list(state["fingerprints"]):
+            if key not in applied and ruleset.owns(key.split(":", 1)[1]):
+                del state["fingerprints"][key]
+        state["fingerprints"].update(applied)
+
+
+def clear(backend):
+    "forgets all recorded fingerprints, eg. after the evon firewall objects are deleted altogether"
+    with _locked_state(backend) as state:
+        state["fingerprints"] = {}
+
+
+def detect(backend, live_objects):
+    """
+    Compares `live_objects`, as returned by an engine's live_objects(), with the last applied state.
+    Returns a sorted list of drifted object keys, or None if no state has been recorded for `backend`.
+    """
+    state = read_state(backend)
+    if state is None or not state["fingerprints"]:
+        return None
+    live = fingerprints(live_objects)
+    recorded = state["fingerprints"]
+    return sorted(key for key in set(recorded) | set(live) if recorded.get(key) != live.get(key))
+
+
+def count(backend, drifted):
+    "adds `drifted` object keys to the drift event counters"
+    with _locked_state(backend) as state:
+        state["drift_events"] += len(drifted)
+        for key in drifted:
+            state["drift_counts"][key] = state["drift_counts"].get(key, 0) + 1
+        state["last_drift"] = time.time()
+
+
+def scope_for(key):
+    "returns the scope key that rebuilds drifted object `key`"
+    name = key.split(":", 1)[1]
+    rule_prefix = hub.models.Rule.chain_name_prefix
+    if name.startswith(rule_prefix) and name[len(rule_prefix):].isdigit():
+        return compiler.rule_key(int(name[len(rule_prefix):]))
+    if name.startswith(compiler.SOURCE_PREFIX):
+        return compiler.RULES
+    if name == compiler.POLICY_CHAIN or name.startswith(compiler.DISPATCH_PREFIX) or key.startswith("map:"):
+        return compiler.POLICIES
+    if name == compiler.USER_CHAIN or key.startswith("set:") and not name.startswith("evon-"):
+        # the evon-user chain, or the nftables shared users set
+        return compiler.USERS
+    return compiler.MAIN
@@ -0,0 +1,67 @@
+"""
+ipset helpers for the iptables-restore firewall engine.
+
+The resolved addresses of each shared Rule source are kept in a hash:ip set so that Rule chains need only one
+`-m set --match-set` rule per port match, and membership changes become ipset add/del operations.
+The target addresses of each Policy dispatch chain are kept in a set of the same name.
+"""
+
+from hub.fw.shell import run
+
+
+IPSET_SAVE = ["ipset", "save"]
+IPSET_RESTORE = ["ipset", "restore", "-exist"]
+SET_TYPE = "hash:ip"
+
+
+def parse(text):
+    """
+    Parses ipset save output and returns a dict of set name -> set of members
+    """
+    sets = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == "create":
+            sets.setdefault(parts[1], set())
+        elif len(parts) >= 3 and parts[0] == "add":
+            sets.setdefault(parts[1], set()).add(parts[2])
+    return sets
+
+
+def read_sets():
+    "returns all live ipsets as parsed by parse()"
+    return parse(run(IPSET_SAVE))
+
+
+def diff(ruleset, live):
+    """
+    Compares the sets owned by `ruleset` with the `live` sets and returns the ipset restore commands that
+    reconcile them as a tuple of (before, after, added, removed).
+
+    `before` creates and updates sets and must be committed before the iptables rules that reference them,
+    `after` destroys obsolete sets once they are unreferenced. `added` and `removed` count set members.
+    """
+    before = []
+    added = removed = 0
+    for name, members in ruleset.sets.items():
+        current = live.get(name)
+        if current is None:
+            before.append(f"create {name} {SET_TYPE}")
+            current = set()
+        additions = sorted(members - current)
+        deletions = sorted(current - members)
+        before.extend(f"add {name} {member}" for member in additions)
+        before.extend(f"del {name} {member}" for member in deletions)
+        added += len(additions)
+        removed += len(deletions)
+    after = [f"destroy {name}" for name in live if ruleset.owns(name) and name not in ruleset.sets]
+    return before, after, added, removed
+
+
+def render(lines):
+    return "\n".join(lines + [""])
+
+
+def commit(payload):
+    "commits `payload` using ipset restore"
+    run(IPSET_RESTORE, payload)
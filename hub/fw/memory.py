@@ -0,0 +1,525 @@
+"""
+In-memory stand-in for the kernel firewall.
+
+A Kernel holds an iptables filter table, ipsets and an nftables evon table, and understands the commands run by
+the compiled engines (iptables-save/-restore, ipset save/restore and nft list/-f). Install it with
+hub.fw.shell.set_runner() to exercise hub.firewall without root or a real kernel. Each restore or nft payload
+is applied atomically like the real thing and rejected with FirewallError if the kernel would reject it,
+eg. deleting a missing rule or a chain that is still referenced. Commands are counted in `commits` and `reads`.
+
+iptc_module() returns a stand-in for python-iptables that works on the filter table of the installed Kernel,
+so that the iptc backend can be exercised the same way. Install it as sys.modules["iptc"] before importing
+hub.firewall.
+"""
+
+from collections import Counter
+import copy
+import functools
+import ipaddress
+import types
+
+from hub.exceptions import FirewallError
+from hub.fw import shell
+
+
+BUILTIN_CHAINS = ["INPUT", "FORWARD", "OUTPUT"]
+BUILTIN_TARGETS = ["ACCEPT", "DROP", "REJECT", "RETURN", "LOG"]
+
+
+def _elements(text):
+    "returns the elements of an nft `{ a, b }` list"
+    return [element.strip() for element in text.strip().strip("{}").split(",") if element.strip()]
+
+
+class Kernel:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        "empties all tables and counters"
+        self.table = {name: [] for name in BUILTIN_CHAINS}
+        self.sets = {}
+        self.nft = None
+        self.clear_counters()
+
+    def clear_counters(self):
+        self.commits = Counter()
+        self.reads = Counter()
+
+    def __call__(self, cmd, payload=None):
+        "runs `cmd` as hub.fw.shell.run() would, returning its output"
+        tool = cmd[0]
+        if tool == "iptables-save":
+            self.reads[tool] += 1
+            return self._iptables_save()
+        if tool == "iptables-restore":
+            self.commits[tool] += 1
+            self.table = self._iptables_restore(payload)
+            return ""
+        if tool == "ipset" and cmd[1] == "save":
+            self.reads[tool] += 1
+            return "".join(
+                f"create {name} hash:ip\n" + "".join(f"add {name} {member}\n" for member in sorted(members))
+                for name, members in self.sets.items()
+            )
+        if tool == "ipset" and cmd[1] == "restore":
+            self.commits[tool] += 1
+            self.sets = self._ipset_restore(payload)
+            return ""
+        if cmd[:2] == ["nft", "list"]:
+            self.reads[tool] += 1
+            if cmd[2] == "tables":
+                return "table ip evon\n" if self.nft is not None else ""
+            if self.nft is None:
+                raise FirewallError("nft failed with rc 1: No such file or directory")
+            return self._nft_list()
+        if cmd[:2] == ["nft", "-f"]:
+            self.commits[tool] += 1
+            self.nft = self._nft_apply(payload)
+            return ""
+        raise FirewallError(f"{tool} is not supported by the in-memory kernel")
+
+    def rule_count(self):
+        "returns the number of iptables rules and nftables statements held"
+        count = sum(len(specs) for specs in self.table.values())
+        if self.nft is not None:
+            count += sum(len(statements) for statements in self.nft["chains"].values())
+        return count
+
+    ##### iptables and ipset
+
+    def _iptables_save(self):
+        lines = ["*filter"]
+        lines.extend(f":{name} {'ACCEPT' if name in BUILTIN_CHAINS else '-'} [0:0]" for name in self.table)
+        lines.extend(f"-A {name} {spec}" for name, specs in self.table.items() for spec in specs)
+        return "\n".join(lines + ["COMMIT", ""])
+
+    def _iptables_restore(self, payload):
+        table = copy.deepcopy(self.table)
+        for line in payload.splitlines():
+            if not line or line.startswith(("*", "#")) or line == "COMMIT":
+                continue
+            if line.startswith(":"):
+                # declaring a chain creates it, or flushes it under --noflush
+                table[line[1:].split()[0]] = []
+                continue
+            op, _, rest = line.partition(" ")
+            name, _, spec = rest.partition(" ")
+            if name not in table:
+                raise FirewallError(f"iptables-restore failed with rc 1: chain {name} does not exist: {line}")
+            if op == "-A":
+                table[name].append(spec)
+            elif op == "-I":
+                table[name].insert(0, spec)
+            elif op == "-D":
+                if spec not in table[name]:
+                    raise FirewallError(f"iptables-restore failed with rc 1: Bad rule: {line}")
+                table[name].remove(spec)
+            elif op == "-F":
+                table[name] = []
+            elif op == "-X":
+                if table[name] or any(self._jumps_to(spec, name) for specs in table.values() for spec in specs):
+                    raise FirewallError(f"iptables-restore failed with rc 1: chain {name} is not empty or in use")
+                del table[name]
+            else:
+                raise FirewallError(f"iptables-restore failed with rc 1: unknown command: {line}")
+        for name, specs in table.items():
+            for spec in specs:
+                parts = spec.split()
+                target = parts[parts.index("-j") + 1] if "-j" in parts[:-1] else None
+                if target and target not in table and target not in BUILTIN_TARGETS:
+                    raise FirewallError(f"iptables-restore failed with rc 2: Couldn't load target `{target}'")
+                if "--match-set" in parts[:-1] and parts[parts.index("--match-set") + 1] not in self.sets:
+                    raise FirewallError(f"iptables-restore failed with rc 2: Set {parts[parts.index('--match-set') + 1]} doesn't exist")
+        return table
+
+    @staticmethod
+    def _jumps_to(spec, name):
+        parts = spec.split()
+        return "-j" in parts[:-1] and parts[parts.index("-j") + 1] == name
+
+    def _ipset_restore(self, payload):
+        sets = copy.deepcopy(self.sets)
+        for line in payload.splitlines():
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "create":
+                sets.setdefault(parts[1], set())
+            elif parts[1] not in sets:
+                raise FirewallError(f"ipset failed with rc 1: The set with the given name does not exist: {line}")
+            elif parts[0] == "add":
+                sets[parts[1]].add(parts[2])
+            elif parts[0] == "del":
+                sets[parts[1]].discard(parts[2])
+            elif parts[0] == "destroy":
+                if any(f"--match-set {parts[1]} " in spec for specs in self.table.values() for spec in specs):
+                    raise FirewallError("ipset failed with rc 1: Set cannot be destroyed: it is in use by a kernel component")
+                del sets[parts[1]]
+            else:
+                raise FirewallError(f"ipset failed with rc 1: unknown command: {line}")
+        return sets
+
+    ##### nftables
+
+    def _nft_list(self):
+        table = self.nft
+        lines = ["table ip evon {"]
+        for name, devices in table["flowtables"].items():
+            lines += [f"\tflowtable {name} {{", "\t\thook ingress priority filter", f"\t\tdevices = {{ {', '.join(sorted(devices))} }}", "\t}"]
+        for name, members in table["sets"].items():
+            lines += [f"\tset {name} {{", "\t\ttype ipv4_addr"]
+            if members:
+                lines.append(f"\t\telements = {{ {', '.join(sorted(members))} }}")
+            lines.append("\t}")
+        for name, elements in table["maps"].items():
+            lines += [f"\tmap {name} {{", "\t\ttype ipv4_addr : verdict"]
+            if elements:
+                lines.append(f"\t\telements = {{ {', '.join(f'{k} : {v}' for k, v in sorted(elements.items()))} }}")
+            lines.append("\t}")
+        for name, statements in table["chains"].items():
+            lines.append(f"\tchain {name} {{")
+            if name in table["hooks"]:
+                lines.append(f"\t\t{table['hooks'][name]}")
+            lines.extend(f"\t\t{statement}" for statement in statements)
+            lines.append("\t}")
+        return "\n".join(lines + ["}", ""])
+
+    def _nft_apply(self, payload):
+        table = copy.deepcopy(self.nft)
+        for line in payload.splitlines():
+            words = line.split()
+            if not words:
+                continue
+            verb, kind = words[:2]
+            if kind == "table":
+                if verb == "add":
+                    table = table or {"chains": {}, "hooks": {}, "sets": {}, "maps": {}, "flowtables": {}}
+                elif verb == "delete":
+                    table = None
+                continue
+            if table is None:
+                raise FirewallError(f"nft failed with rc 1: No such file or directory: {line}")
+            name, rest = words[4], " ".join(words[5:])
+            self._nft_command(table, verb, kind, name, rest, line)
+        return table
+
+    @staticmethod
+    def _nft_command(table, verb, kind, name, rest, line):
+        def fail(reason):
+            raise FirewallError(f"nft failed with rc 1: {reason}: {line}")
+
+        def referenced(target):
+            statements = [s for chain_statements in table["chains"].values() for s in chain_statements]
+            verdicts = [v for elements in table["maps"].values() for v in elements.values()]
+            return any(f"@{target}" in s.split() or s.endswith(f"jump {target}") for s in statements) or f"jump {target}" in verdicts
+
+        if (verb, kind) == ("add", "chain"):
+            table["chains"].setdefault(name, [])
+            if rest:
+                table["hooks"][name] = rest.strip("{} ")
+        elif (verb, kind) in [("add", "set"), ("add", "map")]:
+            table[f"{kind}s"].setdefault(name, set() if kind == "set" else {})
+        elif (verb, kind) == ("add", "flowtable"):
+            table["flowtables"][name] = set(_elements(rest.split("devices = ")[1].split("}")[0]))
+        elif kind == "element":
+            if name in table["sets"]:
+                members = _elements(rest)
+                if verb == "delete" and not set(members) <= table["sets"][name]:
+                    fail("Could not process rule: No such file or directory")
+                if verb == "add":
+                    table["sets"][name].update(members)
+                else:
+                    table["sets"][name].difference_update(members)
+            elif name in table["maps"]:
+                for element in _elements(rest):
+                    key, _, verdict = element.partition(" : ")
+                    if verb == "add":
+                        if verdict.startswith("jump ") and verdict[5:] not in table["chains"]:
+                            fail("Could not process rule: No such file or directory")
+                        table["maps"][name][key] = verdict
+                    elif table["maps"][name].pop(key, None) is None:
+                        fail("Could not process rule: No such file or directory")
+            else:
+                fail("Could not process rule: No such file or directory")
+        elif verb == "flush" and kind == "chain":
+            if name not in table["chains"]:
+                fail("Could not process rule: No such file or directory")
+            table["chains"][name] = []
+        elif (verb, kind) == ("add", "rule"):
+            if name not in table["chains"]:
+                fail("Could not process rule: No such file or directory")
+            words = rest.split()
+            missing_sets = [w[1:] for w in words if w.startswith("@") and w[1:] not in table["sets"] and w[1:] not in table["maps"] and w[1:] not in table["flowtables"]]
+            missing_chains = [words[i + 1] for i, w in enumerate(words[:-1]) if w == "jump" and words[i + 1] not in table["chains"]]
+            if missing_sets or missing_chains:
+                fail("Could not process rule: No such file or directory")
+            table["chains"][name].append(rest)
+        elif verb == "delete" and kind in ["chain", "set", "flowtable"]:
+            objects = table[f"{kind}s"]
+            if name not in objects:
+                fail("Could not process rule: No such file or directory")
+            if (kind == "chain" and objects[name]) or referenced(name):
+                fail("Could not process rule: Device or resource busy")
+            del objects[name]
+            if kind == "chain":
+                table["hooks"].pop(name, None)
+        else:
+            fail("unsupported command")
+
+
+##### python-iptables
+
+class Match:
+    "a match of an iptc Rule, parameters are set and read as attributes, unset ones read as None"
+
+    def __init__(self, rule, name):
+        self.__dict__.update(rule=rule, name=name, parameters={})
+
+    def __getattr__(self, name):
+        return self.parameters.get(name.replace("_", "-"))
+
+    def __setattr__(self, name, value):
+        self.parameters[name.replace("_", "-")] = value
+
+
+class Target:
+
+    def __init__(self, rule, name):
+        self.rule = rule
+        self.name = name
+
+
+@functools.lru_cache(maxsize=None)
+def _network(address):
+    "parsing is the bulk of reading a rule and each address appears in many of them"
+    return ipaddress.IPv4Network(address)
+
+
+class Rule:
+    "an iptc Rule, addresses read in address/netmask form as python-iptables returns them"
+
+    def __init__(self):
+        self._src = self._dst = None
+        self.protocol = "ip"
+        self.matches = []
+        self.target = None
+
+    @staticmethod
+    def _address(network):
+        return f"{network.network_address}/{network.netmask}" if network else "0.0.0.0/0.0.0.0"
+
+    src = property(lambda self: self._address(self._src), lambda self, v: setattr(self, "_src", _network(v)))
+    dst = property(lambda self: self._address(self._dst), lambda self, v: setattr(self, "_dst", _network(v)))
+
+    def create_match(self, name):
+        match = Match(self, name)
+        self.add_match(match)
+        return match
+
+    def add_match(self, match):
+        self.matches.append(match)
+
+    def spec(self):
+        "returns this rule in iptables-save syntax"
+        parts = []
+        if self._src:
+            parts += ["-s", self._src.with_prefixlen]
+        if self._dst:
+            parts += ["-d", self._dst.with_prefixlen]
+        if self.protocol != "ip":
+            parts += ["-p", self.protocol]
+        for match in self.matches:
+            parts += ["-m", match.name]
+            for name, value in match.parameters.items():
+                parts += [f"--{name}", value]
+        if self.target:
+            parts += ["-j", self.target.name]
+        return " ".join(parts)
+
+    @classmethod
+    def parse(cls, spec):
+        "returns the Rule of `spec`, in the subset of iptables-save syntax that spec() renders"
+        rule = cls()
+        parts = spec.split()
+        match = None
+        for option, value in zip(parts[::2], parts[1::2]):
+            if option == "-s":
+                rule.src = value
+            elif option == "-d":
+                rule.dst = value
+            elif option == "-p":
+                rule.protocol = value
+            elif option == "-m":
+                match = rule.create_match(value)
+            elif option == "-j":
+                rule.target = Target(rule, value)
+            else:
+                match.parameters[option[2:]] = value
+        return rule
+
+    def parameters(self):
+        "returns this rule as easy.dump_table() does, match parameters are lists of values"
+        rule = {}
+        if self._src:
+            rule["src"] = self._src.with_prefixlen
+        if self._dst:
+            rule["dst"] = self._dst.with_prefixlen
+        if self.protocol != "ip":
+            rule["protocol"] = self.protocol
+        for match in self.matches:
+            rule[match.name] = {name: value.split() for name, value in match.parameters.items()}
+        if self.target:
+            rule["target"] = self.target.name
+        return rule
+
+
+class Table:
+    """
+    An iptc Table, one per name like python-iptables. Changes are committed to the Kernel installed with
+    hub.fw.shell.set_runner() one at a time, or on commit() if `autocommit` is False. Each commit is counted
+    as an "iptc" commit and each refresh as an "iptc" read.
+    """
+
+    FILTER = "filter"
+    _tables = {}
+
+    def __new__(cls, name, autocommit=None):
+        if name != cls.FILTER:
+            raise FirewallError(f"the in-memory kernel has no {name} table")
+        table = cls._tables.get(name)
+        if not table:
+            table = cls._tables[name] = super().__new__(cls)
+            table.name = name
+            table.autocommit = True
+            table._kernel = None
+            table._pending = {}
+        if autocommit is not None:
+            table.autocommit = autocommit
+        return table
+
+    @property
+    def kernel(self):
+        if not isinstance(shell.runner, Kernel):
+            raise FirewallError("the iptc stand-in needs a memory.Kernel installed with hub.fw.shell.set_runner()")
+        if shell.runner is not self._kernel:
+            self._kernel, self._pending = shell.runner, {}
+        return self._kernel
+
+    def _specs(self, chain_name):
+        "returns the rule specs of `chain_name`, as changed since the last commit"
+        specs = self._pending.get(chain_name, self.kernel.table.get(chain_name))
+        if specs is None:
+            raise FirewallError(f"iptc: chain {chain_name} does not exist")
+        return specs
+
+    def _change(self, chain_name, specs):
+        self._pending[chain_name] = specs
+        if self.autocommit:
+            self.commit()
+
+    def _chain_names(self):
+        names = [name for name in self.kernel.table if self._pending.get(name, True) is not None]
+        return names + [name for name, specs in self._pending.items() if name not in self.kernel.table and specs is not None]
+
+    @property
+    def chains(self):
+        return [Chain(self, name) for name in self._chain_names()]
+
+    def is_chain(self, chain_name):
+        return self._pending.get(chain_name, self.kernel.table.get(chain_name)) is not None
+
+    def create_chain(self, chain_name):
+        if self.is_chain(chain_name):
+            raise FirewallError(f"iptc: chain {chain_name} already exists")
+        self._change(chain_name, [])
+        return Chain(self, chain_name)
+
+    def delete_chain(self, chain):
+        chain_name = getattr(chain, "name", chain)
+        if self._specs(chain_name):
+            raise FirewallError(f"iptc: chain {chain_name} is not empty")
+        for name in self._chain_names():
+            if any(_jump(spec) == chain_name for spec in self._specs(name)):
+                raise FirewallError(f"iptc: chain {chain_name} is referenced by {name}")
+        self._change(chain_name, None)
+
+    def refresh(self):
+        "discards uncommitted changes"
+        self.kernel.reads["iptc"] += 1
+        self._pending = {}
+
+    def commit(self):
+        table = dict(self.kernel.table)
+        for chain_name, specs in self._pending.items():
+            if specs is None:
+                del table[chain_name]
+            else:
+                table[chain_name] = specs
+        self.kernel.table = table
+        self.kernel.commits["iptc"] += 1
+        self._pending = {}
+
+
+class Chain:
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    @property
+    def rules(self):
+        return [Rule.parse(spec) for spec in self.table._specs(self.name)]
+
+    def _check(self, rule):
+        target = rule.target and rule.target.name
+        if target and target not in BUILTIN_TARGETS and not self.table.is_chain(target):
+            raise FirewallError(f"iptc: chain {self.name} can't jump to missing chain {target}")
+
+    def insert_rule(self, rule, position=0):
+        self._check(rule)
+        specs = list(self.table._specs(self.name))
+        specs.insert(position, rule.spec())
+        self.table._change(self.name, specs)
+
+    def append_rule(self, rule):
+        self._check(rule)
+        self.table._change(self.name, self.table._specs(self.name) + [rule.spec()])
+
+    def delete_rule(self, rule):
+        specs = list(self.table._specs(self.name))
+        if rule.spec() not in specs:
+            raise FirewallError(f"iptc: no such rule in chain {self.name}: {rule.spec()}")
+        specs.remove(rule.spec())
+        self.table._change(self.name, specs)
+
+    def flush(self):
+        self.table._change(self.name, [])
+
+
+def _jump(spec):
+    "returns the chain or target `spec` jumps to, spec() renders it last"
+    option, _, target = spec.rpartition(" ")
+    return target if option == "-j" or option.endswith(" -j") else None
+
+
+def _refreshed(table_name):
+    table = Table(table_name)
+    table.refresh()
+    return table
+
+
+def iptc_module():
+    "returns a stand-in for the python-iptables module `iptc`, see Table"
+    easy = types.SimpleNamespace(
+        get_chains=lambda table: _refreshed(table)._chain_names(),
+        add_chain=lambda table, chain: _refreshed(table).create_chain(chain),
+        flush_chain=lambda table, chain: Chain(_refreshed(table), chain).flush(),
+        dump_table=lambda table: {
+            chain.name: [rule.parameters() for rule in chain.rules] for chain in _refreshed(table).chains
+        },
+    )
+    module = types.ModuleType("iptc", "in-memory stand-in for python-iptables, see hub.fw.memory")
+    module.__dict__.update(Table=Table, Chain=Chain, Rule=Rule, Match=Match, Target=Target, easy=easy)
+    return module
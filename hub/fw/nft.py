@@ -0,0 +1,350 @@
+"""
+nftables firewall engine.
+
+Expresses the evon firewall natively in an nftables table and applies it in a single `nft -f`
+transaction. Rule sources are named sets, evon-policy dispatches on destination address through a
+verdict map, and shared user devices are matched with a single set lookup, so per-packet cost no
+longer grows with the number of Rules, Policies or Users.
+
+If EVON_HUB_CONFIG["FIREWALL_FLOWTABLE"] is set, established overlay flows are also offloaded to a flowtable
+so that their packets skip the forward chain altogether. Offloaded flows are torn down along with their
+conntrack entries, so revoked flows are still cut off by hub.fw.conntrack.
+"""
+
+import os
+import time
+
+from eapi.settings import EVON_HUB_CONFIG
+from evon.log import get_evon_logger
+from hub.fw import compiler, conntrack, drift, snapshot
+from hub.fw.shell import run
+import hub.models
+
+
+logger = get_evon_logger()
+
+NAME = "nftables"
+TABLE = "ip evon"
+FORWARD_CHAIN = "forward"
+POLICY_MAP = "policy-targets"
+SHARED_USERS_SET = "shared-users"
+# the fast path is managed from configuration rather than compiled, see _diff_fastpath()
+FASTPATH_CHAIN = "fastpath"
+FLOWTABLE = "fastpath"
+NFT_LIST_TABLES = ["nft", "list", "tables", "ip"]
+NFT_LIST_TABLE = ["nft", "list", "table", "ip", "evon"]
+NFT_APPLY = ["nft", "-f", "-"]
+
+
+def build(data):
+    """
+    Builds a Ruleset of nft rule statements, sets and verdict maps from data returned by compiler.load()
+    """
+    scope = data["scope"]
+    ruleset = compiler.Ruleset(scope)
+    rule_prefix = hub.models.Rule.chain_name_prefix
+    overlay = compiler.overlay_range()
+    if compiler.MAIN in scope:
+        ruleset.chains[FORWARD_CHAIN] = [
+            f"ip saddr {overlay} ip daddr @{SHARED_USERS_SET} accept",
+            f"ip saddr {overlay} jump {compiler.MAIN_CHAIN}",
+        ]
+        ruleset.chains[compiler.MAIN_CHAIN] = [
+            "ct state established,related accept",
+            f"jump {compiler.POLICY_CHAIN}",
+            f"ip saddr {overlay} drop",
+        ]
+    compiler.own_rules(ruleset, data)
+    for pk, rule in data["rules"].items():
+        name = f"{rule_prefix}{pk}"
+        protocol = rule["protocol"]
+        # Rules with the same source definition share one source set
+        source = compiler.source_name(rule["definition"])
+        ruleset.sets[source] = set(rule["sources"])
+        ruleset.chains[name] = []
+        # virtual group subnets are matched by prefix, see compiler.virtual_sources()
+        for match in [f"ip saddr @{source}"] + [f"ip saddr {subnet}" for subnet in rule["ranges"]]:
+            if rule["ports"]:
+                # all ports are matched by a single anonymous set
+                ports = [str(first) if first == last else f"{first}-{last}" for first, last in compiler.merge_ports(rule["ports"])]
+                portspec = ports[0] if len(ports) == 1 else f"{{ {', '.join(ports)} }}"
+                ruleset.add(name, f"{match} {protocol} dport {portspec} accept")
+            elif protocol != "all":
+                ruleset.add(name, f"{match} ip protocol {protocol} accept")
+            else:
+                ruleset.add(name, f"{match} accept")
+    if compiler.POLICIES in scope:
+        # each target address maps to a dispatch chain jumping to every Rule chain that applies to it
+        ruleset.owned_prefixes.append(compiler.DISPATCH_PREFIX)
+        ruleset.chains[compiler.POLICY_CHAIN] = [f"ip daddr vmap @{POLICY_MAP}"]
+        ruleset.maps[POLICY_MAP] = {}
+        for name, (rule_pks, addresses) in sorted(compiler.dispatch_targets(data["policies"]).items()):
+            ruleset.chains[name] = [f"jump {rule_prefix}{pk}" for pk in rule_pks]
+            ruleset.maps[POLICY_MAP].update((address, f"jump {name}") for address in addresses)
+        for subnet, name, rule_pks in compiler.dispatch_ranges(data["policies"]):
+            ruleset.chains.setdefault(name, [f"jump {rule_prefix}{pk}" for pk in rule_pks])
+            ruleset.add(compiler.POLICY_CHAIN, f"ip daddr {subnet} jump {name}")
+    if compiler.USERS in scope:
+        ruleset.sets[SHARED_USERS_SET] = set(data["users"].values())
+    return ruleset
+
+
+def parse(text):
+    """
+    Parses `nft list table` output and returns a dict with the table's chains (name -> list of statements),
+    sets (name -> set of elements), maps (name -> dict of key -> verdict) and flowtables (name -> set of devices)
+    """
+    live = {"chains": {}, "sets": {}, "maps": {}, "flowtables": {}}
+    kind = name = None
+    elements = None
+    for line in text.splitlines():
+        line = line.strip()
+        if elements is not None:
+            # continuation of a multi-line elements list
+            elements += " " + line
+        elif line.startswith(("chain ", "set ", "map ", "flowtable ")) and line.endswith("{"):
+            kind, name = line.split()[:2]
+            if kind == "chain":
+                live["chains"][name] = []
+            elif kind == "set":
+                live["sets"][name] = set()
+            elif kind == "map":
+                live["maps"][name] = {}
+            else:
+                live["flowtables"][name] = set()
+            continue
+        elif kind == "flowtable" and line.startswith("devices = "):
+            live["flowtables"][name] = {d.strip() for d in line[len("devices = "):].strip("{} ").split(",") if d.strip()}
+            continue
+        elif line == "}":
+            kind = name = None
+            continue
+        elif kind == "chain" and line and not line.startswith("type "):
+            live["chains"][name].append(line)
+            continue
+        elif kind in ["set", "map"] and line.startswith("elements = {"):
+            elements = line[len("elements = "):]
+        else:
+            continue
+        if elements.endswith("}"):
+            for element in [e.strip() for e in elements.strip("{} ").split(",") if e.strip()]:
+                if kind == "set":
+                    live["sets"][name].add(element)
+                else:
+                    key, _, verdict = element.partition(" : ")
+                    live["maps"][name][key] = verdict
+            elements = None
+    return live
+
+
+def read_table():
+    "returns the live evon table as parsed by parse()"
+    if "table ip evon" not in run(NFT_LIST_TABLES).splitlines():
+        return {"chains": {}, "sets": {}, "maps": {}, "flowtables": {}}
+    return parse(run(NFT_LIST_TABLE))
+
+
+def desired_objects(ruleset):
+    "returns the chains, sets and maps of `ruleset` in the shape of live_objects()"
+    return {"chains": ruleset.chains, "sets": ruleset.sets, "maps": ruleset.maps}
+
+
+def live_objects():
+    "returns the compiled chains, sets and maps of the evon table in the kernel"
+    live = read_table()
+    live["chains"].pop(FASTPATH_CHAIN, None)
+    return live
+
+
+def _elements(members):
+    "formats `members` as the body of an nft element list"
+    return ", ".join(sorted(members))
+
+
+def flowtable_devices():
+    "returns the configured flowtable devices that exist, or an empty list if the flowtable is disabled"
+    if not EVON_HUB_CONFIG["FIREWALL_FLOWTABLE"]:
+        return []
+    return [device for device in EVON_HUB_CONFIG["FIREWALL_FLOWTABLE_DEVICES"] if os.path.exists(f"/sys/class/net/{device}")]
+
+
+def _diff_fastpath(live):
+    """
+    Returns the nft commands that reconcile the flowtable and the base chain offloading flows to it with the
+    configuration, along with the number of rules they add and remove.
+    The chain runs ahead of the forward chain and only offloads flows that evon-main already accepts.
+    """
+    devices = set(flowtable_devices())
+    overlay = compiler.overlay_range()
+    statements = [
+        f"ip saddr {overlay} ip daddr {overlay} ct state established meta l4proto {{ tcp, udp }} flow add @{FLOWTABLE}"
+    ] if devices else []
+    current = live["chains"].get(FASTPATH_CHAIN)
+    current_devices = live.get("flowtables", {}).get(FLOWTABLE)
+    if current_devices == (devices or None) and current == (statements or None):
+        return [], 0, 0
+    lines = []
+    # flowtable devices can't be removed, the flowtable is recreated once nothing refers to it
+    if current is not None:
+        lines += [f"flush chain {TABLE} {FASTPATH_CHAIN}", f"delete chain {TABLE} {FASTPATH_CHAIN}"]
+    if current_devices is not None:
+        lines.append(f"delete flowtable {TABLE} {FLOWTABLE}")
+    if devices:
+        lines += [
+            f"add flowtable {TABLE} {FLOWTABLE} {{ hook ingress priority 0; devices = {{ {', '.join(sorted(devices))} }}; }}",
+            f"add chain {TABLE} {FASTPATH_CHAIN} {{ type filter hook forward priority -1; policy accept; }}",
+        ]
+        lines.extend(f"add rule {TABLE} {FASTPATH_CHAIN} {statement}" for statement in statements)
+    return lines, len(statements), len(current or [])
+
+
+def diff(ruleset, live):
+    """
+    Compares the objects owned by `ruleset` with the `live` table and returns the nft commands that reconcile
+    them, along with a dict counting the rules and set or map elements they add and remove.
+
+    Set and map elements are added and deleted individually, chains whose statements differ are rewritten.
+    The flowtable fast path is reconciled along with the main scope.
+    """
+    # objects referenced across scopes must always exist
+    core_chains = [FORWARD_CHAIN, compiler.MAIN_CHAIN, compiler.POLICY_CHAIN]
+    lines = [
+        f"add table {TABLE}",
+        f"add chain {TABLE} {FORWARD_CHAIN} {{ type filter hook forward priority 0; policy accept; }}",
+        f"add chain {TABLE} {compiler.MAIN_CHAIN}",
+        f"add chain {TABLE} {compiler.POLICY_CHAIN}",
+        f"add set {TABLE} {SHARED_USERS_SET} {{ type ipv4_addr; }}",
+        f"add map {TABLE} {POLICY_MAP} {{ type ipv4_addr : verdict; }}",
+    ]
+    changes = {"rules_added": 0, "rules_removed": 0, "members_added": 0, "members_removed": 0}
+    for name, members in ruleset.sets.items():
+        current = live["sets"].get(name, set())
+        if name != SHARED_USERS_SET:
+            lines.append(f"add set {TABLE} {name} {{ type ipv4_addr; }}")
+        if current - members:
+            lines.append(f"delete element {TABLE} {name} {{ {_elements(current - members)} }}")
+        if members - current:
+            lines.append(f"add element {TABLE} {name} {{ {_elements(members - current)} }}")
+        changes["members_added"] += len(members - current)
+        changes["members_removed"] += len(current - members)
+    # chains are created before any map element or rule can jump to them
+    lines.extend(f"add chain {TABLE} {chain_name}" for chain_name in ruleset.chains if chain_name not in core_chains)
+    for name, elements in ruleset.maps.items():
+        current = live["maps"].get(name, {})
+        stale = [k for k, v in current.items() if elements.get(k) != v]
+        fresh = {k: v for k, v in elements.items() if current.get(k) != v}
+        if stale:
+            lines.append(f"delete element {TABLE} {name} {{ {_elements(stale)} }}")
+        if fresh:
+            lines.append(f"add element {TABLE} {name} {{ {', '.join(f'{k} : {v}' for k, v in sorted(fresh.items()))} }}")
+        changes["members_added"] += len(fresh)
+        changes["members_removed"] += len(stale)
+    for chain_name, statements in ruleset.chains.items():
+        current = live["chains"].get(chain_name, [])
+        if current == statements:
+            continue
+        lines.append(f"flush chain {TABLE} {chain_name}")
+        lines.extend(f"add rule {TABLE} {chain_name} {statement}" for statement in statements)
+        changes["rules_added"] += len(statements)
+        changes["rules_removed"] += len(current)
+    for chain_name, current in sorted(live["chains"].items()):
+        if ruleset.owns(chain_name) and chain_name not in ruleset.chains:
+            # only empty chains can be deleted
+            lines += [f"flush chain {TABLE} {chain_name}", f"delete chain {TABLE} {chain_name}"]
+            changes["rules_removed"] += len(current)
+    for name, current in sorted(live["sets"].items()):
+        if ruleset.owns(name) and name not in ruleset.sets:
+            lines.append(f"delete set {TABLE} {name}")
+            changes["members_removed"] += len(current)
+    if compiler.MAIN in ruleset.scope:
+        fastpath, added, removed = _diff_fastpath(live)
+        lines += fastpath
+        changes["rules_added"] += added
+        changes["rules_removed"] += removed
+    return lines, changes
+
+
+def render(lines):
+    "joins nft commands `lines` into an nft -f payload"
+    return "\n".join(lines + [""])
+
+
+def commit(payload):
+    "commits `payload` to the kernel in a single nft transaction"
+    run(NFT_APPLY, payload)
+
+
+def commit_ruleset(ruleset, live=None):
+    """
+    Commits the difference between `ruleset` and the kernel in one nft transaction.
+    Returns a dict counting the rules and set or map elements added and removed.
+    """
+    lines, changes = diff(ruleset, read_table() if live is None else live)
+    commit(render(lines))
+    drift.record(NAME, ruleset, desired_objects(ruleset))
+    return changes
+
+
+def plan(scope):
+    """
+    Compiles `scope` and returns what apply() would commit, without touching the kernel, as a dict of the
+    compiled `data` and `ruleset`, the `commands` and `changes` of the diff and the `timings` of each step
+    """
+    start = time.monotonic()
+    live = read_table()
+    data = compiler.load(scope)
+    loaded = time.monotonic()
+    ruleset = build(data)
+    wider = compiler.widen_scope(scope, ruleset, live["chains"])
+    if wider is not scope:
+        data = compiler.load(wider)
+        ruleset = build(data)
+    built = time.monotonic()
+    lines, changes = diff(ruleset, live)
+    return {
+        "data": data,
+        "ruleset": ruleset,
+        "commands": [f"nft {line}" for line in lines],
+        "changes": changes,
+        "timings": {"load": loaded - start, "build": built - loaded, "diff": time.monotonic() - built},
+    }
+
+
+def apply(scope):
+    """
+    Compiles `scope` and commits its difference from the kernel in one transaction.
+    If anything was removed, conntrack entries of flows that are no longer permitted are flushed.
+    """
+    start = time.monotonic()
+    # read before compiling, so that changes committed meanwhile leave the snapshot stale
+    revision = snapshot.current_revision() if compiler.FULL_SCOPE <= set(scope) else None
+    live = read_table()
+    ruleset = build(compiler.load(scope))
+    wider = compiler.widen_scope(scope, ruleset, live["chains"])
+    if wider is not scope:
+        ruleset = build(compiler.load(wider))
+    changes = commit_ruleset(ruleset, live)
+    if revision is not None:
+        snapshot.save(NAME, revision, ruleset)
+    logger.info(
+        f"applied scope {sorted(ruleset.scope)} in {time.monotonic() - start:.3f}s: "
+        f"+{changes['rules_added']}/-{changes['rules_removed']} rules, "
+        f"+{changes['members_added']}/-{changes['members_removed']} set and map elements"
+    )
+    if changes["rules_removed"] or changes["members_removed"]:
+        conntrack.revoke_unpermitted(ruleset.scope)
+    return changes
+
+
+def delete_all(flush_only=True):
+    """
+    Flushes all evon Rule, Policy and User objects in one transaction.
+    If flush_only=False, the evon table is deleted altogether.
+    """
+    live = read_table()
+    if flush_only:
+        scope = frozenset([compiler.RULES, compiler.POLICIES, compiler.USERS])
+        commit_ruleset(build({"scope": scope, "rules": {}, "policies": {}, "users": {}}), live)
+    elif live["chains"] or live["sets"] or live["maps"] or live["flowtables"]:
+        commit(f"delete table {TABLE}\n")
+        drift.clear(NAME)
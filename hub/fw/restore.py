@@ -0,0 +1,253 @@
+"""
+iptables-restore firewall engine.
+
+Compiles the desired state of the evon chains and commits it to the kernel as a single
+`iptables-restore --noflush` transaction, rather than committing one rule at a time.
+"""
+
+from collections import Counter
+import time
+
+from eapi.settings import EVON_HUB_CONFIG
+from evon.log import get_evon_logger
+from hub.fw import compiler, conntrack, drift, ipset, snapshot
+from hub.fw.shell import run
+
+
+logger = get_evon_logger()
+
+NAME = "iptables-restore"
+IPTABLES_SAVE = ["iptables-save", "-t", "filter"]
+IPTABLES_RESTORE = ["iptables-restore", "--noflush", "--wait"]
+# chains in which rule order is significant
+ORDERED_CHAINS = [compiler.MAIN_CHAIN]
+
+
+def parse(text):
+    """
+    Parses iptables-save output and returns a dict of chain name -> list of rule specs for the filter table
+    """
+    chains = {}
+    for line in text.splitlines():
+        if line.startswith(":"):
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith("-A "):
+            chain_name, _, spec = line[3:].partition(" ")
+            chains.setdefault(chain_name, []).append(spec)
+    return chains
+
+
+def read_table():
+    "returns the live filter table as parsed by parse()"
+    return parse(run(IPTABLES_SAVE))
+
+
+def jump_target(spec):
+    "returns the chain or target jumped to by rule `spec`"
+    parts = spec.split()
+    if "-j" in parts[:-1]:
+        return parts[parts.index("-j") + 1]
+    return None
+
+
+def desired_objects(ruleset):
+    "returns the evon chains and sets of `ruleset` in the shape of live_objects()"
+    objects = {"chains": dict(ruleset.chains), "sets": dict(ruleset.sets)}
+    if ruleset.forward:
+        # FORWARD jumps are inserted, so their order in the kernel is reversed
+        objects["chains"]["FORWARD"] = {spec for _, spec in ruleset.forward}
+    return objects
+
+
+def live_objects():
+    "returns the evon chains and sets in the kernel, including the evon jumps of the FORWARD chain"
+    table = read_table()
+    objects = {"chains": {name: specs for name, specs in table.items() if compiler.is_evon_object(name)}, "sets": {}}
+    forward = {spec for spec in table.get("FORWARD", []) if "--comment evon-forward-to-" in spec}
+    if forward:
+        objects["chains"]["FORWARD"] = forward
+    if EVON_HUB_CONFIG["FIREWALL_IPSET"]:
+        objects["sets"] = {name: members for name, members in ipset.read_sets().items() if compiler.is_evon_object(name)}
+    return objects
+
+
+def diff(ruleset, live):
+    """
+    Compares the chains owned by `ruleset` with the `live` table and returns the iptables-restore --noflush
+    commands that reconcile them, along with the number of rules they add and remove.
+
+    Only the rules that differ are added or deleted, except in ORDERED_CHAINS where rule order is
+    significant and a chain that differs in any way is rewritten in full.
+    Owned chains that are absent from the ruleset have their references removed and are then deleted.
+    """
+    declarations = []
+    deletions = []
+    additions = []
+    cleanup = []
+    added = removed = 0
+    # core chains must exist before anything can jump to them
+    for chain_name in compiler.CORE_CHAINS:
+        if chain_name not in live and chain_name not in ruleset.chains:
+            declarations.append(f":{chain_name} - [0:0]")
+    for chain_name, specs in ruleset.chains.items():
+        current = live.get(chain_name)
+        if current == specs:
+            continue
+        if current is None or chain_name in ORDERED_CHAINS:
+            # declaring an existing chain flushes it under --noflush
+            declarations.append(f":{chain_name} - [0:0]")
+            additions.extend(f"-A {chain_name} {spec}" for spec in specs)
+            added += len(specs)
+            removed += len(current or [])
+            continue
+        surplus = Counter(current)
+        surplus.subtract(specs)
+        missing = Counter(specs)
+        missing.subtract(current)
+        for spec, count in surplus.items():
+            deletions.extend([f"-D {chain_name} {spec}"] * max(count, 0))
+            removed += max(count, 0)
+        for spec in specs:
+            if missing[spec] > 0:
+                missing[spec] -= 1
+                additions.append(f"-A {chain_name} {spec}")
+                added += 1
+    # FORWARD is never flushed, missing jumps are inserted at the top
+    forward = live.get("FORWARD", [])
+    for comment, spec in ruleset.forward:
+        if not [s for s in forward if f"--comment {comment} " in f"{s} "]:
+            additions.append(f"-I FORWARD {spec}")
+            added += 1
+    obsolete = [c for c in live if ruleset.owns(c) and c not in ruleset.chains]
+    for chain_name in obsolete:
+        for other, specs in live.items():
+            if other in ruleset.chains or other in obsolete:
+                continue
+            references = [spec for spec in specs if jump_target(spec) == chain_name]
+            cleanup.extend(f"-D {other} {spec}" for spec in references)
+            removed += len(references)
+        cleanup.append(f"-F {chain_name}")
+        removed += len(live[chain_name])
+    cleanup.extend(f"-X {chain_name}" for chain_name in obsolete)
+    return declarations + deletions + additions + cleanup, added, removed
+
+
+def render(lines):
+    "wraps iptables-restore commands `lines` in a filter table transaction"
+    return "\n".join(["*filter", *lines, "COMMIT", ""])
+
+
+def commit(payload):
+    "commits `payload` to the kernel in a single iptables-restore transaction"
+    run(IPTABLES_RESTORE, payload)
+
+
+def _diff_all(ruleset, live=None):
+    """
+    Returns the ipset commands to run before and after the iptables commands that reconcile `ruleset` with the
+    `live` table, read if None, and their counts
+    """
+    if EVON_HUB_CONFIG["FIREWALL_IPSET"]:
+        before, after, members_added, members_removed = ipset.diff(ruleset, ipset.read_sets())
+    else:
+        before, after, members_added, members_removed = [], [], 0, 0
+    lines, added, removed = diff(ruleset, read_table() if live is None else live)
+    changes = {
+        "rules_added": added,
+        "rules_removed": removed,
+        "members_added": members_added,
+        "members_removed": members_removed,
+    }
+    return before, lines, after, changes
+
+
+def commit_ruleset(ruleset, live=None):
+    """
+    Commits the difference between `ruleset` and the kernel, or the `live` table if given, in one
+    iptables-restore transaction, updating any ipsets it uses beforehand.
+    Returns a dict counting the rules and set members added and removed.
+    """
+    before, lines, after, changes = _diff_all(ruleset, live)
+    if before:
+        ipset.commit(ipset.render(before))
+    if lines:
+        commit(render(lines))
+    if after:
+        ipset.commit(ipset.render(after))
+    drift.record(NAME, ruleset, desired_objects(ruleset))
+    return changes
+
+
+def plan(scope):
+    """
+    Compiles `scope` and returns what apply() would commit, without touching the kernel, as a dict of the
+    compiled `data` and `ruleset`, the `commands` and `changes` of the diff and the `timings` of each step
+    """
+    start = time.monotonic()
+    live = read_table()
+    data = compiler.load(scope)
+    loaded = time.monotonic()
+    ruleset = compiler.build(data, sets=EVON_HUB_CONFIG["FIREWALL_IPSET"])
+    wider = compiler.widen_scope(scope, ruleset, live)
+    if wider is not scope:
+        data = compiler.load(wider)
+        ruleset = compiler.build(data, sets=EVON_HUB_CONFIG["FIREWALL_IPSET"])
+    built = time.monotonic()
+    before, lines, after, changes = _diff_all(ruleset, live)
+    commands = [f"ipset {line}" for line in before] + [f"iptables {line}" for line in lines]
+    commands += [f"ipset {line}" for line in after]
+    return {
+        "data": data,
+        "ruleset": ruleset,
+        "commands": commands,
+        "changes": changes,
+        "timings": {"load": loaded - start, "build": built - loaded, "diff": time.monotonic() - built},
+    }
+
+
+def apply(scope):
+    """
+    Compiles `scope` and commits its difference from the kernel in one transaction.
+    If anything was removed, conntrack entries of flows that are no longer permitted are flushed.
+    """
+    start = time.monotonic()
+    # read before compiling, so that changes committed meanwhile leave the snapshot stale
+    revision = snapshot.current_revision() if compiler.FULL_SCOPE <= set(scope) else None
+    live = read_table()
+    ruleset = compiler.compile_ruleset(scope, sets=EVON_HUB_CONFIG["FIREWALL_IPSET"])
+    wider = compiler.widen_scope(scope, ruleset, live)
+    if wider is not scope:
+        ruleset = compiler.compile_ruleset(wider, sets=EVON_HUB_CONFIG["FIREWALL_IPSET"])
+    changes = commit_ruleset(ruleset, live)
+    if revision is not None:
+        snapshot.save(NAME, revision, ruleset)
+    logger.info(
+        f"applied scope {sorted(ruleset.scope)} in {time.monotonic() - start:.3f}s: "
+        f"+{changes['rules_added']}/-{changes['rules_removed']} rules, "
+        f"+{changes['members_added']}/-{changes['members_removed']} set members"
+    )
+    if changes["rules_removed"] or changes["members_removed"]:
+        conntrack.revoke_unpermitted(ruleset.scope)
+    return changes
+
+
+def delete_all(flush_only=True):
+    """
+    Flushes all evon Rule, Policy and User chains in one transaction.
+    If flush_only=False, the core chains and FORWARD jumps are deleted as well.
+    """
+    if flush_only:
+        commit_ruleset(compiler.empty({compiler.RULES, compiler.POLICIES, compiler.USERS}))
+        return
+    live = read_table()
+    evon_chains = [c for c in live if c in compiler.CORE_CHAINS or c.startswith("evon-")]
+    lines = [f"-D FORWARD {spec}" for spec in live.get("FORWARD", []) if jump_target(spec) in evon_chains]
+    lines.extend(f"-F {chain_name}" for chain_name in evon_chains)
+    lines.extend(f"-X {chain_name}" for chain_name in evon_chains)
+    if lines:
+        commit(render(lines))
+    drift.clear(NAME)
+    if EVON_HUB_CONFIG["FIREWALL_IPSET"]:
+        evon_sets = [name for name in ipset.read_sets() if name.startswith("evon-")]
+        if evon_sets:
+            ipset.commit(ipset.render([f"destroy {name}" for name in evon_sets]))
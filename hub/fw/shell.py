@@ -0,0 +1,33 @@
+import subprocess
+
+from hub.exceptions import FirewallError
+
+
+def subprocess_runner(cmd, payload=None):
+    """
+    Runs `cmd`, optionally feeding `payload` to its stdin, and returns its stdout. Raises FirewallError on failure.
+    """
+    try:
+        result = subprocess.run(cmd, input=payload, capture_output=True, text=True)
+    except OSError as e:
+        raise FirewallError(f"failed to run {cmd[0]}: {e}")
+    if result.returncode:
+        raise FirewallError(f"{cmd[0]} failed with rc {result.returncode}: {result.stderr.strip()}")
+    return result.stdout
+
+
+runner = subprocess_runner
+
+
+def set_runner(func):
+    """
+    Routes the commands of all compiled engines to `func(cmd, payload)`, eg. a hub.fw.memory.Kernel for tests
+    and benchmarks that can't touch the real kernel. Pass None to restore subprocess_runner.
+    """
+    global runner
+    runner = func or subprocess_runner
+
+
+def run(cmd, payload=None):
+    "runs firewall command `cmd` with the current runner, see subprocess_runner()"
+    return runner(cmd, payload)
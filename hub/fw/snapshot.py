@@ -0,0 +1,93 @@
+"""
+Compiled ruleset snapshots.
+
+Every full apply saves the compiled Ruleset to disk along with the firewall revision of the DB it was compiled
+from (see hub.models.FirewallState). At boot, restore() commits the snapshot in a single transaction without
+querying or compiling anything if the revision is unchanged, so the overlay network is only briefly forwarded
+by a partial ruleset.
+"""
+
+import json
+import os
+
+from eapi.settings import EVON_HUB_CONFIG, VERSION
+from evon.log import get_evon_logger
+from hub.fw import compiler, conntrack
+import hub.models
+
+
+logger = get_evon_logger()
+
+
+def _path(backend):
+    return os.path.join(EVON_HUB_CONFIG["FIREWALL_STATE_DIR"], f"snapshot-{backend}.json")
+
+
+def current_revision():
+    "returns the firewall revision of the DB"
+    return hub.models.FirewallState.get_solo().revision
+
+
+def _key(revision):
+    "returns the properties a snapshot must match to be restored besides its backend, ie. all it was compiled from"
+    return {
+        "revision": revision,
+        "version": VERSION,
+        "overlay": compiler.overlay_range(),
+        "user_subnet": compiler.user_subnet(),
+        "server_subnet": compiler.server_subnet(),
+        "ipset": EVON_HUB_CONFIG["FIREWALL_IPSET"],
+        "flowtable": EVON_HUB_CONFIG["FIREWALL_FLOWTABLE"],
+        "flowtable_devices": sorted(EVON_HUB_CONFIG["FIREWALL_FLOWTABLE_DEVICES"]),
+    }
+
+
+def save(backend, revision, ruleset):
+    """
+    Saves full scope `ruleset` as compiled for `backend` from DB firewall revision `revision`.
+    Snapshots are an optimisation, failures to save them are logged rather than raised.
+    """
+    path = _path(backend)
+    try:
+        os.makedirs(EVON_HUB_CONFIG["FIREWALL_STATE_DIR"], exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": _key(revision), "ruleset": ruleset.to_dict()}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"unable to save firewall snapshot {path}: {e}")
+
+
+def load(backend):
+    "returns the saved snapshot for `backend` as a dict of its key and Ruleset, or None if there is none"
+    try:
+        with open(_path(backend)) as f:
+            data = json.load(f)
+        return {"key": data["key"], "ruleset": compiler.Ruleset.from_dict(data["ruleset"])}
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"ignoring unreadable firewall snapshot {_path(backend)}: {e}")
+        return None
+
+
+def restore(engine):
+    """
+    Commits the saved snapshot of `engine` in one transaction if it was compiled from the current DB revision.
+    Returns True if the snapshot was restored, or False if the firewall needs to be compiled.
+    """
+    saved = load(engine.NAME)
+    if saved is None:
+        return False
+    if saved["key"] != _key(current_revision()):
+        logger.info(f"firewall snapshot for {engine.NAME} is stale, recompiling")
+        return False
+    changes = engine.commit_ruleset(saved["ruleset"])
+    logger.info(
+        f"restored firewall snapshot for {engine.NAME} at revision {saved['key']['revision']}: "
+        f"+{changes['rules_added']}/-{changes['rules_removed']} rules, "
+        f"+{changes['members_added']}/-{changes['members_removed']} set members"
+    )
+    if changes["rules_removed"] or changes["members_removed"]:
+        conntrack.revoke_unpermitted()
+    return True
@@ -0,0 +1,36 @@
+from hub.fw import applier
+
+
+def intent(op, backend="iptables-restore", **args):
+    return {"op": op, "backend": backend, "args": args}
+
+
+def test_coalesce_merges_consecutive_intents_in_order():
+    intents = [
+        intent("apply", scope=["rule:1"]),
+        intent("apply", scope=["rule:2", "policies"]),
+        intent("apply", scope=["rule:1"]),
+        intent("init", full=True),
+        intent("init", full=True),
+        intent("apply", scope=["users"]),
+        intent("apply", "nftables", scope=["users"]),
+        intent("flush", flows=[["100.111.208.6", "100.111.224.6", "tcp", 22]]),
+        intent("flush", flows=[["100.111.208.10", "100.111.224.6", "udp", [53, 54]]]),
+    ]
+    batches = applier.coalesce(intents)
+    assert [(merged["op"], merged["backend"], merged["args"]) for merged, _ in batches] == [
+        ("apply", "iptables-restore", {"scope": ["policies", "rule:1", "rule:2"]}),
+        ("init", "iptables-restore", {"full": True}),
+        ("apply", "iptables-restore", {"scope": ["users"]}),
+        ("apply", "nftables", {"scope": ["users"]}),
+        ("flush", "iptables-restore", {"flows": [
+            ["100.111.208.6", "100.111.224.6", "tcp", 22], ["100.111.208.10", "100.111.224.6", "udp", [53, 54]]
+        ]}),
+    ]
+    # every intent is answered by the batch it was merged into
+    assert [i for _, batch in batches for i in batch] == intents
+
+
+def test_coalesce_keeps_differing_arguments_apart():
+    intents = [intent("init", full=True), intent("init", full=False), intent("delete_all", flush_only=True)]
+    assert [batch for _, batch in applier.coalesce(intents)] == [[i] for i in intents]
@@ -0,0 +1,125 @@
+from django.contrib.auth.models import Group, User
+import pytest
+
+from hub.fw import compiler
+import hub.models
+
+
+def test_aggregate_widens_client_addresses_to_their_block():
+    # clients are allocated the third address of a /30, see hub.models.vpn_ipv4_addresses()
+    assert compiler.aggregate(["100.111.224.2", "100.111.224.6"]) == ["100.111.224.0/29"]
+    assert compiler.aggregate(["100.111.224.6", "100.111.224.10"]) == ["100.111.224.4-100.111.224.11"]
+    assert compiler.aggregate(["100.111.224.6"]) == ["100.111.224.6/32"]
+    # other addresses aren't widened
+    assert compiler.aggregate(["100.111.224.9", "100.111.224.21"]) == ["100.111.224.9/32", "100.111.224.21/32"]
+
+
+def test_merge_ports():
+    assert compiler.merge_ports(["443", "80", "81", "8000-9000", "8500:9500", "9501"]) == [
+        (80, 81), (443, 443), (8000, 9501)
+    ]
+
+
+def test_pack_ports_fills_multiport_slots():
+    ports = [(port, port) for port in range(1, 17)]
+    assert [len(pack) for pack in compiler.pack_ports(ports)] == [15, 1]
+    # a range takes two slots
+    ranges = [(port, port + 1) for port in range(1, 40, 3)]
+    assert [len(pack) for pack in compiler.pack_ports(ranges)] == [7, 6]
+    assert compiler.pack_ports([(22, 22), (8000, 9000)]) == [["22", "8000:9000"]]
+
+
+def test_permits(data):
+    data["policies"][1]["rules"] = {1}
+    permitted = compiler.permits(data)
+    # Rule 1 allows tcp 22 and 8000-9000 from two Users to both targets
+    assert permitted("100.111.208.6", "100.111.224.6", "tcp", 22)
+    assert permitted("100.111.208.10", "100.111.224.10", "tcp", 8500)
+    assert not permitted("100.111.208.6", "100.111.224.6", "tcp", 443)
+    assert not permitted("100.111.208.6", "100.111.224.6", "udp", 22)
+    assert not permitted("100.111.208.18", "100.111.224.6", "tcp", 22)
+    assert not permitted("100.111.208.6", "100.111.224.18", "tcp", 22)
+    # shared Users accept anything, and flows that don't cross the overlay aren't evaluated
+    assert permitted("100.111.208.18", "100.111.208.14", "udp", 53)
+    assert permitted("10.0.0.1", "100.111.224.6", "tcp", 443)
+
+
+@pytest.mark.django_db
+def test_revocation_governs_the_targets_of_the_scope():
+    Rule = hub.models.Rule
+    hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid=f"7f1b3cd4-0000-4000-8000-00000000000{i}", fqdn=f"web-{i}.test", ipv4_address=address)
+        for i, address in enumerate(["100.111.224.6", "100.111.224.10"])
+    ])
+    ssh = Rule.objects.create(name="ssh", destination_protocol=Rule.TCP, destination_ports="22")
+    unused = Rule.objects.create(name="ping", destination_protocol=Rule.ICMP)
+    policy = hub.models.Policy.objects.create(name="ssh")
+    policy.rules.add(ssh)
+    policy.servers.add(hub.models.Server.objects.get(ipv4_address="100.111.224.6"))
+
+    assert compiler.revocation({compiler.rule_key(unused.pk)}) is None
+    governed, data = compiler.revocation({compiler.rule_key(ssh.pk)})
+    assert governed("100.111.224.6") and not governed("100.111.224.10")
+    assert (set(data["rules"]), set(data["policies"])) == ({ssh.pk}, {policy.pk})
+    # sharing governs every User
+    governed, _ = compiler.revocation({compiler.USERS})
+    assert governed("100.111.208.14") and not governed("100.111.224.6")
+    # Policies may govern anything
+    assert compiler.revocation({compiler.POLICIES})[0] is None
+
+
+def test_widen_scope_rebuilds_policies_when_a_rule_chain_goes():
+    ruleset = compiler.build({"scope": frozenset({"rule:1"}), "rules": {}, "policies": {}, "users": {}})
+    assert compiler.widen_scope({"rule:1"}, ruleset, ["evon-rule-2"]) == {"rule:1"}
+    assert compiler.widen_scope({"rule:1"}, ruleset, ["evon-rule-1"]) == {"rule:1", compiler.POLICIES}
+
+
+@pytest.mark.django_db
+def test_dependents():
+    servergroup = hub.models.ServerGroup.objects.create(name="web")
+    server = hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn="web-1.test", ipv4_address="100.111.224.6")
+    ])[0]
+    server.server_groups.add(servergroup)
+    group = Group.objects.create(name="ops")
+    user = User.objects.bulk_create([User(username="alice")])[0]
+    user.groups.add(group)
+    Rule = hub.models.Rule
+    by_group = Rule.objects.create(name="ssh", destination_protocol=Rule.TCP, destination_ports="22")
+    by_server = Rule.objects.create(name="ping", destination_protocol=Rule.ICMP)
+    by_group.source_groups.add(group)
+    by_server.source_servergroups.add(servergroup)
+    policy = hub.models.Policy.objects.create(name="ops")
+    policy.servergroups.add(servergroup)
+
+    assert compiler.dependents("user", [user.pk]) == {compiler.rule_key(by_group.pk)}
+    assert compiler.dependents("server", [server.pk]) == {compiler.rule_key(by_server.pk), compiler.POLICIES}
+    assert compiler.dependents("servergroup", [servergroup.pk]) == {compiler.rule_key(by_server.pk), compiler.POLICIES}
+    # membership of the virtual All Users group never changes the firewall
+    all_users = Group.objects.get(name=compiler.ALL_USERS)
+    by_group.source_groups.add(all_users)
+    assert compiler.dependents("group", [all_users.pk]) == set()
+
+
+@pytest.mark.django_db
+def test_virtual_groups_are_matched_by_subnet():
+    all_users = Group.objects.get(name=compiler.ALL_USERS)
+    all_servers = hub.models.ServerGroup.objects.get(name=compiler.ALL_SERVERS)
+    assert compiler.virtual_sources() == {
+        f"group:{all_users.pk}": "100.111.208.0/20", f"servergroup:{all_servers.pk}": "100.111.224.0/19"
+    }
+    server = hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn="web-1.test", ipv4_address="100.111.224.6")
+    ])[0]
+    Rule = hub.models.Rule
+    rule = Rule.objects.create(name="ping", destination_protocol=Rule.ICMP)
+    rule.source_groups.add(all_users)
+    rule.source_servers.add(server)
+    policy = hub.models.Policy.objects.create(name="everywhere")
+    policy.rules.add(rule)
+    policy.servergroups.add(all_servers)
+
+    data = compiler.load({compiler.rule_key(rule.pk), compiler.POLICIES})
+    loaded = data["rules"][rule.pk]
+    assert (loaded["ranges"], loaded["sources"]) == (["100.111.208.0/20"], {"100.111.224.6"})
+    assert data["policies"][policy.pk] == {"rules": {rule.pk}, "targets": set(), "ranges": {"100.111.224.0/19"}}
@@ -0,0 +1,32 @@
+from hub.fw import compiler, drift
+
+
+def test_detect_reports_objects_changed_since_they_were_recorded(kernel):
+    applied = {
+        "chains": {"evon-rule-1": ["-s 100.111.208.6/32 -j ACCEPT"], "evon-main": []},
+        "sets": {"evon-src-0123456789": {"100.111.208.6", "100.111.208.10"}},
+    }
+    assert drift.detect("iptables-restore", applied) is None
+    drift.record("iptables-restore", compiler.Ruleset(compiler.FULL_SCOPE), applied)
+    assert drift.detect("iptables-restore", applied) == []
+
+    live = {
+        "chains": {"evon-rule-1": ["-s 100.111.208.14/32 -j ACCEPT"], "evon-main": [], "evon-rule-9": []},
+        # set members are compared regardless of order
+        "sets": {"evon-src-0123456789": {"100.111.208.10", "100.111.208.6"}},
+    }
+    assert drift.detect("iptables-restore", live) == ["chain:evon-rule-1", "chain:evon-rule-9"]
+    # state is recorded per backend
+    assert drift.detect("nftables", live) is None
+
+
+def test_scope_for():
+    assert drift.scope_for("chain:evon-rule-12") == compiler.rule_key(12)
+    assert drift.scope_for("set:evon-src-0123456789") == compiler.RULES
+    assert drift.scope_for("chain:evon-policy") == compiler.POLICIES
+    assert drift.scope_for("chain:evon-dst-0123456789") == compiler.POLICIES
+    assert drift.scope_for("map:policy-targets") == compiler.POLICIES
+    assert drift.scope_for("chain:evon-user") == compiler.USERS
+    assert drift.scope_for("set:shared-users") == compiler.USERS
+    assert drift.scope_for("chain:evon-main") == compiler.MAIN
+    assert drift.scope_for("chain:forward") == compiler.MAIN
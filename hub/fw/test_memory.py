@@ -0,0 +1,118 @@
+import pytest
+
+from hub.exceptions import FirewallError
+from hub.fw import memory
+
+
+RESTORE = ["iptables-restore", "--noflush"]
+
+
+def restore(kernel, *lines):
+    kernel(RESTORE, "\n".join(["*filter", *lines, "COMMIT", ""]))
+
+
+def test_iptables_restore_round_trip(kernel):
+    restore(kernel, ":evon-main - [0:0]", "-A evon-main -s 1.2.3.4/32 -j ACCEPT", "-I FORWARD -j evon-main")
+    assert kernel.table["evon-main"] == ["-s 1.2.3.4/32 -j ACCEPT"]
+    saved = kernel(["iptables-save", "-t", "filter"])
+    assert ":evon-main - [0:0]" in saved.splitlines()
+    assert "-A FORWARD -j evon-main" in saved.splitlines()
+    assert kernel.commits["iptables-restore"] == 1
+    assert kernel.reads["iptables-save"] == 1
+
+
+def test_iptables_restore_is_atomic(kernel):
+    restore(kernel, ":evon-main - [0:0]", "-A evon-main -j ACCEPT")
+    with pytest.raises(FirewallError):
+        restore(kernel, "-A evon-main -j DROP", "-D evon-main -s 1.2.3.4/32 -j ACCEPT")
+    assert kernel.table["evon-main"] == ["-j ACCEPT"]
+
+
+def test_iptables_restore_rejects_missing_and_referenced_chains(kernel):
+    with pytest.raises(FirewallError):
+        restore(kernel, "-A FORWARD -j evon-main")
+    restore(kernel, ":evon-main - [0:0]", "-A FORWARD -j evon-main")
+    with pytest.raises(FirewallError):
+        restore(kernel, "-X evon-main")
+    restore(kernel, "-D FORWARD -j evon-main", "-X evon-main")
+    assert "evon-main" not in kernel.table
+
+
+def test_ipset_in_use_is_not_destroyed(kernel):
+    kernel(["ipset", "restore"], "create evon-src-1 hash:ip\nadd evon-src-1 100.64.208.2\n")
+    restore(kernel, ":evon-rule-1 - [0:0]", "-A evon-rule-1 -m set --match-set evon-src-1 src -j ACCEPT")
+    with pytest.raises(FirewallError):
+        kernel(["ipset", "restore"], "destroy evon-src-1\n")
+    assert kernel(["ipset", "save"]) == "create evon-src-1 hash:ip\nadd evon-src-1 100.64.208.2\n"
+
+
+def test_nft_rejects_busy_chains(kernel):
+    kernel(["nft", "-f", "-"], "\n".join([
+        "add table ip evon",
+        "add chain ip evon evon-main",
+        "add chain ip evon evon-policy",
+        "add rule ip evon evon-main jump evon-policy",
+    ]))
+    assert "\t\tjump evon-policy" in kernel(["nft", "list", "table", "ip", "evon"]).splitlines()
+    with pytest.raises(FirewallError):
+        kernel(["nft", "-f", "-"], "delete chain ip evon evon-policy")
+    assert kernel.rule_count() == 1
+
+
+def test_iptc_autocommit_commits_each_change(kernel):
+    iptc = memory.iptc_module()
+    iptc.easy.add_chain("filter", "evon-user")
+    rule = iptc.Rule()
+    rule.dst = "100.64.208.2"
+    match = iptc.Match(rule, "comment")
+    match.comment = "evon-user-1"
+    rule.add_match(match)
+    rule.target = iptc.Target(rule, "ACCEPT")
+    iptc.Chain(iptc.Table(iptc.Table.FILTER), "evon-user").insert_rule(rule)
+    assert kernel.table["evon-user"] == ["-d 100.64.208.2/32 -m comment --comment evon-user-1 -j ACCEPT"]
+    assert kernel.commits["iptc"] == 2
+    dumped = iptc.easy.dump_table("filter")["evon-user"]
+    assert dumped == [{"dst": "100.64.208.2/32", "comment": {"comment": ["evon-user-1"]}, "target": "ACCEPT"}]
+    [read] = iptc.Chain(iptc.Table(iptc.Table.FILTER), "evon-user").rules
+    assert read.dst == "100.64.208.2/255.255.255.255"
+    assert [m.comment for m in read.matches] == ["evon-user-1"]
+
+
+def test_iptc_table_commits_once_or_discards(kernel):
+    iptc = memory.iptc_module()
+    restore(kernel, ":evon-rule-1 - [0:0]", "-A evon-rule-1 -j ACCEPT", "-A FORWARD -j evon-rule-1")
+    table = iptc.Table(iptc.Table.FILTER)
+    table.autocommit = False
+    try:
+        forward = iptc.Chain(table, "FORWARD")
+        forward.delete_rule(forward.rules[0])
+        iptc.Chain(table, "evon-rule-1").flush()
+        table.delete_chain("evon-rule-1")
+        assert "evon-rule-1" in kernel.table
+        table.commit()
+    finally:
+        table.refresh()
+        table.autocommit = True
+    assert "evon-rule-1" not in kernel.table and kernel.table["FORWARD"] == []
+    assert kernel.commits["iptc"] == 1
+
+    restore(kernel, ":evon-rule-2 - [0:0]")
+    table.autocommit = False
+    iptc.Chain(table, "evon-rule-2").append_rule(iptc.Rule())
+    table.refresh()
+    table.autocommit = True
+    assert kernel.table["evon-rule-2"] == []
+
+
+def test_iptc_rejects_missing_and_referenced_chains(kernel):
+    iptc = memory.iptc_module()
+    rule = iptc.Rule()
+    rule.target = iptc.Target(rule, "evon-rule-1")
+    with pytest.raises(FirewallError):
+        iptc.Chain(iptc.Table(iptc.Table.FILTER), "FORWARD").insert_rule(rule)
+    assert kernel.table["FORWARD"] == []
+    iptc.easy.add_chain("filter", "evon-rule-1")
+    iptc.Chain(iptc.Table(iptc.Table.FILTER), "FORWARD").insert_rule(rule)
+    with pytest.raises(FirewallError):
+        iptc.Table(iptc.Table.FILTER).delete_chain("evon-rule-1")
+    assert kernel.table["FORWARD"] == ["-j evon-rule-1"]
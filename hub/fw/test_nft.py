@@ -0,0 +1,59 @@
+from hub.fw import nft
+
+
+LISTING = """table ip evon {
+	set evon-src-0123456789 {
+		type ipv4_addr
+		elements = { 100.111.208.6, 100.111.208.10,
+			     100.111.208.14 }
+	}
+
+	map policy-targets {
+		type ipv4_addr : verdict
+		elements = { 100.111.224.6 : jump evon-dst-0123456789 }
+	}
+
+	flowtable fastpath {
+		hook ingress priority filter
+		devices = { tun0, tun1 }
+	}
+
+	chain forward {
+		type filter hook forward priority filter; policy accept;
+		ip saddr 100.111.208.1-100.111.255.254 jump evon-main
+	}
+
+	chain evon-main {
+	}
+}
+"""
+
+
+def test_parse():
+    assert nft.parse(LISTING) == {
+        "chains": {"forward": ["ip saddr 100.111.208.1-100.111.255.254 jump evon-main"], "evon-main": []},
+        "sets": {"evon-src-0123456789": {"100.111.208.6", "100.111.208.10", "100.111.208.14"}},
+        "maps": {"policy-targets": {"100.111.224.6": "jump evon-dst-0123456789"}},
+        "flowtables": {"fastpath": {"tun0", "tun1"}},
+    }
+
+
+def test_commit_ruleset_converges(kernel, data):
+    ruleset = nft.build(data)
+    changes = nft.commit_ruleset(ruleset)
+    assert changes["rules_added"] == ruleset.rule_count()
+    assert changes["members_added"] == sum(len(members) for members in ruleset.sets.values()) + 2
+    # parsing the table back finds nothing left to change
+    assert set(nft.diff(ruleset, nft.read_table())[1].values()) == {0}
+
+    # a Rule that's gone takes its chain, source set and dispatch chain with it
+    del data["rules"][2]
+    data["policies"][1]["rules"] = {1}
+    ruleset = nft.build(data)
+    changes = nft.commit_ruleset(ruleset)
+    assert changes["rules_removed"] > 0
+    live = nft.read_table()
+    assert set(live["chains"]) == set(ruleset.chains)
+    assert set(live["sets"]) == set(ruleset.sets)
+    assert set(nft.diff(ruleset, live)[1].values()) == {0}
+    assert kernel.commits["nft"] == 2
@@ -0,0 +1,74 @@
+import pytest
+
+from eapi.settings import EVON_HUB_CONFIG
+from hub.fw import compiler, ipset, restore
+
+
+def test_diff_changes_only_differing_rules_and_deletes_obsolete_chains():
+    ruleset = compiler.Ruleset({"rule:1", "rule:2"})
+    ruleset.owned_names.update(["evon-rule-1", "evon-rule-2"])
+    ruleset.chains["evon-rule-1"] = ["-s 100.111.208.6/32 -j ACCEPT", "-s 100.111.208.10/32 -j ACCEPT"]
+    live = {
+        "FORWARD": [],
+        "evon-main": [], "evon-policy": [], "evon-user": [],
+        "evon-rule-1": ["-s 100.111.208.6/32 -j ACCEPT", "-s 100.111.208.14/32 -j ACCEPT"],
+        "evon-rule-2": ["-j ACCEPT"],
+        "evon-dst-0123456789": ["-j evon-rule-1", "-j evon-rule-2"],
+    }
+    assert restore.diff(ruleset, live) == ([
+        "-D evon-rule-1 -s 100.111.208.14/32 -j ACCEPT",
+        "-A evon-rule-1 -s 100.111.208.10/32 -j ACCEPT",
+        # references to an obsolete chain go before it does
+        "-D evon-dst-0123456789 -j evon-rule-2",
+        "-F evon-rule-2",
+        "-X evon-rule-2",
+    ], 1, 3)
+
+
+def test_diff_rewrites_ordered_chains():
+    ruleset = compiler.build({"scope": frozenset({compiler.MAIN}), "rules": {}, "policies": {}, "users": {}})
+    main = ruleset.chains[compiler.MAIN_CHAIN]
+    live = {"evon-main": main[1:] + main[:1], "evon-policy": [], "evon-user": []}
+    lines, added, removed = restore.diff(ruleset, live)
+    assert lines[:1 + len(main)] == [":evon-main - [0:0]"] + [f"-A evon-main {spec}" for spec in main]
+    # FORWARD jumps are inserted rather than appended
+    assert [line.split()[:2] for line in lines[1 + len(main):]] == [["-I", "FORWARD"]] * 2
+    assert (added, removed) == (len(main) + 2, len(main))
+
+
+def test_ipset_diff_fills_sets_before_and_destroys_them_after():
+    ruleset = compiler.Ruleset({compiler.RULES})
+    ruleset.owned_prefixes.append(compiler.SOURCE_PREFIX)
+    ruleset.sets = {"evon-src-a": {"100.111.208.10", "100.111.208.14"}, "evon-src-b": {"100.111.208.18"}}
+    live = {
+        "evon-src-a": {"100.111.208.6", "100.111.208.10"},
+        "evon-src-old": {"100.111.208.22"},
+        "unrelated": {"10.0.0.1"},
+    }
+    assert ipset.diff(ruleset, live) == (
+        [
+            "add evon-src-a 100.111.208.14",
+            "del evon-src-a 100.111.208.6",
+            "create evon-src-b hash:ip",
+            "add evon-src-b 100.111.208.18",
+        ],
+        ["destroy evon-src-old"],
+        2,
+        1,
+    )
+
+
+@pytest.mark.parametrize("sets", [False, True], ids=["chains", "ipsets"])
+def test_commit_ruleset_converges(kernel, data, monkeypatch, sets):
+    monkeypatch.setitem(EVON_HUB_CONFIG, "FIREWALL_IPSET", sets)
+    ruleset = compiler.build(data, sets=sets)
+    assert restore.commit_ruleset(ruleset)["rules_added"] == ruleset.rule_count() + len(ruleset.forward)
+    assert set(restore.commit_ruleset(ruleset).values()) == {0}
+    assert kernel.commits["iptables-restore"] == 1
+
+    # deleting Rule 2 replaces the dispatch chain jumping to it, its chain can only go once that has
+    del data["rules"][2]
+    data["policies"][1]["rules"] = {1}
+    restore.commit_ruleset(compiler.build(data, sets=sets))
+    assert not [name for name in restore.read_table() if name.endswith("rule-2")]
+    assert set(restore.commit_ruleset(compiler.build(data, sets=sets)).values()) == {0}
@@ -0,0 +1,39 @@
+import pytest
+
+from eapi.settings import EVON_HUB_CONFIG
+from hub.fw import compiler, restore, snapshot
+import hub.models
+
+
+pytestmark = pytest.mark.django_db
+
+
+def test_restore_commits_a_snapshot_of_the_current_revision(kernel, data):
+    assert not snapshot.restore(restore)
+    ruleset = compiler.build(data, sets=EVON_HUB_CONFIG["FIREWALL_IPSET"])
+    snapshot.save(restore.NAME, snapshot.current_revision(), ruleset)
+    assert snapshot.load(restore.NAME)["ruleset"].to_dict() == ruleset.to_dict()
+
+    assert snapshot.restore(restore)
+    assert kernel.commits["iptables-restore"] == 1
+    assert set(restore.commit_ruleset(ruleset).values()) == {0}
+    # snapshots are per backend
+    assert snapshot.load("nftables") is None
+
+
+def test_stale_snapshots_are_not_restored(kernel, data):
+    snapshot.save(restore.NAME, snapshot.current_revision(), compiler.build(data))
+    hub.models.FirewallState.bump()
+    assert not snapshot.restore(restore)
+    assert "iptables-restore" not in kernel.commits
+
+
+@pytest.mark.parametrize("setting, value", [
+    ("FIREWALL_IPSET", not EVON_HUB_CONFIG["FIREWALL_IPSET"]),
+    ("FIREWALL_FLOWTABLE", not EVON_HUB_CONFIG["FIREWALL_FLOWTABLE"]),
+    ("FIREWALL_FLOWTABLE_DEVICES", ["tun0"]),
+])
+def test_snapshots_of_another_configuration_are_not_restored(kernel, data, monkeypatch, setting, value):
+    snapshot.save(restore.NAME, snapshot.current_revision(), compiler.build(data))
+    monkeypatch.setitem(EVON_HUB_CONFIG, setting, value)
+    assert not snapshot.restore(restore)
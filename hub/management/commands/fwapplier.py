@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from hub.fw import applier
+
+
+class Command(BaseCommand):
+    help = "Run the firewall applier daemon, which applies the firewall changes of all Hub processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            help='Unix socket to listen on, overriding EVON_HUB_CONFIG["FIREWALL_APPLIER_SOCKET"]',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            applier.serve(options['socket'])
+        except KeyboardInterrupt:
+            self.stdout.write("Firewall applier stopped")
@@ -1,12 +1,24 @@
+import datetime
+import statistics
+
 from django.core.management.base import BaseCommand, CommandError
 
+from evon.job_queue import job_queue, percentile
 from hub import firewall
+from hub.fw import compiler
 
 
 class Command(BaseCommand):
     help = "Control iptables chains and rules relating to Evon Rules and Policies"
 
     def add_arguments(self, parser):
+        parser.add_argument(
+            '--backend',
+            choices=firewall.BACKENDS,
+            help='Firewall backend to use for this command only, overriding EVON_HUB_CONFIG["FIREWALL_BACKEND"]. '
+                 'The Hub keeps applying changes with the configured backend, to switch backends change '
+                 'FIREWALL_BACKEND, restart the Hub and run --init',
+        )
         parser.add_argument(
             '--init',
             action='store_true',
@@ -17,6 +29,26 @@ class Command(BaseCommand):
             action='store_true',
             help='Initialise iptables only without applying Hub Rules and Policies',
         )
+        parser.add_argument(
+            '--reconcile',
+            action='store_true',
+            help='Rebuild only the Evon chains and sets that have drifted from the last applied state',
+        )
+        parser.add_argument(
+            '--plan',
+            action='store_true',
+            help='Compile all Hub Rules and Policies and show the changes that --init would make, without applying them',
+        )
+        parser.add_argument(
+            '--jobs',
+            action='store_true',
+            help='Show the depth, latency and failures of the background job queues of all Hub processes',
+        )
+        parser.add_argument(
+            '--dead-letters',
+            action='store_true',
+            help='Show the background jobs that failed on every retry and have not succeeded since',
+        )
         parser.add_argument(
             '--delete',
             action='store_true',
@@ -33,6 +65,14 @@ class Command(BaseCommand):
             self.stdout.write("Please specify an option")
             return
 
+        if options['backend']:
+            if options['backend'] != firewall.backend and options['init']:
+                self.stderr.write(
+                    f"Warning: the Hub applies changes with the configured {firewall.backend} backend, which --init "
+                    f"removes in favour of {options['backend']}. Set FIREWALL_BACKEND to switch backends."
+                )
+            firewall.set_backend(options['backend'])
+
         if options['init']:
             firewall.init()
             self.stdout.write("All Evon iptables rules and chains initialised")
@@ -41,6 +81,26 @@ class Command(BaseCommand):
             firewall.init(full=False)
             self.stdout.write("Initialised core Evon iptables rules/chains only.")
 
+        if options['reconcile']:
+            replayed = job_queue.replay()
+            if replayed:
+                self.stdout.write(f"Replayed {replayed} firewall jobs orphaned by dead processes")
+            future = firewall.reconcile()
+            drifted = future.result() if future else []
+            if drifted:
+                self.stdout.write(f"Reconciled {len(drifted)} drifted Evon firewall objects: {', '.join(drifted)}")
+            else:
+                self.stdout.write("No Evon firewall drift to reconcile")
+
+        if options['plan']:
+            self.plan()
+
+        if options['jobs']:
+            self.jobs()
+
+        if options['dead_letters']:
+            self.dead_letters()
+
         if options['delete']:
             firewall.delete_all()
             self.stdout.write("Flushed Evon iptables rules and chains")
@@ -48,3 +108,74 @@ class Command(BaseCommand):
         if options['delete_all']:
             firewall.delete_all(flush_only=False)
             self.stdout.write("Deleted all Evon iptables rules and chains")
+
+    def jobs(self):
+        "prints the job queue metrics of all processes sharing the job journal"
+        stats = job_queue.stats()
+        self.stdout.write(
+            f"{stats['processes']} processes, {stats['depth']} unfinished jobs, "
+            f"oldest pending for {stats['oldest_pending_seconds']:.1f}s"
+        )
+        if not stats["jobs"]:
+            return
+        self.stdout.write(
+            f"{'job':<24}{'submitted':>10}{'coalesced':>10}{'deduped':>10}{'failed':>8}{'retried':>8}"
+            f"{'wait p95':>10}{'wait max':>10}{'run p95':>10}{'run max':>10}"
+        )
+
+        def bound(seconds):
+            return f"<={seconds}s" if seconds is not None else ">300s"
+
+        for name, job in sorted(stats["jobs"].items()):
+            wait, run = job["wait"], job["run"]
+            self.stdout.write(
+                f"{name:<24}{job['submitted']:>10}{job['coalesced']:>10}{job['deduped']:>10}{job['failed']:>8}{job['retried']:>8}"
+                f"{bound(percentile(wait, 95)) if wait['count'] else '-':>10}{wait['max']:>9.2f}s"
+                f"{bound(percentile(run, 95)) if run['count'] else '-':>10}{run['max']:>9.2f}s"
+            )
+            if job["last_error"]:
+                self.stdout.write(f"  last error: {job['last_error']}")
+
+    def dead_letters(self):
+        "prints the jobs that failed on every attempt, see SingleWorkerQueue.dead_letters()"
+        letters = job_queue.dead_letters()
+        if not letters:
+            self.stdout.write("No dead letters, all failed jobs have since succeeded")
+            return
+        for letter in letters:
+            failed = datetime.datetime.fromtimestamp(letter["failed"]).isoformat(sep=" ", timespec="seconds")
+            escalated = ", escalated" if letter["escalated"] else ""
+            self.stdout.write(f"{letter['key']} failed {letter['attempts']} times at {failed} (pid {letter['pid']}{escalated})")
+            self.stdout.write(f"  {letter['error']}")
+
+    def plan(self, top=10):
+        "prints the diff, statistics and compile timings of the full firewall without touching the kernel"
+        engine = firewall.get_engine()
+        if not engine:
+            raise CommandError("--plan is not supported by the iptc backend")
+        plan = engine.plan(compiler.FULL_SCOPE)
+        ruleset, changes, timings = plan["ruleset"], plan["changes"], plan["timings"]
+        self.stdout.write(f"Plan for the {engine.NAME} backend, nothing has been applied\n")
+        self.stdout.write("Commands:")
+        for command in plan["commands"]:
+            self.stdout.write(f"  {command}")
+        if not plan["commands"]:
+            self.stdout.write("  none, the kernel is up to date")
+        self.stdout.write(
+            f"\nChanges: +{changes['rules_added']}/-{changes['rules_removed']} rules, "
+            f"+{changes['members_added']}/-{changes['members_removed']} set members\n"
+        )
+        self.stdout.write(f"Rules per chain ({ruleset.rule_count()} rules in {len(ruleset.chains)} chains):")
+        for chain_name, specs in sorted(ruleset.chains.items(), key=lambda item: (-len(item[1]), item[0])):
+            self.stdout.write(f"  {len(specs):6d}  {chain_name}")
+        walks = compiler.walk_costs(ruleset, plan["data"])
+        self.stdout.write(f"\nWorst-case rule walk per destination ({len(walks)} destinations):")
+        if walks:
+            self.stdout.write(f"  max {max(walks.values())}, median {statistics.median(walks.values()):g}")
+            for address, cost in sorted(walks.items(), key=lambda item: (-item[1], item[0]))[:top]:
+                self.stdout.write(f"  {cost:6d}  {address}")
+        self.stdout.write(
+            f"\nCompile time: {timings['load'] + timings['build']:.3f}s "
+            f"(DB queries {timings['load']:.3f}s, rule generation {timings['build']:.3f}s), "
+            f"diff {timings['diff']:.3f}s"
+        )
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.13 on 2026-10-18 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hub", "0004_alter_rule_destination_protocol"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FirewallState",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "revision",
+                    models.PositiveBigIntegerField(
+                        default=0,
+                        editable=False,
+                        help_text="Incremented whenever an object that the firewall is compiled from changes",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Firewall State",
+                "verbose_name_plural": "Firewall State",
+            },
+        ),
+    ]
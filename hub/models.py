@@ -194,6 +194,8 @@ class Server(models.Model):
         help_text="This value is auto-assigned and is static for the UUID used by this Server."
     )
     # connected and disconnected_since will be auto-updated by mapper.py
+    # saves of only these fields are connection state changes, which the firewall does not depend on
+    connection_fields = ["connected", "disconnected_since"]
     connected = models.BooleanField(
         default=False,
         editable=False,
@@ -263,6 +265,7 @@ class Server(models.Model):
         # force dev mode if we're not on an AL2 EC2 instance
         if DEBUG:
             dev_mode = True
+        normalised_fields = {"fqdn": self.fqdn, "ipv4_address": self.ipv4_address}
         # dhcp-style ipv4_address assignment
         if not self.ipv4_address:
             for ipv4_addr in vpn_ipv4_addresses():
@@ -318,6 +321,11 @@ class Server(models.Model):
                 logger.info(f"set_records request: {payload}")
                 response = evon_api.set_records(EVON_API_URL, EVON_API_KEY, payload)
                 logger.info(f"set_records reponse: {response}")
+        # saves limited by update_fields, eg. of the connection_fields, also write the fields normalised above if
+        # they changed, so such saves are only firewall-neutral when the fqdn and ipv4_address are left alone
+        if kwargs.get("update_fields") is not None:
+            changed = [field for field, value in normalised_fields.items() if getattr(self, field) != value]
+            kwargs["update_fields"] = list(kwargs["update_fields"]) + changed
         # validate and save
         self.full_clean()
         super().save(*args, **kwargs)
@@ -567,6 +575,28 @@ class Config(SingletonModel):
         super().save(*args, **kwargs)
 
 
+class FirewallState(SingletonModel):
+    revision = models.PositiveBigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Incremented whenever an object that the firewall is compiled from changes"
+    )
+
+    class Meta:
+        verbose_name = "Firewall State"
+        verbose_name_plural = "Firewall State"
+
+    def __str__(self):
+        return f"Firewall revision {self.revision}"
+
+    @classmethod
+    def bump(cls):
+        "atomically increments the firewall revision"
+        if not cls.objects.filter(pk=cls.singleton_instance_id).update(revision=models.F("revision") + 1):
+            cls.get_solo()
+            cls.objects.filter(pk=cls.singleton_instance_id).update(revision=models.F("revision") + 1)
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
     ipv4_address = models.GenericIPAddressField(
@@ -19,12 +19,63 @@ import zoneinfo
 from evon.log import get_evon_logger
 from eapi.settings import EVON_VARS
 from hub import cron, firewall
+from hub.fw import compiler
 import hub.models
 
 
 logger = get_evon_logger()
 
 
+# fields the firewall doesn't use, by model, saves that only update these leave the firewall as it is
+FIREWALL_IRRELEVANT_FIELDS = {
+    hub.models.Server: hub.models.Server.connection_fields,
+    # last_login is saved on every login
+    hub.models.User: ["last_login", "password"],
+}
+
+
+def is_irrelevant_update(instance, update_fields):
+    "returns True if a save only updated fields the firewall doesn't use, eg. the VPN connection state of a Server"
+    fields = FIREWALL_IRRELEVANT_FIELDS.get(type(instance))
+    return bool(fields and update_fields) and set(update_fields) <= set(fields)
+
+
+def queue_firewall(scope):
+    """
+    Adds intent `scope`, see firewall.apply_scope(), to the firewall intents of the current DB transaction.
+    The intents of a transaction, or of each savepoint within it, are applied by a single firewall.apply_scope()
+    job once it commits, or immediately outside of a transaction, so a save firing many signals costs one
+    kernel transaction. Intents of a transaction rolled back altogether are applied, redundantly, with those
+    of the next.
+    """
+    if not scope:
+        return
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        # nothing is pending outside a transaction, forget the intents of rolled back savepoints
+        connection.firewall_intents = {}
+        firewall.apply_scope(set(scope))
+        return
+    # intents are collected per savepoint, as their on_commit callbacks are dropped when it is rolled back.
+    # Every call registers a callback, which is cheap, and the first to run applies the collected intents.
+    savepoint = tuple(sid for sid in connection.savepoint_ids if sid)
+    intents = connection.__dict__.setdefault("firewall_intents", {})
+    pending = intents.setdefault(savepoint, set())
+    pending.update(scope)
+    transaction.on_commit(partial(flush_firewall_intents, connection, savepoint, pending))
+
+
+def flush_firewall_intents(connection, savepoint, scope):
+    "applies the firewall intents `scope` collected by queue_firewall() in `savepoint`, unless already applied"
+    # intents queued from here on, eg. by a later on_commit hook, are collected afresh
+    if connection.firewall_intents.get(savepoint) is scope:
+        del connection.firewall_intents[savepoint]
+    if scope:
+        applied = set(scope)
+        scope.clear()
+        firewall.apply_scope(applied)
+
+
 ###############################
 ##### pre_save events
 ###############################
@@ -65,26 +116,25 @@ def modify_log_entry(sender, instance, created=False, **kwargs):
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     "create token and add new users to all users group"
 
+    if is_irrelevant_update(instance, kwargs.get("update_fields")):
+        return
     # every new user gets an api token and gets added to All Users group
     if created:
         # create token
         Token.objects.create(user=instance)
         # create a user profile
         hub.models.UserProfile.objects.create(user=instance)
-        # add to group
+        # add to group, rules using the "All Users" group match all user addresses already
         all_users_group = hub.models.Group.objects.get(name="All Users")
         instance.groups.add(all_users_group)
-        # we need to update any rules using the "All Users" group.
-        rules = hub.models.Rule.objects.filter(source_groups__in=[all_users_group])
-        for rule in rules:
-            transaction.on_commit(partial(firewall.apply_rule, rule))
 
     if not instance.is_active:
-        # disconnect the user from the VPN if connected
+        # disconnect the user from the VPN if connected and drop their established flows
         transaction.on_commit(partial(firewall.kill_inactive_users, extra_user=instance.username))
+        transaction.on_commit(partial(firewall.revoke_user, instance))
 
     # update user device sharing fw rule
-    transaction.on_commit(partial(firewall.apply_user, instance))
+    queue_firewall({firewall.user_key(instance.pk)})
 
 
 @receiver(post_save, sender=hub.models.UserProfile)
@@ -92,7 +142,7 @@ def update_userprofile(sender, instance=None, created=False, **kwargs):
     "update fw on userprofile change"
 
     # update user device sharing fw rule
-    transaction.on_commit(partial(firewall.apply_user, instance.user))
+    queue_firewall({firewall.user_key(instance.user_id)})
 
 
 @receiver(post_save, sender=hub.models.Group)
@@ -100,25 +150,19 @@ def upsert_group(sender, instance=None, created=False, **kwargs):
     """
     Update iptables rules for any Rule that references this Group
     """
-    rules = hub.models.Rule.objects.filter(source_groups__in=[instance])
-    for rule in rules:
-        transaction.on_commit(partial(firewall.apply_rule, rule))
+    queue_firewall(compiler.dependents("group", [instance.pk]))
 
 
 @receiver(post_save, sender=hub.models.Server)
 def add_server_to_all_servers_group(sender, instance=None, created=False, **kwargs):
     "add new servers to the all servers group"
 
+    if is_irrelevant_update(instance, kwargs.get("update_fields")):
+        return
     all_servers_group = hub.models.ServerGroup.objects.get(name="All Servers")
     if created:
+        # rules and policies using the "All Servers" group match all server addresses already
         instance.server_groups.add(all_servers_group)
-        # we need to update any rules or policies using the "All Servers" group.
-        rules = hub.models.Rule.objects.filter(source_servergroups__in=[all_servers_group])
-        for rule in rules:
-            transaction.on_commit(partial(firewall.apply_rule, rule))
-        policies = hub.models.Policy.objects.filter(servergroups__in=[all_servers_group])
-        for policy in policies:
-            transaction.on_commit(partial(firewall.apply_policy, policy))
     else:
         # ensure all_servers group membership is immutable
         transaction.on_commit(partial(instance.server_groups.add, all_servers_group))
@@ -129,26 +173,21 @@ def upsert_servergroup(sender, instance=None, created=False, **kwargs):
     """
     Update iptables rules for any Rule or Policy that references this ServerGroup
     """
-    rules = hub.models.Rule.objects.filter(source_servergroups__in=[instance])
-    for rule in rules:
-        transaction.on_commit(partial(firewall.apply_rule, rule))
-    policies = hub.models.Policy.objects.filter(servergroups__in=[instance])
-    for policy in policies:
-        transaction.on_commit(partial(firewall.apply_policy, policy))
+    queue_firewall(compiler.dependents("servergroup", [instance.pk]))
 
 
 @receiver(post_save, sender=hub.models.Rule)
 def upsert_rule(sender, instance=None, created=False, **kwargs):
     "upsert iptables chain for Rule"
 
-    firewall.apply_rule(instance)
+    queue_firewall({compiler.rule_key(instance.pk)})
 
 
 @receiver(post_save, sender=hub.models.Policy)
 def upsert_policy(sender, instance=None, created=False, **kwargs):
     "upsert iptables rules for Policy"
 
-    firewall.apply_policy(instance)
+    queue_firewall({firewall.policy_key(instance.pk)})
 
 
 @receiver(post_save, sender=hub.models.Config)
@@ -187,6 +226,24 @@ def delete_user(sender, instance, **kwargs):
         raise PermissionDenied
 
 
+# kind of each model the firewall depends on, see hub.fw.compiler.dependents()
+DEPENDENCY_KINDS = {
+    hub.models.User: "user",
+    hub.models.Group: "group",
+    hub.models.Server: "server",
+    hub.models.ServerGroup: "servergroup",
+}
+
+
+@receiver(pre_delete)
+def collect_firewall_dependents(sender, instance, **kwargs):
+    "record the firewall objects depending on an object before its relations are deleted with it"
+
+    kind = DEPENDENCY_KINDS.get(sender)
+    if kind:
+        instance._firewall_dependents = compiler.dependents(kind, [instance.pk])
+
+
 ###############################
 ##### post_delete events
 ###############################
@@ -197,52 +254,126 @@ def delete_object(sender, instance=None, **kwargs):
     Update fw rules on object deletions
     """
     if isinstance(instance, hub.models.Rule):
-        firewall.delete_rule(instance)
+        queue_firewall({compiler.rule_key(instance.pk)})
         return
 
     if isinstance(instance, hub.models.Policy):
-        firewall.delete_policy(instance)
+        queue_firewall({firewall.policy_key(instance.pk)})
         return
 
     if isinstance(instance, hub.models.Server):
         transaction.on_commit(firewall.kill_orphan_servers)
 
     if isinstance(instance, hub.models.User):
-        transaction.on_commit(partial(firewall.delete_user, instance))
+        queue_firewall({firewall.user_key(instance.pk)})
 
-    # just re-init if a group or servergroup are deleted
-    object_types = [hub.models.ServerGroup, hub.models.Group]
-    if any([isinstance(instance, ot) for ot in object_types]):
-        transaction.on_commit(firewall.init)
+    # rebuild the rules and policies that sourced or targeted a deleted user, group, server or servergroup
+    queue_firewall(getattr(instance, "_firewall_dependents", None))
 
 
 ###############################
 ##### m2m_changed events
 ###############################
 
+def membership_dependents(kind, instance, pk_set, fallback):
+    """
+    Returns the firewall scope depending on a membership change between `instance` and the objects with
+    `pk_set`, where `kind` is the kind of the group side of the relation. If the members were cleared,
+    `pk_set` is None and `fallback` is returned.
+    """
+    if DEPENDENCY_KINDS.get(type(instance)) == kind:
+        return compiler.dependents(kind, [instance.pk])
+    if pk_set is None:
+        return fallback
+    return compiler.dependents(kind, pk_set)
+
+
+# m2m through models of Rules and Policies, with the model owning the relation, the scope key of an owner and
+# the scope rebuilding every owner
+FIREWALL_RELATIONS = {
+    **{
+        through: (hub.models.Rule, compiler.rule_key, compiler.RULES)
+        for through in [
+            hub.models.Rule.source_users.through,
+            hub.models.Rule.source_groups.through,
+            hub.models.Rule.source_servers.through,
+            hub.models.Rule.source_servergroups.through,
+        ]
+    },
+    **{
+        through: (hub.models.Policy, firewall.policy_key, compiler.POLICIES)
+        for through in [hub.models.Policy.rules.through, hub.models.Policy.servers.through, hub.models.Policy.servergroups.through]
+    },
+}
+
+
+def relation_scope(sender, instance, pk_set):
+    """
+    Returns the firewall scope rebuilding the Rules or Policies whose relation `sender` changed, whether it
+    was changed from their side, eg. rule.source_users.add(), or the reverse one, eg. user.rule_set.add().
+    If a reverse relation was cleared, `pk_set` is None and all owners are rebuilt.
+    """
+    model, key, everything = FIREWALL_RELATIONS[sender]
+    if isinstance(instance, model):
+        return {key(instance.pk)}
+    if pk_set is None:
+        return {everything}
+    return {key(pk) for pk in pk_set}
+
+
 @receiver(m2m_changed)
 def update_object(sender, instance=None, created=False, **kwargs):
-    "update iptables for Rules and Policies"
+    "update iptables for Rules and Policies, and for changes to the Group or ServerGroup memberships they use"
 
-    if isinstance(instance, hub.models.Rule):
-        firewall.apply_rule(instance)
-    elif isinstance(instance, hub.models.Policy):
-        firewall.apply_policy(instance)
-    elif isinstance(instance, hub.models.User) and kwargs.get("action") == "post_remove":
-        # make "All Users" group membership immutable
-        all_users_group = hub.models.Group.objects.get(name="All Users")
-        if all_users_group not in instance.groups.all():
-            logger.info(f"preventing user '{instance}' from leaving group '{all_users_group}'")
-            instance.groups.add(all_users_group)
-        transaction.on_commit(firewall.init)
-    else:
-        transaction.on_commit(firewall.init)
+    action = kwargs.get("action")
+    if kwargs.get("pk_set") is not None and not kwargs["pk_set"]:
+        # eg. adding a member that is already present
+        return
+    if sender in FIREWALL_RELATIONS:
+        if action.startswith("post_"):
+            queue_firewall(relation_scope(sender, instance, kwargs.get("pk_set")))
+    elif sender is hub.models.User.groups.through:
+        if isinstance(instance, hub.models.User) and action == "post_remove":
+            # make "All Users" group membership immutable
+            all_users_group = hub.models.Group.objects.get(name="All Users")
+            if all_users_group not in instance.groups.all():
+                logger.info(f"preventing user '{instance}' from leaving group '{all_users_group}'")
+                instance.groups.add(all_users_group)
+        if action.startswith("post_"):
+            queue_firewall(membership_dependents("group", instance, kwargs.get("pk_set"), {compiler.RULES}))
+    elif sender is hub.models.Server.server_groups.through:
+        if action.startswith("post_"):
+            queue_firewall(membership_dependents("servergroup", instance, kwargs.get("pk_set"), {compiler.RULES, compiler.POLICIES}))
 
 
 ###############################
 ##### other events
 ###############################
 
+# models the firewall is compiled from
+FIREWALL_MODELS = (
+    hub.models.Rule,
+    hub.models.Policy,
+    hub.models.Server,
+    hub.models.ServerGroup,
+    hub.models.User,
+    hub.models.Group,
+    hub.models.UserProfile,
+)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+@receiver(m2m_changed)
+def bump_firewall_revision(sender, instance=None, **kwargs):
+    "invalidate the saved firewall snapshot when anything the firewall is compiled from changes"
+
+    if is_irrelevant_update(instance, kwargs.get("update_fields")) or (kwargs.get("pk_set") is not None and not kwargs["pk_set"]):
+        return
+    if isinstance(instance, FIREWALL_MODELS) and kwargs.get("action", "post_").startswith("post_"):
+        hub.models.FirewallState.bump()
+
+
 @receiver(user_logged_in)
 def post_login(sender, user, request, **kwargs):
     "add warning alert for admin user if using default admin login password"
@@ -274,16 +405,22 @@ def create_default_groups(sender, **kwargs):
         group, created = hub.models.Group.objects.update_or_create(
             name="All Users",
         )
-        all_users = hub.models.User.objects.all()
-        for user in all_users:
-            if user not in group.user_set.all():
-                user.groups.add(group)
+        # backfill memberships in bulk, the firewall matches All Users by subnet and is unaffected
+        through = hub.models.User.groups.through
+        through.objects.bulk_create(
+            [through(user_id=pk, group_id=group.pk) for pk in hub.models.User.objects.exclude(groups=group).values_list("pk", flat=True)],
+            ignore_conflicts=True,
+        )
 
         # create All Servers group
         server_group, created = hub.models.ServerGroup.objects.update_or_create(
             name="All Servers",
         )
-        all_servers = hub.models.Server.objects.all()
-        for server in all_servers:
-            if server not in server_group.server_set.all():
-                server.server_groups.add(server_group)
+        through = hub.models.Server.server_groups.through
+        through.objects.bulk_create(
+            [
+                through(server_id=pk, servergroup_id=server_group.pk)
+                for pk in hub.models.Server.objects.exclude(server_groups=server_group).values_list("pk", flat=True)
+            ],
+            ignore_conflicts=True,
+        )
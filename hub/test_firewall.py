@@ -0,0 +1,47 @@
+import pytest
+
+from evon.job_queue import job_queue
+from hub import firewall
+import hub.models
+
+
+@pytest.fixture
+def inline_jobs():
+    "runs queued jobs in the test's DB transaction, which worker threads can't see"
+    workers = job_queue.workers
+    job_queue.set_workers(0)
+    yield
+    job_queue.set_workers(workers)
+
+
+@pytest.mark.django_db
+def test_iptc_init_jumps_from_forward_once(kernel, monkeypatch, inline_jobs):
+    monkeypatch.setattr(firewall, "backend", "iptc")
+    firewall.init.__wrapped__()
+    firewall.init.__wrapped__()
+    assert sorted(spec.split("--comment ")[1].split()[0] for spec in kernel.table["FORWARD"]) == [
+        "evon-forward-to-evon-main", "evon-forward-to-evon-user"
+    ]
+
+
+@pytest.mark.django_db
+def test_iptc_jobs_skip_objects_deleted_since_they_were_queued(kernel, monkeypatch, inline_jobs):
+    monkeypatch.setattr(firewall, "backend", "iptc")
+    firewall.init.__wrapped__()
+    Rule = hub.models.Rule
+    rule = Rule.objects.create(name="ssh", destination_protocol=Rule.TCP, destination_ports="22")
+    policy = hub.models.Policy.objects.create(name="ssh")
+    policy.rules.add(rule)
+    policy.servers.add(hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn="web-1.test", ipv4_address="100.111.224.6")
+    ])[0])
+    # the instances jobs were queued with before the objects were deleted
+    stale_rule, stale_policy = Rule.objects.get(pk=rule.pk), hub.models.Policy.objects.get(pk=policy.pk)
+    chain_name = rule.get_chain_name()
+    policy.delete()
+    rule.delete()
+
+    firewall.apply_rule.__wrapped__(stale_rule)
+    firewall.apply_policy.__wrapped__(stale_policy)
+    assert chain_name not in kernel.table
+    assert kernel.table["evon-policy"] == []
@@ -0,0 +1,136 @@
+from django.db import transaction
+import pytest
+
+from eapi.settings import EVON_VARS
+from hub import firewall, signals
+from hub.fw import compiler
+import hub.models
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    "returns the list of scopes passed to firewall.apply_scope()"
+    scopes = []
+    monkeypatch.setattr(firewall, "apply_scope", scopes.append)
+    return scopes
+
+
+def test_deleting_a_servergroup_rebuilds_what_depended_on_it(applied, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        servergroup = hub.models.ServerGroup.objects.create(name="web")
+        rule = hub.models.Rule.objects.create(name="ping", destination_protocol=hub.models.Rule.ICMP)
+        rule.source_servergroups.add(servergroup)
+        policy = hub.models.Policy.objects.create(name="web")
+        policy.servergroups.add(servergroup)
+    applied.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        servergroup.delete()
+    # collected before the relations were deleted along with the ServerGroup
+    assert applied == [{compiler.rule_key(rule.pk), compiler.POLICIES}]
+
+
+def test_connection_state_saves_leave_the_firewall_alone(applied, django_capture_on_commit_callbacks):
+    server = hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn=f"web-1.{EVON_VARS['account_domain']}", ipv4_address="100.111.224.6")
+    ])[0]
+    with django_capture_on_commit_callbacks(execute=True):
+        user = hub.models.User.objects.create(username="alice")
+    applied.clear()
+    revision = hub.models.FirewallState.get_solo().revision
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        server.connected = True
+        server.save(update_fields=hub.models.Server.connection_fields)
+        user.save(update_fields=["last_login"])
+    assert (callbacks, applied) == ([], [])
+    assert hub.models.FirewallState.get_solo().revision == revision
+
+    with django_capture_on_commit_callbacks(execute=True):
+        user.save(update_fields=["last_login", "is_active"])
+    assert applied == [{firewall.user_key(user.pk)}]
+    assert hub.models.FirewallState.get_solo().revision > revision
+
+
+def test_intents_of_a_transaction_are_applied_once(applied, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        signals.queue_firewall({"rule:1"})
+        signals.queue_firewall({"rule:2", compiler.POLICIES})
+        signals.queue_firewall(set())
+    assert applied == [{"rule:1", "rule:2", compiler.POLICIES}]
+
+
+def test_intents_are_dropped_with_their_savepoint(applied, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        with pytest.raises(RuntimeError), transaction.atomic():
+            signals.queue_firewall({"rule:1"})
+            raise RuntimeError
+        signals.queue_firewall({"rule:2"})
+    assert applied == [{"rule:2"}]
+
+
+def test_intents_of_released_savepoints_are_applied(applied, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            signals.queue_firewall({"rule:1"})
+        signals.queue_firewall({"rule:2"})
+    assert set().union(*applied) == {"rule:1", "rule:2"}
+
+
+def test_intents_outside_a_transaction_are_applied_immediately(applied, monkeypatch):
+    monkeypatch.setattr(transaction.get_connection(), "in_atomic_block", False)
+    signals.queue_firewall({"rule:1"})
+    assert applied == [{"rule:1"}]
+
+
+def test_intents_queued_while_flushing_are_applied_afresh(monkeypatch, django_capture_on_commit_callbacks):
+    applied = []
+
+    def apply_scope(scope):
+        applied.append(set(scope))
+        if len(applied) == 1:
+            signals.queue_firewall({"rule:3"})
+
+    monkeypatch.setattr(firewall, "apply_scope", apply_scope)
+    with django_capture_on_commit_callbacks(execute=True):
+        signals.queue_firewall({"rule:1"})
+    assert applied == [{"rule:1"}, {"rule:3"}]
+
+
+def test_reverse_relation_changes_rebuild_their_rules_and_policies(applied, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        server = hub.models.Server.objects.bulk_create([
+            hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn=f"web-1.{EVON_VARS['account_domain']}", ipv4_address="100.111.224.6")
+        ])[0]
+        servergroup = hub.models.ServerGroup.objects.create(name="web")
+        user = hub.models.User.objects.create(username="alice")
+        rule = hub.models.Rule.objects.create(name="ping", destination_protocol=hub.models.Rule.ICMP)
+        policy = hub.models.Policy.objects.create(name="web")
+        policy.servergroups.add(servergroup)
+
+    for change, scope in [
+        (lambda: server.policy_set.add(policy), {firewall.policy_key(policy.pk)}),
+        (lambda: servergroup.policy_set.remove(policy), {firewall.policy_key(policy.pk)}),
+        (lambda: rule.policy_set.add(policy), {firewall.policy_key(policy.pk)}),
+        (lambda: user.rule_set.add(rule), {compiler.rule_key(rule.pk)}),
+        (lambda: user.rule_set.clear(), {compiler.RULES}),
+        (lambda: server.policy_set.clear(), {compiler.POLICIES}),
+    ]:
+        applied.clear()
+        with django_capture_on_commit_callbacks(execute=True):
+            change()
+        assert applied == [scope]
+
+
+def test_connection_state_saves_write_normalised_fields(applied, django_capture_on_commit_callbacks):
+    server = hub.models.Server.objects.bulk_create([
+        hub.models.Server(uuid="7f1b3cd4-0000-4000-8000-000000000001", fqdn="web-1", ipv4_address="100.111.224.6")
+    ])[0]
+    revision = hub.models.FirewallState.get_solo().revision
+    with django_capture_on_commit_callbacks(execute=True):
+        server.connected = True
+        server.save(update_fields=hub.models.Server.connection_fields)
+    server.refresh_from_db()
+    assert (server.connected, server.fqdn) == (True, f"web-1.{EVON_VARS['account_domain']}")
+    assert hub.models.FirewallState.get_solo().revision > revision
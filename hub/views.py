@@ -22,6 +22,7 @@ import requests
 
 from eapi.settings import EVON_HUB_CONFIG
 from evon import log
+from evon.job_queue import job_queue
 from hub import models
 from hub.api import serializers
 from hub.renderers import BinaryFileRenderer
@@ -243,6 +244,80 @@ class PingViewSet(ViewSet):
         return Response({"message": "pong"})
 
 
+class JobQueueViewSet(ViewSet):
+    """
+    Background job queue metrics, eg. how far behind the firewall worker is
+    """
+    serializer_class = serializers.JobQueueSerializer
+    permission_classes = (hub.permissions.IsSuperuser,)
+
+    @extend_schema(
+        operation_id="jobqueue_stats",
+        responses={
+            200: OpenApiTypes.OBJECT,
+        },
+        examples=[
+            OpenApiExample(
+                'example response',
+                description='Successful response. Histogram buckets count the jobs that waited or ran for up to 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300 and more than 300 seconds',
+                value={
+                    "processes": 3,
+                    "depth": 1,
+                    "oldest_pending_seconds": 0.42,
+                    "jobs": {
+                        "apply_rule": {
+                            "submitted": 12,
+                            "coalesced": 30,
+                            "deduped": 0,
+                            "completed": 11,
+                            "failed": 0,
+                            "retried": 0,
+                            "escalated": 0,
+                            "last_error": None,
+                            "wait": {"buckets": [0, 0, 0, 9, 2, 0, 0, 0, 0, 0, 0], "count": 11, "sum": 5.9, "max": 0.71},
+                            "run": {"buckets": [8, 3, 0, 0, 0, 0, 0, 0, 0, 0, 0], "count": 11, "sum": 0.12, "max": 0.03},
+                        },
+                    },
+                },
+                response_only=True,
+            ),
+        ]
+    )
+    def list(self, *args, **kwargs):
+        return Response(job_queue.stats())
+
+    @extend_schema(
+        operation_id="jobqueue_dead_letters",
+        responses={
+            200: OpenApiTypes.OBJECT,
+        },
+        examples=[
+            OpenApiExample(
+                'example response',
+                description='Successful response. Each entry is a job that failed on every retry and has not succeeded since',
+                value=[
+                    {
+                        "key": "apply-rule-3",
+                        "func": "apply_rule",
+                        "error": "iptables-restore failed with rc 1: chain evon-rule-3 is not empty or in use",
+                        "attempts": 4,
+                        "escalated": True,
+                        "pid": 2817,
+                        "failed": 1760793600.0,
+                    },
+                ],
+                response_only=True,
+            ),
+        ]
+    )
+    @action(methods=['get'], detail=False, url_path="dead-letters")
+    def dead_letters(self, *args, **kwargs):
+        """
+        Background jobs that failed on every attempt, eg. firewall changes that couldn't be applied
+        """
+        return Response(job_queue.dead_letters())
+
+
 class BootstrapViewSet(ViewSet):
     """
     Bootstrap functions
@@ -468,6 +468,7 @@ package_list='
     htop
     httpd-tools
     iproute
+    ipset
     iptables-services
     jq
     glibc-devel
@@ -476,6 +477,7 @@ package_list='
     libffi-devel
     mlocate
     net-tools
+    nftables
     nginx
     openssh
     openvpn